@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""Benchmarks for the startup costs that ``jupyter_kernel_hook`` keeps low.
+
+Everything runs offline, against a throwaway IPython directory and fake
+extensions. Results are compared against ``baseline.json`` and the script
+exits with status 1 if anything got slower than the tolerance allows.
+
+Usage::
+
+    python benchmarks/bench.py                 # compare against the baseline
+    python benchmarks/bench.py --save          # record a new baseline
+    python benchmarks/bench.py -k kernel_start # only matching benchmarks
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import typing as t
+from types import SimpleNamespace
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+
+sys.path.insert(0, REPO_DIR)
+
+FAKE_EXTENSION_SOURCE = """
+def load_ipython_extension(ip):
+    pass
+"""
+
+
+def _extension_names(n: int) -> t.List[str]:
+    return [f"jkh_bench_ext_{i}" for i in range(n)]
+
+
+def _write_fake_extensions(site_dir: str, n: int) -> t.List[str]:
+    os.makedirs(site_dir, exist_ok=True)
+    names = _extension_names(n)
+    for name in names:
+        with open(os.path.join(site_dir, f"{name}.py"), "w") as f:
+            f.write(FAKE_EXTENSION_SOURCE)
+    return names
+
+
+def _fake_nb_app(names: t.List[str]) -> SimpleNamespace:
+    log = logging.getLogger("jupyter_kernel_hook.bench")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+    return SimpleNamespace(
+        nbserver_extensions={name: True for name in names},
+        log=log
+    )
+
+
+def _register(startup_dir: str, names: t.List[str], **kwargs) -> None:
+    from jupyter_kernel_hook import _globals
+    from jupyter_kernel_hook import create_startup_script
+
+    _globals.startup_dir = startup_dir
+    nb_app = _fake_nb_app(names)
+    for name in names:
+        create_startup_script(
+            nb_app,
+            f"{name}:load_ipython_extension(ip)",
+            **kwargs
+        )
+
+
+def _register_many(startup_dir: str, names: t.List[str], **kwargs) -> None:
+    from jupyter_kernel_hook import _globals
+    from jupyter_kernel_hook import create_startup_scripts
+
+    _globals.startup_dir = startup_dir
+    nb_app = _fake_nb_app(names)
+    create_startup_scripts(
+        nb_app,
+        [f"{name}:load_ipython_extension(ip)" for name in names],
+        **kwargs
+    )
+
+
+def _subprocess_seconds(code: str, env: t.Optional[dict] = None) -> float:
+    """Run ``code`` in a fresh interpreter; it must print elapsed seconds."""
+    out = subprocess.check_output(
+        [sys.executable, "-c", code],
+        env=env,
+        cwd=REPO_DIR
+    )
+    return float(out.decode().strip().splitlines()[-1])
+
+
+# Benchmarks
+#
+# Each one takes a scratch directory and returns elapsed seconds for a single
+# run. ``main`` repeats them and keeps the median.
+
+def bench_import_core(tmp: str) -> float:
+    return _subprocess_seconds(
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "import jupyter_kernel_hook.core\n"
+        "print(time.perf_counter() - start)\n"
+    )
+
+
+def _bench_register(
+        n: int,
+        register: t.Callable[..., None] = _register,
+        **kwargs
+) -> t.Callable[[str], float]:
+    def bench(tmp: str) -> float:
+        startup_dir = os.path.join(tmp, "startup")
+        os.makedirs(startup_dir)
+        names = _extension_names(n)
+        start = time.perf_counter()
+        register(startup_dir, names, **kwargs)
+        return time.perf_counter() - start
+    return bench
+
+
+def _enabled_env(tmp: str, cache: bool) -> dict:
+    config_dir = os.path.join(tmp, "config")
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, "jupyter_notebook_config.json"), "w") as f:
+        json.dump({
+            "NotebookApp": {"nbserver_extensions": {"jkh_bench_ext_0": True}}
+        }, f)
+    env = dict(os.environ)
+    env.pop("JUPYTER_KERNEL_HOOK_ENABLED_EXTENSIONS", None)
+    env.pop("JUPYTER_KERNEL_HOOK_NO_CACHE", None)
+    env.update(
+        JUPYTER_CONFIG_DIR=config_dir,
+        JUPYTER_KERNEL_HOOK_CACHE_DIR=os.path.join(tmp, "cache")
+    )
+    if not cache:
+        env["JUPYTER_KERNEL_HOOK_NO_CACHE"] = "1"
+    return env
+
+
+ENABLED_CODE = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "from jupyter_kernel_hook import extension_is_enabled\n"
+    "assert extension_is_enabled('jkh_bench_ext_0')\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def bench_enabled_cold(tmp: str) -> float:
+    return _subprocess_seconds(ENABLED_CODE, env=_enabled_env(tmp, cache=False))
+
+
+def bench_enabled_warm(tmp: str) -> float:
+    env = _enabled_env(tmp, cache=True)
+    _subprocess_seconds(ENABLED_CODE, env=env)
+    return _subprocess_seconds(ENABLED_CODE, env=env)
+
+
+def _bench_kernel_start(n: int, **kwargs) -> t.Callable[[str], float]:
+    def bench(tmp: str) -> float:
+        from jupyter_client import KernelManager
+
+        ipython_dir = os.path.join(tmp, "ipython")
+        startup_dir = os.path.join(ipython_dir, "profile_default", "startup")
+        os.makedirs(startup_dir)
+        site_dir = os.path.join(tmp, "site")
+        names = _write_fake_extensions(site_dir, n)
+        _register(startup_dir, names, **kwargs)
+
+        env = dict(os.environ)
+        env.update(
+            IPYTHONDIR=ipython_dir,
+            PYTHONPATH=os.pathsep.join([site_dir, REPO_DIR]),
+            JUPYTER_KERNEL_HOOK_CACHE_DIR=os.path.join(tmp, "cache"),
+            JUPYTER_KERNEL_HOOK_ENABLED_EXTENSIONS=json.dumps(names)
+        )
+        km = KernelManager(kernel_name="python3")
+        start = time.perf_counter()
+        km.start_kernel(env=env)
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=120)
+            return time.perf_counter() - start
+        finally:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+    return bench
+
+
+BENCHMARKS = {
+    "import_core": bench_import_core,
+    "register_scripts_50": _bench_register(50),
+    "register_bundle_50": _bench_register(50, bundle=True),
+    "register_many_scripts_50": _bench_register(50, _register_many),
+    "register_many_bundle_50": _bench_register(
+        50, _register_many, bundle=True
+    ),
+    "enabled_lookup_cold_cache": bench_enabled_cold,
+    "enabled_lookup_warm_cache": bench_enabled_warm,
+    "kernel_start_0": _bench_kernel_start(0),
+    "kernel_start_1": _bench_kernel_start(1),
+    "kernel_start_10": _bench_kernel_start(10),
+    "kernel_start_50": _bench_kernel_start(50),
+    "kernel_start_bundle_50": _bench_kernel_start(50, bundle=True),
+}
+
+
+def run_benchmarks(
+        names: t.List[str],
+        repeat: int = 5
+) -> t.Dict[str, float]:
+    results = {}
+    for name in names:
+        times = []
+        for _ in range(repeat):
+            tmp = tempfile.mkdtemp(prefix="jkh_bench_")
+            try:
+                times.append(BENCHMARKS[name](tmp))
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        results[name] = statistics.median(times)
+        print(f"{name:<28} {results[name] * 1000:10.2f}ms")
+    return results
+
+
+def compare(
+        results: t.Dict[str, float],
+        baseline: dict,
+        tolerance: float,
+        floor: float
+) -> t.List[str]:
+    """Names of benchmarks that are slower than the baseline allows.
+
+    A result regresses if it exceeds the baseline by more than ``tolerance``
+    times *and* by more than ``floor`` seconds, so tiny numbers don't flap.
+    """
+    regressions = []
+    for name, seconds in results.items():
+        try:
+            expected = baseline["results"][name]
+        except KeyError:
+            continue
+        if seconds > expected * tolerance and seconds - expected > floor:
+            regressions.append(
+                f"{name}: {seconds * 1000:.2f}ms vs. baseline"
+                f" {expected * 1000:.2f}ms ({seconds / expected:.2f}x)"
+            )
+    return regressions
+
+
+def _environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", dest="pattern", default="",
+                        help="Only run benchmarks whose name contains this.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", action="store_true",
+                        help="Write the results to the baseline file.")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Allowed slowdown factor (default: 1.5).")
+    parser.add_argument("--floor", type=float, default=0.005,
+                        help="Ignore slowdowns below this many seconds.")
+    args = parser.parse_args(argv)
+
+    names = [i for i in BENCHMARKS if args.pattern in i]
+    results = run_benchmarks(names, repeat=args.repeat)
+
+    if args.save:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            baseline = {"results": {}}
+        baseline["environment"] = _environment()
+        baseline["results"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {args.baseline!r}.")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline!r}; run with --save first.")
+        return 1
+    if baseline.get("environment") != _environment():
+        print("Warning: the baseline was recorded in a different environment:"
+              f" {baseline.get('environment')!r}")
+
+    regressions = compare(results, baseline, args.tolerance, args.floor)
+    if regressions:
+        print("\nPERFORMANCE REGRESSIONS:")
+        for i in regressions:
+            print(f"  {i}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
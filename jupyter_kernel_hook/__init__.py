@@ -7,8 +7,21 @@ def create_startup_script(
         script_info: str,
         priority: int = 50,
         overwrite: bool = False,
-        add_to_globals: bool = False
-) -> None:
+        add_to_globals: bool = False,
+        export_enabled: bool = False,
+        bundle: bool = False,
+        lazy: bool = False,
+        defer_magics: bool = False,
+        mode: str = "sync",
+        after: "typing.Sequence[str]" = (),
+        before: "typing.Sequence[str]" = (),
+        wait: bool = True,
+        precompile: bool = False,
+        time_budget: "typing.Optional[float]" = None,
+        memory_budget: "typing.Union[int, str, None]" = None,
+        profile: bool = False,
+        conditions: "typing.Optional[dict]" = None
+) -> "typing.Optional[concurrent.futures.Future]":
     """Create IPython startup script for your module.
 
     Args:
@@ -21,9 +34,67 @@ def create_startup_script(
         priority: The prefix to the startup script file that's created.
             Generally you should keep this at 50 unless you have a good reason.
         overwrite: Whether to overwrite the startup script file if it exists.
-            By default this is turned off.
+            By default this is turned off. Scripts whose content hasn't
+            changed are never rewritten, and a script whose priority changed
+            is renamed rather than duplicated.
         add_to_globals: If True, add the imported package to the global
             namespace of the IPython kernel on load.
+        export_enabled: If True, export the server's enabled extension set to
+            the environment of the kernels it launches, so the kernels never
+            read the Jupyter config files to check whether a hook is enabled.
+        bundle: If True, add the hook to a shared manifest that a single
+            startup script runs through ``jupyter_kernel_hook.runtime``,
+            instead of writing a startup script just for this package.
+        lazy: If True, don't import the package at startup. Instead, bind a
+            proxy to the package's top-level name in the kernel's globals
+            that imports it on first attribute access. Dotted paths are
+            supported. Only valid when ``script_info`` has no function call.
+        defer_magics: If True, find out which magics the function call
+            registers (e.g. ``load_ipython_extension(ip)``) when the server
+            starts, and register lightweight stubs for them in the kernel.
+            The package is imported the first time one of the magics is used.
+            If the call does anything besides registering magics, the package
+            is loaded at startup as usual.
+        mode: ``"sync"`` (the default) loads the package while the kernel
+            starts up. ``"background"`` imports it on a worker thread so the
+            kernel is ready sooner; the function call runs on the main thread
+            once the import is done, before the next cell. A cell that
+            mentions the package waits for it first.
+        after: Names of hooked extensions that must finish loading before
+            this one starts. Requires ``bundle=True``. Hooks that don't
+            depend on each other are imported concurrently.
+        before: Names of hooked extensions that must not start loading
+            until this one is done. Requires ``bundle=True``.
+        wait: If False, write the script on a background thread so the
+            server isn't held up by a slow file system, and return a
+            ``concurrent.futures.Future`` (use ``asyncio.wrap_future`` to
+            await it). Kernels launched before it's done are sent the new
+            hooks once they're written, and the server logs them.
+        precompile: If True, find the modules that importing the package
+            loads, and compile them ahead of time into a bytecode cache that
+            the kernel imports the package from. This helps kernels whose
+            ``__pycache__`` directories are missing or read-only. Requires
+            Python 3.8, and doesn't apply to ``lazy`` hooks.
+        time_budget: Seconds the kernel waits for the package to load. If
+            the import takes longer, the kernel starts without it and warns.
+            Either way, a hook that goes over is skipped by later kernels
+            until the package's version changes.
+        memory_budget: Same as ``time_budget``, for how much loading may
+            grow the kernel's resident memory, in bytes or as a string like
+            ``"512M"``. Admins can override both budgets (see
+            ``jupyter_kernel_hook.watchdog``).
+        profile: If True, measure how long the startup script takes to
+            import the package and make the call, and how much memory it
+            adds, in a subprocess, and warn in the server log if it's too
+            much (see ``jupyter_kernel_hook.importcost``). The hook is
+            profiled again when its version or its script changes.
+        conditions: Only load the package in kernels that meet all of these,
+            checked before anything is imported. The keys are
+            ``"kernel_name"`` (patterns for the kernel spec's name), ``"env"``
+            (environment variables and patterns for their values, or None if
+            the variable must be unset) and ``"executable"`` (patterns for
+            ``sys.executable``). Patterns starting with ``!`` exclude what
+            they match (see ``jupyter_kernel_hook.conditions``).
     """
     # Lazy load core module to reduce unnecessary overhead.
     # The only time this script ever needs to run is when firing up Jupyter.
@@ -37,7 +108,57 @@ def create_startup_script(
         script_info,
         priority=priority,
         overwrite=overwrite,
-        add_to_globals=add_to_globals
+        add_to_globals=add_to_globals,
+        export_enabled=export_enabled,
+        bundle=bundle,
+        lazy=lazy,
+        defer_magics=defer_magics,
+        mode=mode,
+        after=after,
+        before=before,
+        wait=wait,
+        precompile=precompile,
+        time_budget=time_budget,
+        memory_budget=memory_budget,
+        profile=profile,
+        conditions=conditions
+    )
+
+
+def create_startup_scripts(
+        nb_app: "notebook.notebookapp.NotebookApp",
+        specs: "typing.Iterable[typing.Union[str, dict]]",
+        export_enabled: bool = False,
+        wait: bool = True,
+        **options
+) -> "jupyter_kernel_hook.core.RegistrationReport":
+    """Create IPython startup scripts for many modules at once.
+
+    Every spec is validated before anything is written, the startup directory
+    is read once, and the files are all written at the end. In bundle mode
+    the manifest is written only once, however many hooks there are.
+
+    Args:
+        nb_app: Active NotebookApp instance.
+        specs: Each one is either a ``script_info`` string, or a dict with a
+            ``"script_info"`` key plus any options to use for that hook only.
+        export_enabled: See ``create_startup_script``.
+        wait: See ``create_startup_script``. If False, the specs are still
+            validated right away, and the future's result is the report.
+        **options: Options for every hook, as in ``create_startup_script``.
+
+    Returns:
+        A report with the paths of the files that were ``written``, and the
+        names of the extensions that were ``skipped`` because their scripts
+        were already there and up to date or ``disabled`` on the server.
+    """
+    from .core import main_many
+    return main_many(
+        nb_app,
+        specs,
+        export_enabled=export_enabled,
+        wait=wait,
+        **options
     )
 
 
@@ -49,7 +170,8 @@ def extension_is_enabled(ext: str) -> bool:
     reimplements that logic.
 
     Lazy-loading ``enabled_server_extensions`` from ``_globals`` causes it to
-    run the Notebook app config logic.
+    run the Notebook app config logic, unless the server exported the enabled
+    set to the kernel's environment (see ``export_enabled``).
 
     Args:
         ext: Name of a Jupyter server extension.
@@ -62,8 +184,32 @@ def extension_is_enabled(ext: str) -> bool:
     return bool(ext in li)
 
 
+def _jupyter_server_extension_paths():
+    return [{"module": "jupyter_kernel_hook"}]
+
+
+def load_jupyter_server_extension(nb_app: "notebook.notebookapp.NotebookApp"):
+    """Check for stale startup scripts whenever the server starts, and apply
+    new hooks to running kernels.
+
+    Enable this with ``jupyter serverextension enable jupyter_kernel_hook``.
+    It logs the scripts and bundled hooks of extensions that are no longer
+    enabled, or that can't be imported, and cleans them up if
+    ``JUPYTER_KERNEL_HOOK_RECONCILE`` says to (see
+    ``core.reconcile_on_start``). Run
+    ``python -m jupyter_kernel_hook reconcile`` to clean them up by hand.
+    Then it watches for hooks that are added or enabled while the server
+    runs (see ``jupyter_kernel_hook.hotapply``).
+    """
+    from .core import reconcile_on_start
+    from .hotapply import watch
+    reconcile_on_start(nb_app)
+    watch(nb_app)
+
+
 __all__ = [
     "create_startup_script",
+    "create_startup_scripts",
     "extension_is_enabled",
     "__version__"
 ]
@@ -0,0 +1,208 @@
+"""Command line tools for admins: ``python -m jupyter_kernel_hook --help``."""
+import sys
+import logging
+import argparse
+import typing as t
+
+
+def _conditions(args: argparse.Namespace) -> t.Optional[dict]:
+    conditions = {}
+    if args.kernel_name:
+        conditions["kernel_name"] = args.kernel_name
+    if args.executable:
+        conditions["executable"] = args.executable
+    env = {}
+    for item in args.env:
+        name, eq, pattern = item.partition("=")
+        env[name] = pattern if eq else "*"
+    env.update((name, None) for name in args.unset_env)
+    if env:
+        conditions["env"] = env
+    return conditions or None
+
+
+def _install_shared(args: argparse.Namespace) -> int:
+    from .core import install_shared
+    report = install_shared(
+        args.specs,
+        shared_dir=args.shared_dir,
+        ipython_config_dir=args.ipython_config_dir,
+        priority=args.priority,
+        overwrite=args.overwrite,
+        lazy=args.lazy,
+        defer_magics=args.defer_magics,
+        mode=args.mode,
+        precompile=args.precompile,
+        time_budget=args.time_budget,
+        memory_budget=args.memory_budget,
+        profile=args.profile,
+        conditions=_conditions(args)
+    )
+    for path in report.skipped:
+        print(f"{path!r} is already installed.")
+    return 0
+
+
+def _reconcile(args: argparse.Namespace) -> int:
+    from . import _globals
+    from .core import reconcile
+    enabled, _ = _globals._scan_enabled_server_extensions()
+    report = reconcile(
+        enabled,
+        startup_dir=args.startup_dir,
+        quarantine=args.quarantine,
+        dry_run=args.dry_run
+    )
+    verb = "Would" if args.dry_run else "Did"
+    for path in report.removed:
+        print(f"{verb} remove {path!r}.")
+    for path in report.quarantined:
+        print(f"{verb} quarantine {path!r}.")
+    return 0
+
+
+def _profile(args: argparse.Namespace) -> int:
+    from . import importcost
+    from .core import ScriptInfo
+    from .core import render_startup_script
+    status = 0
+    for spec in args.specs:
+        script_info = ScriptInfo.from_str(spec)
+        path = script_info.path
+        if args.history:
+            costs = importcost.history(path)
+            if not costs:
+                print(f"{path!r} hasn't been profiled yet.")
+            for cost in costs:
+                print(cost.summary())
+            continue
+        try:
+            cost = importcost.measure(
+                path,
+                script=render_startup_script(script_info),
+                force=args.force,
+                top=args.top
+            )
+        except Exception as e:
+            print(f"Could not profile {path!r}: {e}", file=sys.stderr)
+            status = 1
+            continue
+        print(cost.summary())
+        for name, seconds, cumulative in cost.top[:args.top]:
+            print(f"  {seconds:8.3f}s {cumulative:8.3f}s  {name}")
+        for message in importcost.check(cost):
+            logging.warning(message)
+    return status
+
+
+def build_parser() -> argparse.ArgumentParser:
+    from .runtime import MODES
+
+    parser = argparse.ArgumentParser(
+        prog="python -m jupyter_kernel_hook",
+        description=__doc__.splitlines()[0]
+    )
+    # ``required`` isn't a keyword argument before Python 3.7.
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    p = subparsers.add_parser(
+        "install-shared",
+        help="Install hooks in the host's shared bundle, for every user.",
+        description="Install hooks in the host's shared bundle, and make"
+                    " every kernel in this environment load it. Servers then"
+                    " skip writing their own scripts for these hooks."
+    )
+    p.add_argument("specs", nargs="+", metavar="SCRIPT_INFO",
+                   help="e.g. 'my_package:load_ipython_extension(ip)'")
+    p.add_argument("--shared-dir", default=None,
+                   help="Defaults to $JUPYTER_KERNEL_HOOK_SHARED_DIR, or"
+                        " {sys.prefix}/share/jupyter_kernel_hook.")
+    p.add_argument("--ipython-config-dir", default=None,
+                   help="Where to add the kernel config that loads the"
+                        " bundle. Defaults to {sys.prefix}/etc/ipython.")
+    p.add_argument("--priority", type=int, default=50)
+    p.add_argument("--overwrite", action="store_true")
+    p.add_argument("--lazy", action="store_true")
+    p.add_argument("--defer-magics", action="store_true")
+    p.add_argument("--mode", choices=MODES, default="sync")
+    p.add_argument("--precompile", action="store_true",
+                   help="Precompile the hooks' imports. Set"
+                        " $JUPYTER_KERNEL_HOOK_PYCACHE_PREFIX to a directory"
+                        " that every user can read.")
+    p.add_argument("--time-budget", type=float, default=None,
+                   metavar="SECONDS",
+                   help="Start kernels without a hook whose import takes"
+                        " longer than this.")
+    p.add_argument("--memory-budget", default=None, metavar="SIZE",
+                   help="Same, for resident memory growth, e.g. 512M.")
+    p.add_argument("--profile", action="store_true",
+                   help="Measure what the hooks' imports cost, and warn if"
+                        " it's too much.")
+    p.add_argument("--kernel-name", action="append", default=[],
+                   metavar="PATTERN",
+                   help="Only load the hooks in kernels whose spec name"
+                        " matches, e.g. 'python3', or doesn't match, e.g."
+                        " '!papermill-*'. Can be repeated.")
+    p.add_argument("--env", action="append", default=[],
+                   metavar="NAME[=PATTERN]",
+                   help="Only load the hooks in kernels where the variable"
+                        " is set (and its value matches). Can be repeated.")
+    p.add_argument("--unset-env", action="append", default=[],
+                   metavar="NAME",
+                   help="Only load the hooks in kernels where the variable"
+                        " isn't set. Can be repeated.")
+    p.add_argument("--executable", action="append", default=[],
+                   metavar="PATTERN",
+                   help="Only load the hooks in kernels whose Python"
+                        " executable matches. Can be repeated.")
+    p.set_defaults(func=_install_shared)
+
+    p = subparsers.add_parser(
+        "profile",
+        help="Measure what importing hooks adds to every kernel.",
+        description="Run each hook's startup script in a fresh interpreter,"
+                    " and show how long it took, how much memory it added,"
+                    " and the slowest modules it imported (their own time,"
+                    " then including their imports). Results are recorded"
+                    " per package version."
+    )
+    p.add_argument("specs", nargs="+", metavar="SCRIPT_INFO",
+                   help="e.g. 'my_package:load_ipython_extension(ip)'")
+    p.add_argument("--top", type=int, default=10,
+                   help="How many of the slowest modules to show.")
+    p.add_argument("--force", action="store_true",
+                   help="Profile again even if this version was profiled.")
+    p.add_argument("--history", action="store_true",
+                   help="Show the recorded costs of earlier versions instead.")
+    p.set_defaults(func=_profile)
+
+    p = subparsers.add_parser(
+        "reconcile",
+        help="Clean up startup scripts of disabled or missing extensions.",
+        description="Remove the startup scripts and bundled hooks of"
+                    " extensions that are no longer enabled, or that can't be"
+                    " imported. Scripts that jupyter_kernel_hook didn't"
+                    " generate are left alone."
+    )
+    p.add_argument("--startup-dir", default=None,
+                   help="Defaults to the startup directory of the IPython"
+                        " profile.")
+    p.add_argument("--quarantine", action="store_true",
+                   help="Rename stale scripts to *.py.disabled instead of"
+                        " deleting them.")
+    p.add_argument("--dry-run", action="store_true",
+                   help="Only show what would be cleaned up.")
+    p.set_defaults(func=_reconcile)
+
+    return parser
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
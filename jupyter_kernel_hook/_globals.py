@@ -1,54 +1,460 @@
 # flake8: noqa: F821
 """Globals that are lazy-loaded as needed to keep things slim."""
 import os
+import sys
+import glob
+import errno
+import json
+import time
+import re
+import hashlib
+import functools
+import contextlib
 import typing as t
 
 
 # Eager loaded attributes
-TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
+MANIFEST_FILENAME = "jupyter_kernel_hook.json"
+BUNDLE_FILENAME = "50-jupyter_kernel_hook.py"
+LISTENER_FILENAME = "00-jupyter_kernel_hook-listener.py"
+CACHE_VERSION = 2
+ENABLED_EXTENSIONS_ENV_VAR = "JUPYTER_KERNEL_HOOK_ENABLED_EXTENSIONS"
+SHARED_DIR_ENV_VAR = "JUPYTER_KERNEL_HOOK_SHARED_DIR"
+
+# Config sections read, and where each one keeps its server extensions.
+_CONFIG_SECTIONS = {
+    "jupyter_notebook_config": ("NotebookApp", "nbserver_extensions"),
+    "jupyter_server_config": ("ServerApp", "jpserver_extensions"),
+}
+
+# Environment variables that change what ``jupyter_config_path()`` returns.
+# These are part of the cache key because the kernel checks the cache without
+# importing ``jupyter_core``.
+_CONFIG_ENV_VARS = (
+    "HOME",
+    "JUPYTER_CONFIG_DIR",
+    "JUPYTER_CONFIG_PATH",
+    "JUPYTER_NO_CONFIG",
+    "JUPYTER_PREFER_ENV_PATH",
+    "JUPYTER_PLATFORM_DIRS",
+    "PROGRAMDATA",
+    "XDG_CONFIG_HOME",
+)
 
 
 # Lazy loaded attributes
-jinja_env: "jinja2.Environment"
 startup_dir: str
 enabled_server_extensions: t.Set[str]
 
 
-def _get_jinja_env() -> "jinja2.Environment":
-    import jinja2
-    return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
-        keep_trailing_newline=True
-    )
+def get_ipython_dir() -> str:
+    """Same as ``IPython.paths.get_ipython_dir`` without importing IPython.
+
+    IPython's legacy ``~/.config/ipython`` migration is not reproduced.
+    """
+    ipython_dir = os.environ.get("IPYTHONDIR") \
+        or os.path.join(os.path.expanduser("~"), ".ipython")
+    return os.path.normpath(os.path.expanduser(ipython_dir))
+
+
+@functools.lru_cache(maxsize=None)
+def find_startup_dir(
+        profile: str = "default",
+        ipython_dir: t.Optional[str] = None
+) -> str:
+    """Startup directory of an IPython profile, created if it's missing.
+
+    Results are memoized for the life of the process.
+    """
+    if ipython_dir is None:
+        ipython_dir = get_ipython_dir()
+    startup_dir = os.path.join(ipython_dir, f"profile_{profile}", "startup")
+    os.makedirs(startup_dir, exist_ok=True)
+    return startup_dir
 
 
 def _get_startup_dir() -> str:
-    from IPython.paths import get_ipython_dir
-    from IPython.core.profiledir import ProfileDir
+    try:
+        return os.environ["JUPYTER_KERNEL_HOOK_STARTUP_DIR"]
+    except KeyError:
+        pass
+    profile = os.environ.get("JUPYTER_KERNEL_HOOK_PROFILE", "default")
+    return find_startup_dir(profile)
 
-    profile_dir = ProfileDir.find_profile_dir_by_name(
-        get_ipython_dir(),
-        "default"
-    )
-    return profile_dir.startup_dir
 
+def _atomic_write(path: str, data: str) -> None:
+    """Write through a temp file and ``os.replace``, so readers (e.g. kernels
+    starting up) never see a partially written file.
 
-def _get_enabled_server_extensions() -> t.Set[str]:
-    from notebook.config_manager import BaseJSONConfigManager
+    The temp file doesn't end in ``.py``, so IPython never runs it.
+    """
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "w", encoding="utf8") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# Finds the extension in generated startup scripts (see ``core.SCRIPT_MARKER``).
+# Scripts written before the marker was added are recognized by their body.
+_SCRIPT_MARKER_RE = re.compile(
+    r"^# Generated by jupyter_kernel_hook: (\S+)$"
+    r'|^    if extension_is_enabled\("([^"]+)"\):$',
+    re.M
+)
+
+
+def generated_for(script_path: str) -> t.Optional[str]:
+    """Name of the extension a startup script was generated for, or None if
+    it wasn't generated by ``jupyter_kernel_hook``.
+    """
+    try:
+        with open(script_path, encoding="utf8") as f:
+            content = f.read(4096)
+    except (OSError, UnicodeDecodeError):
+        return None
+    if "def __jupyter_kernel_hook()" not in content:
+        return None
+    m = _SCRIPT_MARKER_RE.search(content)
+    return (m.group(1) or m.group(2)) if m else None
+
+
+def _metadata():
+    """``importlib.metadata``, or its backport before Python 3.8."""
+    try:
+        from importlib import metadata
+    except ImportError:
+        import importlib_metadata as metadata
+    return metadata
+
+
+@functools.lru_cache(maxsize=None)
+def _packages_distributions() -> t.Dict[str, t.List[str]]:
+    """Top-level import names -> names of the distributions that provide
+    them. Scanned once per process.
+    """
+    metadata = _metadata()
+    try:
+        return metadata.packages_distributions()
+    except AttributeError:
+        pass
+    # Before Python 3.10 (or importlib_metadata 4.4), do what ``packages_distributions`` does.
+    d: t.Dict[str, t.List[str]] = {}
+    for dist in metadata.distributions():
+        top_level = (dist.read_text("top_level.txt") or "").split()
+        if not top_level:
+            top_level = {
+                f.parts[0] if len(f.parts) > 1 else f.with_suffix("").name
+                for f in dist.files or () if f.suffix == ".py"
+            }
+        for name in top_level:
+            d.setdefault(name, []).append(dist.metadata["Name"])
+    return d
+
+
+def package_version(path: str) -> t.Optional[str]:
+    """Version of the installed distribution that provides the package (e.g.
+    ``PyYAML`` for ``yaml``), found without importing the package.
+    """
+    name = path.partition(".")[0]
+    try:
+        metadata = _metadata()
+        distributions = _packages_distributions().get(name) or [name]
+    except Exception:
+        return None
+    for distribution in distributions:
+        try:
+            return metadata.version(distribution)
+        except Exception:
+            continue
+    return None
+
+
+def _cache_dir() -> str:
+    try:
+        return os.environ["JUPYTER_KERNEL_HOOK_CACHE_DIR"]
+    except KeyError:
+        pass
+    base = os.environ.get("XDG_CACHE_HOME") \
+        or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "jupyter_kernel_hook")
+
+
+def lock_path(directory: str) -> str:
+    """Lock file for writing to ``directory``. It's kept in the cache
+    directory, so startup directories only ever contain scripts.
+    """
+    key = hashlib.sha1(
+        os.path.realpath(directory).encode("utf8")
+    ).hexdigest()[:16]
+    return os.path.join(_cache_dir(), "locks", f"{key}.lock")
+
+
+_LOCK_CONTENTION_ERRNOS = (errno.EACCES, errno.EDEADLK)
+
+
+@contextlib.contextmanager
+def file_lock(path: str) -> t.Iterator[None]:
+    """Hold an exclusive lock on ``path`` (created if missing), across
+    processes. Blocks until the lock is available.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError as e:
+                    # ``LK_LOCK`` gives up after 10 seconds of contention.
+                    if e.errno not in _LOCK_CONTENTION_ERRNOS:
+                        raise
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def get_shared_dir() -> t.Optional[str]:
+    """Directory of the host's shared bundle. Set
+    ``JUPYTER_KERNEL_HOOK_SHARED_DIR`` to move it, or to an empty string to
+    not use one.
+    """
+    shared_dir = os.environ.get(SHARED_DIR_ENV_VAR)
+    if shared_dir is None:
+        return os.path.join(sys.prefix, "share", "jupyter_kernel_hook")
+    return shared_dir or None
+
+
+def hook_dirs() -> t.List[str]:
+    """Directories that hooks are registered in: the startup directory and
+    the shared bundle's.
+    """
+    dirs = [__getattr__("startup_dir")]
+    shared_dir = get_shared_dir()
+    if shared_dir:
+        dirs.append(shared_dir)
+    return dirs
+
+
+def hook_fingerprint() -> str:
+    """Changes whenever a startup script, a manifest or the exported enabled
+    extension set changes.
+    """
+    h = hashlib.sha1()
+    for directory in hook_dirs():
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            h.update(f"{entry.path}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+    h.update(os.environ.get(ENABLED_EXTENSIONS_ENV_VAR, "").encode())
+    return h.hexdigest()
+
+
+def config_fingerprint() -> t.List[t.Any]:
+    """Changes whenever a Jupyter config file that can enable or disable
+    extensions changes.
+    """
+    from jupyter_core.paths import jupyter_config_path
+    return [
+        (path, _stat_key(path))
+        for config_dir in jupyter_config_path()
+        for path in _config_stat_paths(config_dir)
+    ]
+
+
+def _cache_file() -> str:
+    """One cache file per environment, so conda envs don't evict each other."""
+    digest = hashlib.sha1(sys.prefix.encode("utf8")).hexdigest()[:16]
+    return os.path.join(_cache_dir(), f"enabled_extensions-{digest}.json")
+
+
+def _cache_env() -> t.Dict[str, t.Optional[str]]:
+    return {k: os.environ.get(k) for k in _CONFIG_ENV_VARS}
+
+
+def _stat_key(path: str) -> t.Optional[t.List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _config_stat_paths(config_dir: str) -> t.List[str]:
+    """Every path whose change can alter what a config dir resolves to.
+
+    Directories are included so that newly created files bump the key.
+    """
+    paths = [config_dir]
+    for section in _CONFIG_SECTIONS:
+        drop_in_dir = os.path.join(config_dir, section + ".d")
+        paths.append(os.path.join(config_dir, section + ".json"))
+        paths.append(drop_in_dir)
+        try:
+            names = sorted(os.listdir(drop_in_dir))
+        except OSError:
+            names = []
+        paths.extend(
+            os.path.join(drop_in_dir, i) for i in names if i.endswith(".json")
+        )
+    return paths
+
+
+def _cache_enabled() -> bool:
+    return not os.environ.get("JUPYTER_KERNEL_HOOK_NO_CACHE")
+
+
+def _read_enabled_cache() -> t.Optional[t.Set[str]]:
+    """Return the cached enabled set, or None if it is missing or stale.
+
+    This uses the standard library only; it is what keeps ``notebook`` and
+    ``jupyter_core`` out of the kernel when nothing has changed.
+    """
+    try:
+        with open(_cache_file(), encoding="utf8") as f:
+            data = json.load(f)
+        if data["version"] != CACHE_VERSION \
+                or data["prefix"] != sys.prefix \
+                or data["env"] != _cache_env():
+            return None
+        for path, key in data["stats"].items():
+            if _stat_key(path) != key:
+                return None
+        return set(data["enabled"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_enabled_cache(
+        enabled: t.Set[str],
+        config_dirs: t.List[str]
+) -> None:
+    """Atomically write the cache file. Failures are never fatal."""
+    stats = {}
+    for config_dir in config_dirs:
+        for path in _config_stat_paths(config_dir):
+            stats[path] = _stat_key(path)
+    data = {
+        "version": CACHE_VERSION,
+        "prefix": sys.prefix,
+        "env": _cache_env(),
+        "config_path": list(config_dirs),
+        "stats": stats,
+        "enabled": sorted(enabled),
+    }
+    destination = _cache_file()
+    try:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        _atomic_write(destination, json.dumps(data))
+    except OSError:
+        pass
+
+
+def _recursive_update(target: dict, new: dict) -> None:
+    """Same as ``notebook.config_manager.recursive_update``."""
+    for k, v in new.items():
+        if isinstance(v, dict):
+            if k not in target:
+                target[k] = {}
+            _recursive_update(target[k], v)
+            if not target[k]:
+                del target[k]
+        elif v is None:
+            target.pop(k, None)
+        else:
+            target[k] = v
+
+
+def _read_config_section(config_dir: str, section: str) -> dict:
+    """Same result as ``BaseJSONConfigManager(config_dir=...).get(section)``.
+
+    Files in ``{section}.d`` are merged first in sorted order, then
+    ``{section}.json`` on top, so user config wins over package defaults.
+    """
+    pattern = os.path.join(config_dir, section + ".d", "*.json")
+    paths = sorted(glob.glob(pattern))
+    paths.append(os.path.join(config_dir, section + ".json"))
+    data = {}
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                _recursive_update(data, json.load(f))
+    return data
+
+
+def _scan_enabled_server_extensions() -> t.Tuple[t.Set[str], t.List[str]]:
     from jupyter_core.paths import jupyter_config_path
 
     s = set()
     config_dirs = jupyter_config_path()
     for config_dir in config_dirs:
-        cm = BaseJSONConfigManager(config_dir=config_dir)
-        data = cm.get("jupyter_notebook_config")
-        server_extensions = (
-            data.setdefault("NotebookApp", {})
-                .setdefault("nbserver_extensions", {})
-        )
-        for k, v in server_extensions.items():
-            if v:
-                s.add(k)
+        for section, (app, key) in _CONFIG_SECTIONS.items():
+            data = _read_config_section(config_dir, section)
+            server_extensions = data.get(app, {}).get(key, {})
+            for k, v in server_extensions.items():
+                if v:
+                    s.add(k)
+    return s, config_dirs
+
+
+def _read_enabled_env() -> t.Optional[t.Set[str]]:
+    """Enabled set exported by the server into the kernel's environment."""
+    try:
+        value = os.environ[ENABLED_EXTENSIONS_ENV_VAR]
+    except KeyError:
+        return None
+    try:
+        return set(json.loads(value))
+    except (ValueError, TypeError):
+        return None
+
+
+def _resolve_enabled_server_extensions() -> t.Tuple[t.Set[str], str]:
+    s = _read_enabled_env()
+    if s is not None:
+        return s, "environment"
+    if not _cache_enabled():
+        return _scan_enabled_server_extensions()[0], "config"
+    s = _read_enabled_cache()
+    if s is not None:
+        return s, "cache"
+    s, config_dirs = _scan_enabled_server_extensions()
+    _write_enabled_cache(s, config_dirs)
+    return s, "config"
+
+
+# How long the enabled set took to resolve, and where it came from.
+_enabled_lookup: t.Dict[str, t.Any] = {}
+
+
+def _get_enabled_server_extensions() -> t.Set[str]:
+    start = time.perf_counter()
+    s, source = _resolve_enabled_server_extensions()
+    _enabled_lookup.update(seconds=time.perf_counter() - start, source=source)
     return s
 
 
@@ -64,7 +470,6 @@ def _load(s: str, callback: callable) -> t.Any:
 
 
 _lazy_loaders = {
-    "jinja_env": _get_jinja_env,
     "startup_dir": _get_startup_dir,
     "enabled_server_extensions": _get_enabled_server_extensions
 }
@@ -81,8 +486,11 @@ def __getattr__(s: str):
 
 
 __all__ = [
-    "TEMPLATES_DIR",
-    "jinja_env",
+    "MANIFEST_FILENAME",
+    "BUNDLE_FILENAME",
+    "LISTENER_FILENAME",
+    "CACHE_VERSION",
+    "ENABLED_EXTENSIONS_ENV_VAR",
     "startup_dir",
     "enabled_server_extensions"
 ]
@@ -0,0 +1,152 @@
+"""Conditions that limit a hook to some kernels.
+
+Hooks registered with ``conditions`` only run in kernels that meet all of
+them. They're checked before anything is imported, and only use the
+standard library, like ``runtime``:
+
+* ``kernel_name``: patterns for the name of the kernel spec, e.g.
+  ``["python3", "analysis-*"]``. The name is read from the kernel's
+  connection file, or from ``JUPYTER_KERNEL_HOOK_KERNEL_NAME``. A kernel
+  whose name is unknown (e.g. a terminal IPython) doesn't match.
+* ``env``: environment variables and patterns for their values, e.g.
+  ``{"DISPLAY": "*"}``. A variable that maps to None must be unset.
+* ``executable``: patterns for ``sys.executable``, e.g. ``"*/envs/ds/*"``.
+
+Patterns use ``fnmatch`` syntax. A pattern that starts with ``!`` excludes
+what it matches, so ``["!papermill-*"]`` matches every kernel whose name
+doesn't start with ``papermill-``.
+"""
+import os
+import sys
+import json
+import fnmatch
+import typing as t
+
+
+KERNEL_NAME_ENV_VAR = "JUPYTER_KERNEL_HOOK_KERNEL_NAME"
+KEYS = ("kernel_name", "env", "executable")
+
+_CONNECTION_FILE_FLAGS = ("-f", "--f", "--IPKernelApp.connection_file")
+
+_unknown = object()
+_kernel_name: t.Any = _unknown
+
+
+def normalize(conditions: t.Optional[dict]) -> t.Optional[dict]:
+    """Validate ``conditions``, with single patterns made into lists.
+    Returns None if there are none.
+    """
+    if not conditions:
+        return None
+    unknown = set(conditions) - set(KEYS)
+    if unknown:
+        raise ValueError(
+            f"Unknown conditions {sorted(unknown)!r}; the conditions are"
+            f" {KEYS!r}."
+        )
+    d = {}
+    for key in ("kernel_name", "executable"):
+        patterns = conditions.get(key)
+        if patterns is None:
+            continue
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        patterns = list(patterns)
+        if not patterns or not all(isinstance(i, str) for i in patterns):
+            raise ValueError(f"{key} must be a pattern or a list of them.")
+        d[key] = patterns
+    env = conditions.get("env")
+    if env is not None:
+        if not isinstance(env, dict) or not all(
+                isinstance(v, str) or v is None for v in env.values()
+        ):
+            raise ValueError(
+                "env must map variable names to patterns or None."
+            )
+        d["env"] = dict(env)
+    return d or None
+
+
+def match(
+        value: t.Optional[str],
+        patterns: t.Iterable[str],
+        case_sensitive: bool = True
+) -> bool:
+    """Whether ``value`` matches one of the ``patterns`` (or there are only
+    ``!`` patterns) and none of the ``!`` patterns.
+    """
+    if value is None:
+        return False
+    fn = fnmatch.fnmatchcase if case_sensitive else fnmatch.fnmatch
+    include = [i for i in patterns if not i.startswith("!")]
+    exclude = [i[1:] for i in patterns if i.startswith("!")]
+    if include and not any(fn(value, i) for i in include):
+        return False
+    return not any(fn(value, i) for i in exclude)
+
+
+def _connection_file(argv: t.List[str]) -> t.Optional[str]:
+    for i, arg in enumerate(argv):
+        flag, eq, value = arg.partition("=")
+        if flag not in _CONNECTION_FILE_FLAGS:
+            continue
+        if eq:
+            return value
+        if i + 1 < len(argv):
+            return argv[i + 1]
+    return None
+
+
+def kernel_name() -> t.Optional[str]:
+    """Name of this kernel's spec, or None if it's unknown. Looked up once."""
+    global _kernel_name
+    if _kernel_name is _unknown:
+        name = os.environ.get(KERNEL_NAME_ENV_VAR)
+        path = _connection_file(sys.argv)
+        if not name and path:
+            try:
+                with open(path, encoding="utf8") as f:
+                    name = json.load(f).get("kernel_name")
+            except (OSError, ValueError, AttributeError):
+                pass
+        _kernel_name = name or None
+    return _kernel_name
+
+
+def matches(conditions: t.Optional[dict]) -> bool:
+    """Whether this process meets all of the (normalized) ``conditions``."""
+    if not conditions:
+        return True
+    if "executable" in conditions and not match(
+            sys.executable, conditions["executable"], case_sensitive=False
+    ):
+        return False
+    for var, pattern in conditions.get("env", {}).items():
+        value = os.environ.get(var)
+        if pattern is None:
+            if value is not None:
+                return False
+        elif not match(value, [pattern]):
+            return False
+    if "kernel_name" in conditions and not match(
+            kernel_name(), conditions["kernel_name"]
+    ):
+        return False
+    return True
+
+
+def per_kernel(conditions: t.Optional[dict]) -> bool:
+    """Whether ``conditions`` depend on the kernel, rather than on the
+    Python environment it runs in.
+    """
+    return bool(conditions) and any(k != "executable" for k in conditions)
+
+
+__all__ = [
+    "KERNEL_NAME_ENV_VAR",
+    "normalize",
+    "match",
+    "kernel_name",
+    "matches",
+    "per_kernel"
+]
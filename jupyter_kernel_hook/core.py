@@ -1,19 +1,43 @@
 import os
 import re
+import sys
 import ast
+import json
 import glob
+import hashlib
+import logging
+import functools
+import importlib
+import importlib.util
+import contextlib
+import threading
 import typing as t
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import field
+from dataclasses import replace
 from dataclasses import dataclass
 
 from notebook.notebookapp import NotebookApp
 
 from . import _globals
+from . import watchdog
+from ._globals import generated_for
+from .conditions import normalize as normalize_conditions
+from .runtime import MODES
+from .runtime import MANIFEST_VERSION
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_obj(s: str) -> ast.expr:
+    """Parse the callable part of a script info string, once per string."""
+    return ast.parse(s, mode="eval").body
 
 
 def _find_arg(s: t.Optional[str], arg_names: t.List[str]) -> bool:
     if s is None:
         return False
-    expr = ast.parse(s, mode="eval").body
+    expr = _parse_obj(s)
     if isinstance(expr, ast.Call):
         for arg in expr.args:
             if isinstance(arg, ast.Name):
@@ -27,6 +51,35 @@ def _find_arg(s: t.Optional[str], arg_names: t.List[str]) -> bool:
     return False
 
 
+class _MagicRecorder(object):
+    """Stand-in for the IPython shell that records which magics get registered.
+
+    Anything besides magic registration raises, so hooks that do more than
+    register magics are never deferred.
+    """
+
+    def __init__(self):
+        self.magics = {"line": set(), "cell": set()}
+
+    def register_magics(self, *magic_objects) -> None:
+        for m in magic_objects:
+            for kind, names in self.magics.items():
+                names.update(m.magics.get(kind, {}))
+
+    def register_magic_function(
+            self,
+            func: callable,
+            magic_kind: str = "line",
+            magic_name: t.Optional[str] = None
+    ) -> None:
+        kinds = ["line", "cell"] if magic_kind == "line_cell" else [magic_kind]
+        for kind in kinds:
+            self.magics[kind].add(magic_name or func.__name__)
+
+    def to_dict(self) -> t.Dict[str, t.List[str]]:
+        return {k: sorted(v) for k, v in self.magics.items() if v}
+
+
 @dataclass
 class ScriptInfo(object):
     path: str
@@ -38,12 +91,14 @@ class ScriptInfo(object):
 
     @property
     def is_called(self) -> bool:
-        expr = ast.parse(self.obj, mode="eval").body
+        if self.obj is None:
+            return False
+        expr = _parse_obj(self.obj)
         return isinstance(expr, ast.Call)
 
     @property
     def obj_name(self) -> str:
-        expr = ast.parse(self.obj, mode="eval").body
+        expr = _parse_obj(self.obj)
         if isinstance(expr, ast.Name):
             return expr.id
         elif isinstance(expr, ast.Call):
@@ -66,11 +121,76 @@ class ScriptInfo(object):
         match_me = self._filename.format(priority="")
         return len(glob.glob(f"{startup_dir}/*{match_me}")) > 0
 
-    def render(self, add_to_globals: bool = False) -> str:
-        if self.obj is None:
+    @property
+    def top_level_name(self) -> str:
+        return self.path.partition(".")[0]
+
+    def discover_magics(self) -> t.Optional[t.Dict[str, t.List[str]]]:
+        """Run the hook's call against a recorder to find the magics it adds.
+
+        Returns None if the hook can't be deferred, i.e. it doesn't pass
+        ``ip``, does anything other than register magics, or fails.
+        """
+        if not (self.is_called and self.uses_ipy):
+            return None
+        recorder = _MagicRecorder()
+        try:
+            module = importlib.import_module(self.path)
+            ns = {self.obj_name: getattr(module, self.obj_name)}
+            ns.update(ip=recorder, ipy=recorder, ipython=recorder)
+            eval(self.obj, ns)
+        except Exception:
+            return None
+        return recorder.to_dict() or None
+
+    @staticmethod
+    def uses_runtime(
+            magics: t.Optional[t.Dict[str, t.List[str]]] = None,
+            mode: str = "sync",
+            pycache_prefix: t.Optional[str] = None,
+            time_budget: t.Optional[float] = None,
+            memory_budget: t.Optional[int] = None
+    ) -> bool:
+        """Whether the rendered script hands the hook to the kernel runtime."""
+        return bool(magics) or mode != "sync" or pycache_prefix is not None \
+            or time_budget is not None or memory_budget is not None
+
+    def render(
+            self,
+            add_to_globals: bool = False,
+            lazy: bool = False,
+            magics: t.Optional[t.Dict[str, t.List[str]]] = None,
+            mode: str = "sync",
+            pycache_prefix: t.Optional[str] = None,
+            time_budget: t.Optional[float] = None,
+            memory_budget: t.Optional[int] = None
+    ) -> str:
+        name = self.top_level_name
+        if self.uses_runtime(
+                magics=magics,
+                mode=mode,
+                pycache_prefix=pycache_prefix,
+                time_budget=time_budget,
+                memory_budget=memory_budget
+        ):
+            return self.render_runtime(
+                add_to_globals=add_to_globals,
+                magics=magics,
+                mode=mode,
+                pycache_prefix=pycache_prefix,
+                time_budget=time_budget,
+                memory_budget=memory_budget
+            )
+        elif lazy:
+            li = ["from jupyter_kernel_hook.runtime import LazyModule"]
+            li.append(f"globals()['{name}'] = LazyModule(")
+            li.append(f"    '{name}', '{self.path}', globals()")
+            li.append(")")
+            return "\n".join(li)
+        elif self.obj is None:
             if add_to_globals:
                 s = f"import {self.path}\n"
-                s += f"globals()['{self.path}'] = {self.path}"
+                s += f"globals()['{name}'] = {name}"
                 return s
             else:
                 return f"import {self.path}  # noqa: F401"
@@ -84,9 +204,67 @@ class ScriptInfo(object):
             li.append(self.obj)
             if add_to_globals:
                 li.append(f"import {self.path}")
-                li.append(f"globals()['{self.path}'] = {self.path}")
+                li.append(f"globals()['{name}'] = {name}")
             return "\n".join(li)
 
+    def render_runtime(self, **options) -> str:
+        """Render code that hands the hook to the kernel runtime, with the
+        manifest record made from ``options`` (see ``to_hook``).
+        """
+        hook = self.to_hook(**options)
+        li = ["from IPython import get_ipython"]
+        li.append("from jupyter_kernel_hook.runtime import Hook, run_hook")
+        li.append("hook = Hook.from_dict({")
+        li.extend(f"    {k!r}: {v!r}," for k, v in hook.items())
+        li.append("})")
+        li.append("run_hook(hook, ip=get_ipython(), user_ns=globals())")
+        return "\n".join(li)
+
+    def to_hook(
+            self,
+            priority: int = 50,
+            add_to_globals: bool = False,
+            lazy: bool = False,
+            magics: t.Optional[t.Dict[str, t.List[str]]] = None,
+            mode: str = "sync",
+            after: t.Sequence[str] = (),
+            before: t.Sequence[str] = (),
+            pycache_prefix: t.Optional[str] = None,
+            origins: t.Optional[dict] = None,
+            time_budget: t.Optional[float] = None,
+            memory_budget: t.Optional[int] = None,
+            conditions: t.Optional[dict] = None
+    ) -> dict:
+        """Manifest record read by ``runtime.Hook`` in the kernel."""
+        d = {
+            "path": self.path,
+            "priority": priority,
+            "add_to_globals": add_to_globals,
+            "lazy": lazy,
+            "magics": magics,
+            "mode": mode,
+            "after": list(after),
+            "before": list(before)
+        }
+        if self.obj is not None:
+            d.update(
+                obj=self.obj,
+                obj_name=self.obj_name,
+                is_called=self.is_called,
+                uses_ipy=self.uses_ipy
+            )
+        if pycache_prefix is not None:
+            d.update(pycache_prefix=pycache_prefix)
+        if origins is not None:
+            d.update(origins=origins)
+        if time_budget is not None:
+            d.update(time_budget=time_budget)
+        if memory_budget is not None:
+            d.update(memory_budget=memory_budget)
+        if conditions is not None:
+            d.update(conditions=conditions)
+        return d
+
     @classmethod
     def from_str(cls, o: str):
         path, obj = [*re.split(r":(?![\\/])", o, 1), None][:2]
@@ -98,6 +276,270 @@ class ScriptInfo(object):
 ScriptInfoType = t.TypeVar("ScriptInfoType", ScriptInfo, str)
 
 
+# Startup scripts are rendered with plain string formatting, to keep template
+# engines off the server's startup path.
+
+# Second line of every generated script. ``reconcile`` only ever touches
+# scripts that have it.
+SCRIPT_MARKER = "# Generated by jupyter_kernel_hook"
+
+_SCRIPT_HEADER = '''# -*- coding: utf-8 -*-
+{marker}
+def __jupyter_kernel_hook() -> None:
+    """{docstring}
+
+    We hide everything behind a function to locally scope these objects.
+    Otherwise they will be imported into the Notebook instance!
+    """
+'''
+
+_SCRIPT_FOOTER = """
+
+
+__jupyter_kernel_hook()
+del __jupyter_kernel_hook
+"""
+
+
+def _indent(s: str, width: int) -> str:
+    """Indent all but the first line."""
+    lines = s.splitlines()
+    prefix = " " * width
+    return "\n".join(
+        [lines[0]] + [prefix + line if line else line for line in lines[1:]]
+    )
+
+
+def render_startup_script(
+        script_info: ScriptInfo,
+        add_to_globals: bool = False,
+        lazy: bool = False,
+        magics: t.Optional[t.Dict[str, t.List[str]]] = None,
+        mode: str = "sync",
+        pycache_prefix: t.Optional[str] = None,
+        time_budget: t.Optional[float] = None,
+        memory_budget: t.Optional[int] = None,
+        conditions: t.Optional[dict] = None
+) -> str:
+    """Render the startup script for one extension."""
+    path = script_info.path
+    budgets = dict(time_budget=time_budget, memory_budget=memory_budget)
+    if script_info.uses_runtime(
+            magics=magics, mode=mode, pycache_prefix=pycache_prefix, **budgets
+    ):
+        body = script_info.render(
+            add_to_globals=add_to_globals,
+            magics=magics,
+            mode=mode,
+            pycache_prefix=pycache_prefix,
+            **budgets
+        )
+        body = _indent(body, 8)
+    elif lazy:
+        code = script_info.render(add_to_globals=add_to_globals, lazy=lazy)
+        body = (
+            "from jupyter_kernel_hook.stats import record_hook\n"
+            f'        with record_hook("{path}", mode="lazy"):\n'
+            f"            {_indent(code, 12)}"
+        )
+    else:
+        # Budgets that admins set in the kernel's environment apply to this
+        # hook too, but only the runtime can enforce them.
+        code = script_info.render(add_to_globals=add_to_globals)
+        env_vars = "".join(
+            f'            "{i}",\n' for i in watchdog.BUDGET_ENV_VARS
+        )
+        body = (
+            "def load():\n"
+            f"            {_indent(code, 12)}\n"
+            "\n"
+            "        import os\n"
+            "        if any(os.environ.get(i) for i in (\n"
+            f"{env_vars}"
+            "        )):\n"
+            "            from jupyter_kernel_hook.runtime import Hook, run_hook\n"
+            f'            run_hook(Hook("{path}"), load=load)\n'
+            "        else:\n"
+            "            from jupyter_kernel_hook.stats import record_hook\n"
+            f'            with record_hook("{path}"):\n'
+            "                load()"
+        )
+    check = f'extension_is_enabled("{path}"):'
+    imports = "    from jupyter_kernel_hook import extension_is_enabled\n"
+    if conditions:
+        # Cheaper than the enabled check, so it goes first.
+        check = f"matches({conditions!r}) and {check}  # noqa: E501"
+        imports += "    from jupyter_kernel_hook.conditions import matches\n"
+    return (
+        _SCRIPT_HEADER.format(
+            marker=f"{SCRIPT_MARKER}: {path}",
+            docstring="We want to check if the extension is enabled before"
+                      " importing."
+        )
+        + imports
+        + f"    if {check}\n"
+        + f"        {body}"
+        + _SCRIPT_FOOTER
+    )
+
+
+def render_bundle_script(manifest_path: str) -> str:
+    """Render the bundle startup script, which runs ``manifest_path``."""
+    return (
+        _SCRIPT_HEADER.format(
+            marker=f"{SCRIPT_MARKER} (bundle)",
+            docstring="Run every bundled hook from a single manifest."
+        )
+        + "    from jupyter_kernel_hook import runtime\n"
+        + f"    runtime.run({manifest_path!r})  # noqa: E501"
+        + _SCRIPT_FOOTER
+    )
+
+
+def render_listener_script() -> str:
+    """Render the startup script that lets kernels receive hooks enabled
+    after they started (see ``hotapply``).
+    """
+    return (
+        _SCRIPT_HEADER.format(
+            marker=f"{SCRIPT_MARKER} (listener)",
+            docstring="Accept the hooks that the server pushes."
+        )
+        + "    from jupyter_kernel_hook.listener import listen\n"
+        + "    listen()"
+        + _SCRIPT_FOOTER
+    )
+
+
+_SCRIPT_FILENAME_RE = re.compile(r"^(\d+)-(.+)\.py$")
+
+
+class StartupDirIndex(object):
+    """One listing of a startup directory, kept up to date with our writes.
+
+    Scripts are indexed by their filename base (the part after the priority),
+    and content hashes are computed on demand, so in the steady state a server
+    start costs one directory listing and no writes.
+    """
+
+    def __init__(self, startup_dir: str):
+        self.startup_dir = startup_dir
+        # Resolving it takes a ``realpath``, which is slow on network drives.
+        self.lock_path = _globals.lock_path(startup_dir)
+        self._lock = threading.RLock()
+        self._scan()
+
+    def _mtime(self) -> int:
+        try:
+            return os.stat(self.startup_dir).st_mtime_ns
+        except OSError:
+            return 0
+
+    def _scan(self) -> None:
+        self.filenames: t.Set[str] = set()
+        self.scripts: t.Dict[str, t.List[str]] = {}
+        self._hashes: t.Dict[str, str] = {}
+        self._scanned_mtime = self._mtime()
+        with os.scandir(self.startup_dir) as it:
+            for entry in it:
+                self._add(entry.name)
+
+    @contextlib.contextmanager
+    def locked(self) -> t.Iterator["StartupDirIndex"]:
+        """Lock the directory against other threads and processes.
+
+        If another process changed the directory since it was listed, the
+        index is rebuilt first, so check-then-write decisions are made on
+        what's actually there.
+        """
+        with self._lock, _globals.file_lock(self.lock_path):
+            if self._mtime() != self._scanned_mtime:
+                self._scan()
+            try:
+                yield self
+            finally:
+                self._scanned_mtime = self._mtime()
+
+    def _add(self, filename: str) -> None:
+        self.filenames.add(filename)
+        m = _SCRIPT_FILENAME_RE.match(filename)
+        if m:
+            self.scripts.setdefault(m.group(2), []).append(filename)
+            self.scripts[m.group(2)].sort()
+
+    def _discard(self, filename: str) -> None:
+        self.filenames.discard(filename)
+        self._hashes.pop(filename, None)
+        m = _SCRIPT_FILENAME_RE.match(filename)
+        if m and filename in self.scripts.get(m.group(2), []):
+            self.scripts[m.group(2)].remove(filename)
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.startup_dir, filename)
+
+    def exists(self, filename: str) -> bool:
+        return filename in self.filenames
+
+    def find(self, filename_base: str) -> t.List[str]:
+        """Filenames of the scripts for a filename base, at any priority."""
+        return list(self.scripts.get(filename_base, []))
+
+    def content_hash(self, filename: str) -> t.Optional[str]:
+        if filename not in self.filenames:
+            return None
+        try:
+            return self._hashes[filename]
+        except KeyError:
+            pass
+        try:
+            with open(self.path(filename), "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+        self._hashes[filename] = digest
+        return digest
+
+    def write(self, filename: str, content: str) -> bool:
+        """Atomically write the file, unless it already has this content.
+
+        Returns whether anything was written.
+        """
+        digest = hashlib.sha256(content.encode("utf8")).hexdigest()
+        if self.content_hash(filename) == digest:
+            return False
+        _globals._atomic_write(self.path(filename), content)
+        self._add(filename)
+        self._hashes[filename] = digest
+        return True
+
+    def rename(self, old: str, new: str) -> None:
+        digest = self._hashes.get(old)
+        os.replace(self.path(old), self.path(new))
+        self._discard(old)
+        self._add(new)
+        if digest is not None:
+            self._hashes[new] = digest
+
+    def remove(self, filename: str) -> None:
+        try:
+            os.remove(self.path(filename))
+        except FileNotFoundError:
+            pass
+        self._discard(filename)
+
+
+_indexes: t.Dict[str, StartupDirIndex] = {}
+
+
+def get_startup_dir_index(startup_dir: str) -> StartupDirIndex:
+    """The process-wide index for a startup directory, built on first use."""
+    try:
+        return _indexes[startup_dir]
+    except KeyError:
+        index = _indexes[startup_dir] = StartupDirIndex(startup_dir)
+        return index
+
+
 def jupyter_config_json(
         package_name: str,
         enabled: bool = True
@@ -125,20 +567,176 @@ def _app_enabled_extensions(nb_app: NotebookApp, path: str) -> bool:
         return True
 
 
-def main(
+def read_manifest(manifest_path: str) -> dict:
+    try:
+        with open(manifest_path, encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": MANIFEST_VERSION, "hooks": {}}
+
+
+def dump_manifest(manifest: dict) -> str:
+    # Without ``indent``, ``json`` uses its C encoder. The whole manifest is
+    # written again for every bundled registration, so this adds up.
+    return json.dumps(manifest, sort_keys=True)
+
+
+def export_enabled_extensions(nb_app: NotebookApp) -> None:
+    """Hand the server's enabled extension set to the kernels it launches.
+
+    Kernels inherit the server's environment, so ``extension_is_enabled`` can
+    read the set from there instead of from the Jupyter config files.
+    """
+    enabled = sorted(k for k, v in nb_app.nbserver_extensions.items() if v)
+    os.environ[_globals.ENABLED_EXTENSIONS_ENV_VAR] = json.dumps(enabled)
+
+
+@dataclass
+class HookSpec(object):
+    """A validated registration: a ``ScriptInfo`` and its options.
+
+    See ``create_startup_script`` for what the options do.
+    """
+    script_info: ScriptInfoType
+    priority: int = 50
+    overwrite: bool = False
+    add_to_globals: bool = False
+    bundle: bool = False
+    lazy: bool = False
+    defer_magics: bool = False
+    mode: str = "sync"
+    after: t.Sequence[str] = ()
+    before: t.Sequence[str] = ()
+    precompile: bool = False
+    time_budget: t.Optional[float] = None
+    memory_budget: t.Optional[t.Union[int, str]] = None
+    profile: bool = False
+    conditions: t.Optional[dict] = None
+
+    def __post_init__(self):
+        # Format into a ScriptInfo object.
+        if isinstance(self.script_info, str):
+            self.script_info = ScriptInfo.from_str(self.script_info)
+
+        self.priority = int(self.priority)
+        assert 0 <= self.priority <= 99, "priority must be between 0 and 99"
+
+        if self.mode not in MODES:
+            raise ValueError(
+                f"mode must be one of {MODES!r}, not {self.mode!r}"
+            )
+
+        if (self.after or self.before) and not self.bundle:
+            raise ValueError(
+                "after and before are only supported with bundle=True;"
+                " separate startup scripts are ordered by priority alone."
+            )
+
+        if self.time_budget is not None:
+            self.time_budget = float(self.time_budget)
+            if self.time_budget <= 0:
+                raise ValueError("time_budget must be a positive number.")
+        if self.memory_budget is not None:
+            self.memory_budget = watchdog.parse_size(self.memory_budget)
+            if self.memory_budget <= 0:
+                raise ValueError("memory_budget must be a positive size.")
+
+        self.conditions = normalize_conditions(self.conditions)
+
+        if self.lazy and self.precompile:
+            raise ValueError(
+                "precompile doesn't apply to lazy hooks; they're imported by"
+                " the first cell that uses them."
+            )
+
+        if self.lazy and self.script_info.is_called:
+            raise ValueError(
+                f"{self.script_info.obj!r} needs the module at startup, so"
+                f" {self.path!r} can't be lazy-loaded."
+            )
+
+    @classmethod
+    def from_spec(cls, spec: t.Union["HookSpec", ScriptInfoType, dict],
+                  **defaults) -> "HookSpec":
+        """Make a spec from a ``ScriptInfo``, a string, or a dict of options
+        (with a ``script_info`` key) that take precedence over ``defaults``.
+        """
+        if isinstance(spec, HookSpec):
+            return spec
+        elif isinstance(spec, dict):
+            return cls(**{**defaults, **spec})
+        else:
+            return cls(spec, **defaults)
+
+    @property
+    def path(self) -> str:
+        return self.script_info.path
+
+    def to_hook(
+            self,
+            magics: t.Optional[dict] = None,
+            pycache_prefix: t.Optional[str] = None,
+            origins: t.Optional[dict] = None
+    ) -> dict:
+        return self.script_info.to_hook(
+            priority=self.priority,
+            add_to_globals=self.add_to_globals,
+            lazy=self.lazy,
+            magics=magics,
+            mode=self.mode,
+            after=self.after,
+            before=self.before,
+            pycache_prefix=pycache_prefix,
+            origins=origins,
+            time_budget=self.time_budget,
+            memory_budget=self.memory_budget,
+            conditions=self.conditions
+        )
+
+    def render(
+            self,
+            magics: t.Optional[dict] = None,
+            pycache_prefix: t.Optional[str] = None
+    ) -> str:
+        return render_startup_script(
+            self.script_info,
+            add_to_globals=self.add_to_globals,
+            lazy=self.lazy,
+            magics=magics,
+            mode=self.mode,
+            pycache_prefix=pycache_prefix,
+            time_budget=self.time_budget,
+            memory_budget=self.memory_budget,
+            conditions=self.conditions
+        )
+
+
+@dataclass
+class RegistrationReport(object):
+    """What ``register`` did.
+
+    ``written`` holds the paths of files that were created or changed,
+    ``skipped`` and ``disabled`` hold extension names.
+    """
+    written: t.List[str] = field(default_factory=list)
+    skipped: t.List[str] = field(default_factory=list)
+    disabled: t.List[str] = field(default_factory=list)
+
+
+def register(
         nb_app: NotebookApp,
-        script_info: ScriptInfoType,
-        priority: int = 50,
-        overwrite: bool = False,
-        add_to_globals: bool = False
-) -> None:
-    """Create startup script."""
-    # Format into a ScriptInfo object.
-    priority = int(priority)
-    assert 0 <= priority <= 99, "priority must be between 0 and 99"
+        specs: t.Iterable[HookSpec],
+        export_enabled: bool = False
+) -> RegistrationReport:
+    """Create or update the startup scripts for many hooks in one pass.
 
-    if isinstance(script_info, str):
-        script_info = ScriptInfo.from_str(script_info)
+    The startup directory is listed once, everything is rendered first, and
+    all files are committed together at the end.
+    """
+    report = RegistrationReport()
+
+    if export_enabled:
+        export_enabled_extensions(nb_app)
 
     # Check if the extension is enabled.
     #
@@ -146,33 +744,694 @@ def main(
     # already enabled. This is just a safeguard against unintended behavior.
     # It's good to be cautious when editing a user's file system.
 
-    if not _app_enabled_extensions(nb_app, script_info.path):
-        return
+    enabled = []
+    for spec in specs:
+        if _app_enabled_extensions(nb_app, spec.path):
+            enabled.append(spec)
+        else:
+            report.disabled.append(spec.path)
+    if not enabled:
+        return report
+
+    # Now we've established that the extensions are enabled.
+    # Let's see which scripts we need to write.
 
-    # Now we've established that the extension is enabled.
-    # Let's see if we need to write the script or not.
+    # Hooks in the host's shared bundle are already loaded by every kernel.
+    shared = _shared_hooks()
+    for spec in list(enabled):
+        if spec.path in shared:
+            nb_app.log.info(
+                f"Extension {spec.path!r} is in the shared bundle at"
+                f" {_globals.get_shared_dir()!r}."
+            )
+            report.skipped.append(spec.path)
+            enabled.remove(spec)
+
+    resolved = _resolve(enabled, nb_app.log)
 
     startup_dir = _globals.__getattr__("startup_dir")
+    index = get_startup_dir_index(startup_dir)
+    with index.locked():
+        _write_hooks(index, enabled, resolved, report, nb_app.log)
+
+    return report
+
+
+def locate_modules(
+        names: t.Iterable[str],
+        modules: t.Optional[dict] = None
+) -> t.Optional[dict]:
+    """Where the top-level modules ``names`` are, for ``runtime.OriginFinder``.
+
+    ``modules`` holds locations that are already known, e.g. from a trial
+    import. Modules that aren't plain files or packages are left out.
+    """
+    modules = dict(modules or {})
+    for name in names:
+        if name in modules:
+            continue
+        try:
+            spec = importlib.util.find_spec(name)
+        except (ImportError, ValueError):
+            continue
+        if spec is None or not spec.has_location or not spec.origin:
+            continue
+        locations = spec.submodule_search_locations
+        if locations is not None:
+            locations = list(locations)
+            entry = os.path.dirname(locations[0])
+        else:
+            entry = os.path.dirname(spec.origin)
+        modules[name] = [spec.origin, locations, entry]
+    if not modules:
+        return None
+    return {"prefix": sys.prefix, "modules": modules}
+
+
+# Discovered magics are kept in the cache directory, so a restarted server
+# doesn't import every deferred package again. An entry is used until the
+# package's version changes, or, for packages without one, its source file.
+
+MAGICS_CACHE_FILENAME = "magics.json"
+
+
+def _magics_key(script_info: ScriptInfo) -> dict:
+    version = _globals.package_version(script_info.path)
+    source = None
+    if version is None:
+        try:
+            spec = importlib.util.find_spec(script_info.top_level_name)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is not None and spec.origin:
+            source = _globals._stat_key(spec.origin)
+    return {"obj": script_info.obj, "version": version, "source": source}
+
+
+def discover_magics(
+        script_info: ScriptInfo
+) -> t.Optional[t.Dict[str, t.List[str]]]:
+    """``ScriptInfo.discover_magics``, cached by the package's version."""
+    cache_path = os.path.join(_globals._cache_dir(), MAGICS_CACHE_FILENAME)
+    key = _magics_key(script_info)
+    try:
+        with open(cache_path, encoding="utf8") as f:
+            entry = json.load(f)[script_info.path]
+        if entry["key"] == key:
+            return entry["magics"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    magics = script_info.discover_magics()
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with _globals.file_lock(f"{cache_path}.lock"):
+            try:
+                with open(cache_path, encoding="utf8") as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+            cache[script_info.path] = {"key": key, "magics": magics}
+            _globals._atomic_write(cache_path, json.dumps(cache, indent=2))
+    except OSError:
+        pass
+    return magics
+
+
+def _resolve(
+        specs: t.List[HookSpec],
+        log: logging.Logger
+) -> t.Dict[str, t.Dict[str, t.Any]]:
+    """Work out everything about the hooks that's done once, on the server:
+    their deferred magics, precompiled bytecode and module locations. Also
+    profile the startup scripts of the hooks that ask for it.
+
+    Returns keyword arguments for ``HookSpec.to_hook``, by extension name.
+    """
+    resolved = {spec.path: {} for spec in specs}
+    for spec in specs:
+        if spec.defer_magics:
+            magics = discover_magics(spec.script_info)
+            resolved[spec.path]["magics"] = magics
+            if magics is None:
+                log.warning(
+                    f"Could not defer the magics of {spec.path!r}; it will"
+                    f" be loaded when the kernel starts."
+                )
+
+    closures = {}
+    precompiled = [spec for spec in specs if spec.precompile]
+    if precompiled:
+        from . import precompile
+        if not precompile.supported():
+            log.warning("Precompiling hooks requires Python 3.8 or later.")
+            precompiled = []
+    for spec in precompiled:
+        try:
+            result = precompile.precompile(spec.path)
+        except Exception as e:
+            log.warning(f"Could not precompile {spec.path!r}: {e}")
+            continue
+        if not result.cached:
+            log.info(
+                f"Precompiled {result.compiled} of the {len(result.sources)}"
+                f" modules that {spec.path!r} imports."
+            )
+        resolved[spec.path]["pycache_prefix"] = result.prefix
+        closures[spec.path] = result.modules
+
+    profiled = [spec for spec in specs if spec.profile]
+    if profiled:
+        from . import importcost
+    for spec in profiled:
+        # What kernels run, minus what would keep the profiler from running
+        # the whole hook.
+        r = resolved[spec.path]
+        script = replace(
+            spec, time_budget=None, memory_budget=None, conditions=None
+        ).render(r.get("magics"), r.get("pycache_prefix"))
+        try:
+            cost = importcost.measure(spec.path, script=script)
+        except Exception as e:
+            log.warning(f"Could not profile {spec.path!r}: {e}")
+            continue
+        if not cost.cached:
+            log.info(f"Profiled the startup script of {cost.summary()}.")
+        for message in importcost.check(cost):
+            log.warning(message)
+
+    # Bundled hooks find their modules without searching ``sys.path``.
+    for spec in specs:
+        if spec.bundle:
+            resolved[spec.path]["origins"] = locate_modules(
+                [spec.script_info.top_level_name],
+                closures.get(spec.path)
+            )
+    return resolved
+
+
+def _write_hooks(
+        index: StartupDirIndex,
+        specs: t.List[HookSpec],
+        resolved: t.Dict[str, t.Dict[str, t.Any]],
+        report: RegistrationReport,
+        log: logging.Logger
+) -> None:
+    """Write the scripts for ``specs`` to the index's directory. The caller
+    holds the index's lock.
+    """
+    renames: t.List[t.Tuple[str, str]] = []
+    removals: t.List[str] = []
+    writes: t.Dict[str, str] = {}
+    owners: t.Dict[str, t.List[str]] = {}
+
+    for spec in specs:
+        if spec.bundle:
+            continue
+
+        # See if the script exists.
+        # If it does, skip it.
+        existing = index.find(spec.script_info.filename_base)
+        if existing and not spec.overwrite:
+            report.skipped.append(spec.path)
+            continue
+
+        filename = spec.script_info.gen_filename(priority=spec.priority)
+
+        # If the priority changed, rename the old script instead of leaving a
+        # duplicate behind that would run too.
+        if existing and filename not in existing:
+            renames.append((existing.pop(0), filename))
+        removals.extend(i for i in existing if i != filename)
+
+        r = resolved.get(spec.path, {})
+        writes[filename] = spec.render(
+            r.get("magics"), r.get("pycache_prefix")
+        )
+        owners[filename] = [spec.path]
+
+    bundled = [spec for spec in specs if spec.bundle]
+    if bundled:
+        manifest_path = index.path(_globals.MANIFEST_FILENAME)
+        manifest = read_manifest(manifest_path)
+        hooks = manifest["hooks"]
+        changed = []
+        for spec in bundled:
+            if index.find(spec.script_info.filename_base):
+                log.warning(
+                    f"Extension {spec.path!r} also has its own startup"
+                    f" script in {index.startup_dir!r}; it will run twice."
+                )
+            hook = spec.to_hook(**resolved.get(spec.path, {}))
+            if spec.path in hooks and \
+                    (not spec.overwrite or hooks[spec.path] == hook):
+                report.skipped.append(spec.path)
+                continue
+            hooks[spec.path] = hook
+            manifest.get("quarantine", {}).pop(spec.path, None)
+            changed.append(spec.path)
+        writes[_globals.MANIFEST_FILENAME] = dump_manifest(manifest)
+        owners[_globals.MANIFEST_FILENAME] = changed
+        writes[_globals.BUNDLE_FILENAME] = render_bundle_script(manifest_path)
+
+    # Commit everything.
+
+    for old, new in renames:
+        index.rename(old, new)
+        log.info(f"Renamed startup script to {index.path(new)!r}.")
+    for filename in removals:
+        index.remove(filename)
+        log.info(f"Removed duplicate startup script: {filename!r}.")
+
+    for filename, content in writes.items():
+        # Files that are already up to date are left alone.
+        destination = index.path(filename)
+        if index.write(filename, content):
+            report.written.append(destination)
+            if filename == _globals.MANIFEST_FILENAME:
+                for path in owners[filename]:
+                    log.info(f"Added {path!r} to {destination!r}.")
+            else:
+                log.info(f"Created new startup script: {destination!r}.")
+        else:
+            report.skipped.extend(owners.get(filename, []))
+
+
+# Shared bundle
+#
+# On hosts where many servers start at once, an admin can install one bundle
+# for everybody, instead of every server writing its own copy of the same
+# scripts. Kernels run it through the IPython kernel config in ``sys.prefix``,
+# and servers skip the hooks that are already in it.
+
+SHARED_CONFIG_FILENAME = "ipython_kernel_config.json"
+
+_shared_manifests: t.Dict[str, t.Dict[str, dict]] = {}
+
+
+def _shared_hooks() -> t.Dict[str, dict]:
+    """The hooks in the shared bundle, read once per process."""
+    shared_dir = _globals.get_shared_dir()
+    if not shared_dir:
+        return {}
+    manifest_path = os.path.join(shared_dir, _globals.MANIFEST_FILENAME)
+    try:
+        return _shared_manifests[manifest_path]
+    except KeyError:
+        pass
+    try:
+        hooks = read_manifest(manifest_path)["hooks"]
+    except ValueError:
+        hooks = {}
+    _shared_manifests[manifest_path] = hooks
+    return hooks
+
+
+def default_ipython_config_dir() -> str:
+    """IPython's config directory for this environment (``ENV_CONFIG_DIRS``).
+    """
+    return os.path.join(sys.prefix, "etc", "ipython")
+
+
+def install_shared_shim(
+        bundle_path: str,
+        ipython_config_dir: t.Optional[str] = None
+) -> t.Optional[str]:
+    """Add the shared bundle script to ``InteractiveShellApp.exec_files`` in
+    ``ipython_kernel_config.json``, keeping whatever else is in there.
+
+    Returns the path of the config file, if it had to be changed.
+    """
+    if ipython_config_dir is None:
+        ipython_config_dir = default_ipython_config_dir()
+    os.makedirs(ipython_config_dir, exist_ok=True)
+    config_path = os.path.join(ipython_config_dir, SHARED_CONFIG_FILENAME)
+    try:
+        with open(config_path, encoding="utf8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    exec_files = config.setdefault("InteractiveShellApp", {}) \
+        .setdefault("exec_files", [])
+    if bundle_path in exec_files:
+        return None
+    exec_files.append(bundle_path)
+    _globals._atomic_write(
+        config_path, json.dumps(config, indent=2, sort_keys=True)
+    )
+    return config_path
+
+
+def install_shared(
+        specs: t.Iterable[t.Union[HookSpec, ScriptInfoType, dict]],
+        shared_dir: t.Optional[str] = None,
+        ipython_config_dir: t.Optional[str] = None,
+        log: t.Optional[logging.Logger] = None,
+        **defaults
+) -> RegistrationReport:
+    """Add hooks to the shared bundle, and make kernels load it.
+
+    This is meant to be run once per host by an admin, e.g. with
+    ``python -m jupyter_kernel_hook install-shared``. The kernels still only
+    run the hooks whose extensions are enabled.
+    """
+    if log is None:
+        log = logging.getLogger("jupyter_kernel_hook")
+    defaults["bundle"] = True
+    specs = [HookSpec.from_spec(spec, **defaults) for spec in specs]
+    for spec in specs:
+        spec.bundle = True
+
+    if shared_dir is None:
+        shared_dir = _globals.get_shared_dir()
+    if not shared_dir:
+        raise ValueError(
+            f"No shared directory; {_globals.SHARED_DIR_ENV_VAR} is empty."
+        )
+    os.makedirs(shared_dir, exist_ok=True)
+
+    resolved = _resolve(specs, log)
 
-    # See if the script exists.
-    # If it does, stop running this.
-    if script_info.exists(startup_dir=startup_dir) and not overwrite:
-        return
+    report = RegistrationReport()
+    index = get_startup_dir_index(shared_dir)
+    with index.locked():
+        _write_hooks(index, specs, resolved, report, log)
+        config_path = install_shared_shim(
+            index.path(_globals.BUNDLE_FILENAME), ipython_config_dir
+        )
+    if config_path is not None:
+        report.written.append(config_path)
+        log.info(f"Kernels now run the shared bundle ({config_path!r}).")
+    _shared_manifests.clear()
+    return report
 
-    jinja_env = _globals.__getattr__("jinja_env")
 
-    script = jinja_env \
-        .get_template("init.py.jinja") \
-        .render(
-            script_info=script_info,
-            add_to_globals=add_to_globals)
+# Reconciliation
+#
+# Scripts for extensions that were disabled or uninstalled would otherwise
+# stay in the startup directory, and cost every kernel an import to do
+# nothing, or fail.
 
-    filename = script_info.gen_filename(priority=priority)
-    destination = os.path.join(startup_dir, filename)
+QUARANTINE_SUFFIX = ".disabled"
 
-    # Write the script to the startup_dir:
-    with open(destination, "w+") as f:
-        f.write(script)
 
-    nb_app.log.info(f"Created new startup script: {destination!r}.")
-    return
+@dataclass
+class ReconcileReport(object):
+    """What ``reconcile`` did, or would do with ``dry_run=True``. Each list
+    holds extension names.
+    """
+    removed: t.List[str] = field(default_factory=list)
+    quarantined: t.List[str] = field(default_factory=list)
+    kept: t.List[str] = field(default_factory=list)
+
+
+def _stale_reason(path: str, enabled: t.Container[str]) -> t.Optional[str]:
+    if path not in enabled:
+        return "is not enabled"
+    try:
+        spec = importlib.util.find_spec(path.split(".")[0])
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None:
+        return "can't be imported"
+    return None
+
+
+def reconcile(
+        enabled: t.Container[str],
+        startup_dir: t.Optional[str] = None,
+        quarantine: bool = False,
+        dry_run: bool = False,
+        log: t.Optional[logging.Logger] = None
+) -> ReconcileReport:
+    """Remove generated startup scripts and bundled hooks whose extensions
+    aren't in ``enabled`` or can't be imported.
+
+    With ``quarantine=True``, scripts are renamed to ``*.py.disabled`` (which
+    IPython ignores) and bundled hooks are moved to the manifest's
+    ``"quarantine"`` section, instead of being deleted. Scripts that weren't
+    generated by ``jupyter_kernel_hook`` are never touched.
+    """
+    if log is None:
+        log = logging.getLogger("jupyter_kernel_hook")
+    if startup_dir is None:
+        startup_dir = _globals.__getattr__("startup_dir")
+    report = ReconcileReport()
+    stale = report.quarantined if quarantine else report.removed
+    index = get_startup_dir_index(startup_dir)
+
+    with index.locked():
+        for filenames in list(index.scripts.values()):
+            # Removing and renaming update ``filenames``.
+            for filename in list(filenames):
+                if filename == _globals.BUNDLE_FILENAME:
+                    continue
+                path = generated_for(index.path(filename))
+                if path is None:
+                    continue
+                reason = _stale_reason(path, enabled)
+                if reason is None:
+                    report.kept.append(path)
+                    continue
+                stale.append(path)
+                log.info(f"Startup script {filename!r} is stale: {path!r}"
+                         f" {reason}.")
+                if dry_run:
+                    continue
+                elif quarantine:
+                    index.rename(filename, filename + QUARANTINE_SUFFIX)
+                else:
+                    index.remove(filename)
+
+        if not index.exists(_globals.MANIFEST_FILENAME):
+            return report
+        manifest = read_manifest(index.path(_globals.MANIFEST_FILENAME))
+        hooks = manifest["hooks"]
+        for path in sorted(hooks):
+            reason = _stale_reason(path, enabled)
+            if reason is None:
+                report.kept.append(path)
+                continue
+            stale.append(path)
+            log.info(f"Bundled hook {path!r} is stale: it {reason}.")
+            hook = hooks.pop(path)
+            if quarantine:
+                manifest.setdefault("quarantine", {})[path] = hook
+
+        if dry_run:
+            pass
+        elif hooks or manifest.get("quarantine"):
+            index.write(_globals.MANIFEST_FILENAME, dump_manifest(manifest))
+        else:
+            index.remove(_globals.MANIFEST_FILENAME)
+        if not hooks and not dry_run:
+            index.remove(_globals.BUNDLE_FILENAME)
+
+    return report
+
+
+def reconcile_app(nb_app: NotebookApp, **kwargs) -> ReconcileReport:
+    """``reconcile`` the startup directory with the server's extensions.
+
+    Extensions enabled in the config of ``jupyter_server``
+    (``jpserver_extensions``) count too; the server's own
+    ``nbserver_extensions`` take precedence.
+    """
+    enabled, _ = _globals._scan_enabled_server_extensions()
+    for k, v in nb_app.nbserver_extensions.items():
+        if v:
+            enabled.add(k)
+        else:
+            enabled.discard(k)
+    return reconcile(enabled, log=nb_app.log, **kwargs)
+
+
+RECONCILE_ENV_VAR = "JUPYTER_KERNEL_HOOK_RECONCILE"
+RECONCILE_ACTIONS = {
+    "log": dict(dry_run=True),
+    "quarantine": dict(quarantine=True),
+    "remove": dict()
+}
+
+
+def reconcile_on_start(nb_app: NotebookApp) -> t.Optional[ReconcileReport]:
+    """What the server extension does with stale scripts when it starts.
+
+    The startup directory is usually shared by every environment, and a
+    script that can't be imported here may belong to another one, so by
+    default stale scripts are only logged. Set ``JUPYTER_KERNEL_HOOK_RECONCILE``
+    to ``quarantine`` or ``remove`` to clean them up, or ``off`` to skip
+    this.
+    """
+    action = os.environ.get(RECONCILE_ENV_VAR, "log").strip().lower()
+    if action == "off":
+        return None
+    if action not in RECONCILE_ACTIONS:
+        nb_app.log.warning(
+            f"Ignoring {RECONCILE_ENV_VAR}={action!r}; expected one of"
+            f" {sorted(RECONCILE_ACTIONS) + ['off']!r}."
+        )
+        action = "log"
+    report = reconcile_app(nb_app, **RECONCILE_ACTIONS[action])
+    if action == "log" and (report.removed or report.quarantined):
+        nb_app.log.info(
+            "Stale startup scripts were left alone. Run `python -m"
+            " jupyter_kernel_hook reconcile`, or set"
+            f" {RECONCILE_ENV_VAR}=quarantine, to clean them up."
+        )
+    return report
+
+
+# Background registration
+#
+# Registrations submitted with ``wait=False`` run one at a time on a single
+# worker thread, so the server can start serving while they write to a slow
+# file system. Kernels launched in the meantime get the new hooks pushed to
+# them once they're written (see ``hotapply``).
+
+_executor: t.Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="jupyter_kernel_hook"
+            )
+        return _executor
+
+
+def _kernel_ids(nb_app: NotebookApp) -> t.Set[str]:
+    km = getattr(nb_app, "kernel_manager", None)
+    try:
+        return set(km.list_kernel_ids())
+    except Exception:
+        return set()
+
+
+def submit(
+        nb_app: NotebookApp,
+        specs: t.List[HookSpec],
+        export_enabled: bool = False
+) -> "Future[RegistrationReport]":
+    """Run ``register`` on the registration thread and return its future.
+
+    Errors are logged, and re-raised by ``future.result()``. Kernels started
+    before the future is done may have missed the new hooks, so they're sent
+    to them afterwards if they listen, and logged otherwise.
+    """
+    # Exporting is cheap, and it's most useful for kernels that start early.
+    if export_enabled:
+        export_enabled_extensions(nb_app)
+
+    kernels_before = _kernel_ids(nb_app)
+
+    def run() -> RegistrationReport:
+        try:
+            return register(nb_app, specs)
+        except BaseException:
+            nb_app.log.exception("Could not create startup scripts.")
+            raise
+        finally:
+            started = sorted(_kernel_ids(nb_app) - kernels_before)
+            if started:
+                _push_hooks(nb_app, started)
+
+    return _get_executor().submit(run)
+
+
+def _push_hooks(nb_app: NotebookApp, kernel_ids: t.List[str]) -> None:
+    """Send the hooks to kernels that started while they were being written,
+    from the server's IO loop if it's running.
+    """
+    from .hotapply import Watcher
+
+    # Scanning the file system stays on the registration thread.
+    watcher = Watcher(nb_app)
+    data = watcher.payload()
+
+    def push() -> None:
+        pushed = watcher.push(data, kernel_ids)
+        missed = [i for i in kernel_ids if i not in pushed]
+        if pushed:
+            nb_app.log.warning(
+                f"Kernels {pushed!r} started while startup scripts were"
+                f" still being written. The new hooks were sent to them."
+            )
+        if missed:
+            nb_app.log.warning(
+                f"Kernels {missed!r} started while startup scripts were"
+                f" still being written and can't receive new hooks. Restart"
+                f" them to run the new hooks."
+            )
+
+    io_loop = getattr(nb_app, "io_loop", None)
+    if io_loop is not None:
+        io_loop.add_callback(push)
+    else:
+        push()
+
+
+def main(
+        nb_app: NotebookApp,
+        script_info: ScriptInfoType,
+        priority: int = 50,
+        overwrite: bool = False,
+        add_to_globals: bool = False,
+        export_enabled: bool = False,
+        bundle: bool = False,
+        lazy: bool = False,
+        defer_magics: bool = False,
+        mode: str = "sync",
+        after: t.Sequence[str] = (),
+        before: t.Sequence[str] = (),
+        wait: bool = True,
+        precompile: bool = False,
+        time_budget: t.Optional[float] = None,
+        memory_budget: t.Optional[t.Union[int, str]] = None,
+        profile: bool = False,
+        conditions: t.Optional[dict] = None
+) -> t.Optional["Future[RegistrationReport]"]:
+    """Create startup script. With ``wait=False``, return a future instead
+    of blocking (see ``submit``).
+    """
+    spec = HookSpec(
+        script_info,
+        priority=priority,
+        overwrite=overwrite,
+        add_to_globals=add_to_globals,
+        bundle=bundle,
+        lazy=lazy,
+        defer_magics=defer_magics,
+        mode=mode,
+        after=after,
+        before=before,
+        precompile=precompile,
+        time_budget=time_budget,
+        memory_budget=memory_budget,
+        profile=profile,
+        conditions=conditions
+    )
+    if not wait:
+        return submit(nb_app, [spec], export_enabled=export_enabled)
+    register(nb_app, [spec], export_enabled=export_enabled)
+    return None
+
+
+def main_many(
+        nb_app: NotebookApp,
+        specs: t.Iterable[t.Union[HookSpec, ScriptInfoType, dict]],
+        export_enabled: bool = False,
+        wait: bool = True,
+        **defaults
+) -> t.Union[RegistrationReport, "Future[RegistrationReport]"]:
+    """Create startup scripts for many hooks. Validates every spec before
+    anything is written, even with ``wait=False``.
+    """
+    specs = [HookSpec.from_spec(spec, **defaults) for spec in specs]
+    if not wait:
+        return submit(nb_app, specs, export_enabled=export_enabled)
+    return register(nb_app, specs, export_enabled=export_enabled)
@@ -0,0 +1,282 @@
+"""Data that hooks load into every kernel, built once and memory-mapped.
+
+Hooks often load the same reference tables or lookup indexes into every
+kernel, which multiplies their memory by the number of kernels. Instead, a
+hook can build the data through ``get``::
+
+    from jupyter_kernel_hook import data_cache
+
+    def load_ipython_extension(ip):
+        table = data_cache.get("my_package", "lookup-table", build_table)
+
+The first kernel to ask for an entry builds it and writes it to a file; every
+kernel, including that one, maps the file read-only, so they all share the
+same pages of memory, and nothing is copied. Entries are keyed by the version
+of the package, so a new version builds them again, and the old version's
+entries, which are no longer used, are the first to be evicted. ``build`` returns bytes,
+any other object with the buffer protocol (e.g. an ``array.array``), or a
+NumPy array. ``get`` returns a read-only ``memoryview`` with the buffer's
+format and shape, or a read-only NumPy array for NumPy arrays.
+
+Entries live in ``JUPYTER_KERNEL_HOOK_DATA_CACHE_DIR`` (``data`` in the cache
+directory by default; point it at a directory every user can read to share
+entries between users). The least recently used entries are evicted once the
+cache is bigger than ``JUPYTER_KERNEL_HOOK_DATA_CACHE_SIZE`` (``2G`` by
+default). Kernels that mapped an evicted entry keep their mapping. The lock
+files next to the entries are never removed, since kernels may be waiting on
+them.
+
+Like ``runtime``, this is imported inside kernels, so it must only use the
+standard library.
+"""
+import os
+import sys
+import json
+import mmap
+import hashlib
+import threading
+import typing as t
+
+from . import _globals
+from .watchdog import parse_size
+
+
+DEFAULT_MAX_SIZE = 2 * 2 ** 30
+DATA_SUFFIX = ".bin"
+META_SUFFIX = ".json"
+
+# Entries this kernel already mapped, by data file.
+_mapped: t.Dict[str, t.Any] = {}
+_mapped_lock = threading.Lock()
+
+
+def cache_dir() -> str:
+    try:
+        return os.environ["JUPYTER_KERNEL_HOOK_DATA_CACHE_DIR"]
+    except KeyError:
+        return os.path.join(_globals._cache_dir(), "data")
+
+
+def max_size() -> int:
+    try:
+        return parse_size(os.environ["JUPYTER_KERNEL_HOOK_DATA_CACHE_SIZE"])
+    except (KeyError, ValueError):
+        return DEFAULT_MAX_SIZE
+
+
+def _version_dir(package: str, version: t.Optional[str]) -> str:
+    return os.path.join(cache_dir(), package, version or "unversioned")
+
+
+def entry_path(
+        package: str,
+        key: str,
+        version: t.Optional[str] = None
+) -> str:
+    """Data file of an entry. Its metadata is next to it, in a ``.json``."""
+    digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+    return os.path.join(_version_dir(package, version), digest + DATA_SUFFIX)
+
+
+def _meta_path(path: str) -> str:
+    return path[:-len(DATA_SUFFIX)] + META_SUFFIX
+
+
+def _read_meta(path: str) -> t.Optional[dict]:
+    """The entry's metadata, or None if it's missing or incomplete.
+
+    The metadata is written after the data, so an entry with metadata is
+    complete.
+    """
+    try:
+        with open(_meta_path(path), encoding="utf8") as f:
+            meta = json.load(f)
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return None
+    return meta if size == meta.get("size") else None
+
+
+def _describe(data: t.Any) -> t.Tuple[memoryview, dict]:
+    """Bytes to write, and what's needed to rebuild the object from them."""
+    if hasattr(data, "__array_interface__") and "numpy" in sys.modules:
+        import numpy as np
+        array = np.ascontiguousarray(data)
+        if array.dtype.hasobject:
+            raise ValueError("Arrays of Python objects can't be cached.")
+        meta = {
+            "kind": "ndarray",
+            "dtype": np.lib.format.dtype_to_descr(array.dtype),
+            "shape": list(array.shape)
+        }
+        return memoryview(array.reshape(-1).view(np.uint8)), meta
+    view = memoryview(data)
+    if not view.c_contiguous:
+        raise ValueError("Only contiguous buffers can be cached.")
+    meta = {"kind": "buffer", "format": view.format, "shape": list(view.shape)}
+    return view.cast("B"), meta
+
+
+def _rebuild(buffer: t.Any, meta: dict) -> t.Any:
+    view = memoryview(buffer)
+    if meta["kind"] == "ndarray":
+        import numpy as np
+        dtype = np.lib.format.descr_to_dtype(meta["dtype"])
+        return np.frombuffer(view, dtype=dtype).reshape(meta["shape"])
+    if not view.nbytes or \
+            (meta["format"] == "B" and len(meta["shape"]) <= 1):
+        return view
+    return view.cast(meta["format"], meta["shape"])
+
+
+def _map(path: str, meta: dict) -> t.Any:
+    with _mapped_lock:
+        try:
+            return _mapped[path]
+        except KeyError:
+            pass
+        if meta["size"] == 0:
+            # Empty files can't be mapped.
+            obj = _rebuild(b"", meta)
+        else:
+            with open(path, "rb") as f:
+                obj = _rebuild(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), meta
+                )
+        _mapped[path] = obj
+    try:
+        # Recently used entries are evicted last.
+        os.utime(_meta_path(path))
+    except OSError:
+        pass
+    return obj
+
+
+def _write(path: str, data: t.Any) -> dict:
+    view, meta = _describe(data)
+    meta["size"] = view.nbytes
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(view)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _globals._atomic_write(_meta_path(path), json.dumps(meta))
+    return meta
+
+
+def get(
+        package: str,
+        key: str,
+        build: t.Callable[[], t.Any],
+        version: t.Optional[str] = None
+) -> t.Any:
+    """Map the cached entry ``key`` of ``package``, building it first if no
+    kernel has yet.
+
+    ``version`` defaults to the installed version of ``package``. When many
+    kernels start at once, only one of them builds the entry; the others
+    wait for it. Bytes and other buffers come back as a ``memoryview``.
+    """
+    if version is None:
+        version = _globals.package_version(package)
+    path = entry_path(package, key, version=version)
+    meta = _read_meta(path)
+    if meta is not None:
+        try:
+            return _map(path, meta)
+        except FileNotFoundError:
+            # Evicted since the metadata was read, so build it again.
+            pass
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Next to the entry, so kernels of other users that share the cache wait
+    # for it too.
+    with _globals.file_lock(f"{path}.lock"):
+        meta = _read_meta(path)
+        if meta is None:
+            meta = _write(path, build())
+            evict(keep=[path])
+    return _map(path, meta)
+
+
+def _data_files(directory: str) -> t.Iterator[str]:
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(DATA_SUFFIX):
+                yield os.path.join(root, name)
+
+
+def _entries() -> t.List[t.Tuple[float, int, str]]:
+    """``(last used, size, data file)`` of every entry."""
+    entries = []
+    for path in _data_files(cache_dir()):
+        try:
+            used = os.stat(_meta_path(path)).st_mtime
+            size = os.stat(path).st_size
+        except OSError:
+            continue
+        entries.append((used, size, path))
+    return entries
+
+
+def remove(path: str) -> None:
+    """Remove an entry. Kernels that mapped it keep their mapping (except on
+    Windows, where mapped entries can't be removed).
+    """
+    for p in (_meta_path(path), path):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def evict(
+        limit: t.Optional[int] = None,
+        keep: t.Iterable[str] = ()
+) -> t.List[str]:
+    """Remove the least recently used entries, except ``keep``, until the
+    cache is no bigger than ``limit`` (``max_size()`` by default). Returns
+    the removed files.
+    """
+    if limit is None:
+        limit = max_size()
+    entries = sorted(_entries())
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        if path in keep:
+            continue
+        remove(path)
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def clear(package: t.Optional[str] = None) -> None:
+    """Remove every entry, or every entry of ``package``."""
+    directory = cache_dir()
+    if package is not None:
+        directory = os.path.join(directory, package)
+    for path in list(_data_files(directory)):
+        remove(path)
+
+
+__all__ = [
+    "DEFAULT_MAX_SIZE",
+    "cache_dir",
+    "max_size",
+    "entry_path",
+    "get",
+    "remove",
+    "evict",
+    "clear"
+]
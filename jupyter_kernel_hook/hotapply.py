@@ -0,0 +1,325 @@
+"""Apply newly enabled hooks to kernels that are already running.
+
+The server polls the startup directories and the Jupyter config files for
+changes on a worker thread (see ``Watcher``). When something changed, it
+opens a comm to the running kernels with the current enabled set and where
+the hooks are. Each
+kernel runs the hooks that are enabled now and that it hasn't run yet, the
+same way it would have at startup, and leaves everything else alone.
+Sending the same message twice does nothing the second time.
+
+While it watches, the server keeps a single listener startup script in the
+startup directory, so every kernel it launches listens (see ``listener``),
+and only kernels that do are sent anything. Hooks are only ever added:
+disabling an extension doesn't unload it from running kernels.
+
+The kernel side only uses the standard library, like ``runtime``.
+"""
+import os
+import sys
+import json
+import atexit
+import shutil
+import tempfile
+import traceback
+import typing as t
+
+from . import _globals
+from .listener import COMM_TARGET
+from .listener import LISTENERS_DIR_ENV_VAR
+from .listener import listen
+from .listener import marker_path
+
+if t.TYPE_CHECKING:
+    from jupyter_client import KernelManager
+    from notebook.notebookapp import NotebookApp
+
+
+DEFAULT_WATCH_INTERVAL = 2.0
+
+
+# Kernel side
+
+def applied_hooks() -> t.Set[str]:
+    """Hooks that already ran in this kernel."""
+    from . import runtime
+    from . import stats
+    return runtime._ran | {r.path for r in stats.records}
+
+
+def apply(data: dict, ip=None) -> t.List[str]:
+    """Run the enabled hooks in ``data`` that haven't run yet. Returns the
+    names of the hooks that ran.
+
+    ``data`` has the server's ``enabled`` set, and the paths of generated
+    startup ``scripts`` and of ``manifests``.
+    """
+    from . import runtime
+    from . import stats
+
+    enabled = set(data["enabled"])
+    # Later lookups, e.g. by lazy or deferred hooks, see the new set too.
+    _globals.enabled_server_extensions = enabled
+    os.environ[_globals.ENABLED_EXTENSIONS_ENV_VAR] = json.dumps(
+        sorted(enabled)
+    )
+
+    before = applied_hooks()
+    ran = []
+    for path in data.get("scripts", []):
+        name = _globals.generated_for(path)
+        if name is None or name not in enabled or name in before:
+            continue
+        n_records = len(stats.records)
+        if ip is not None:
+            ip.safe_execfile(path, ip.user_ns)
+        else:
+            with open(path, encoding="utf8") as f:
+                exec(compile(f.read(), path, "exec"), {"__name__": "__main__"})
+        # A script whose conditions don't match this kernel runs nothing.
+        if any(r.path == name for r in stats.records[n_records:]):
+            ran.append(name)
+
+    runtime._ran.update(before, ran)
+    for manifest_path in data.get("manifests", []):
+        ran_before = set(runtime._ran)
+        runtime.run(manifest_path, ip=ip)
+        ran.extend(sorted(runtime._ran - ran_before))
+    return ran
+
+
+def on_comm_open(comm, msg: dict) -> None:
+    """Apply the hooks in a comm the server opened, then close it."""
+    try:
+        ip = None
+        IPython = sys.modules.get("IPython")
+        if IPython is not None:
+            ip = IPython.get_ipython()
+        apply(msg["content"]["data"], ip=ip)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        comm.close()
+
+
+# Server side
+
+def _generated_scripts(directory: str) -> t.List[str]:
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    paths = [os.path.join(directory, i) for i in names if i.endswith(".py")]
+    return [i for i in paths if _globals.generated_for(i) is not None]
+
+
+def install_listener(startup_dir: t.Optional[str] = None) -> bool:
+    """Write the startup script that makes kernels listen. Returns whether
+    anything was written.
+    """
+    from .core import get_startup_dir_index
+    from .core import render_listener_script
+    if startup_dir is None:
+        startup_dir = _globals.__getattr__("startup_dir")
+    index = get_startup_dir_index(startup_dir)
+    with index.locked():
+        return index.write(
+            _globals.LISTENER_FILENAME, render_listener_script()
+        )
+
+
+class Watcher(object):
+    """Polls for new hooks and enabled extensions, and pushes them to the
+    server's running kernels that listen for them.
+
+    Kernels leave a marker in ``listeners_dir`` when they start listening
+    (``JUPYTER_KERNEL_HOOK_LISTENERS_DIR`` by default).
+    """
+
+    def __init__(
+            self,
+            nb_app: "NotebookApp",
+            listeners_dir: t.Optional[str] = None
+    ):
+        self.nb_app = nb_app
+        if listeners_dir is None:
+            listeners_dir = os.environ.get(LISTENERS_DIR_ENV_VAR)
+        self.listeners_dir = listeners_dir
+        self.fingerprint = self._fingerprint()
+        self._checking = None
+
+    def _fingerprint(self) -> t.Tuple[str, t.List[t.Any]]:
+        return _globals.hook_fingerprint(), _globals.config_fingerprint()
+
+    def enabled(self) -> t.Set[str]:
+        """The server's enabled set, plus whatever the config enables now."""
+        enabled, _ = _globals._scan_enabled_server_extensions()
+        enabled.update(
+            k for k, v in self.nb_app.nbserver_extensions.items() if v
+        )
+        return enabled
+
+    def payload(self) -> dict:
+        scripts = []
+        manifests = []
+        for directory in _globals.hook_dirs():
+            scripts.extend(_generated_scripts(directory))
+            manifest_path = os.path.join(directory, _globals.MANIFEST_FILENAME)
+            if os.path.isfile(manifest_path):
+                manifests.append(manifest_path)
+        return {
+            "enabled": sorted(self.enabled()),
+            "scripts": scripts,
+            "manifests": manifests
+        }
+
+    def listening(self, kernel_manager: "KernelManager") -> bool:
+        """Whether the kernel registered the comm target."""
+        connection_file = getattr(kernel_manager, "connection_file", None)
+        if not self.listeners_dir or not connection_file:
+            return False
+        return os.path.exists(marker_path(self.listeners_dir, connection_file))
+
+    def push(
+            self,
+            data: dict,
+            kernel_ids: t.Optional[t.Iterable[str]] = None
+    ) -> t.List[str]:
+        """Send ``data`` to the kernels in ``kernel_ids``, or to every running
+        kernel, if they listen. Returns the ids of the kernels it was sent to.
+        """
+        km = self.nb_app.kernel_manager
+        if kernel_ids is None:
+            kernel_ids = km.list_kernel_ids()
+        pushed = []
+        for kernel_id in list(kernel_ids):
+            try:
+                kernel = km.get_kernel(kernel_id)
+                if not self.listening(kernel):
+                    continue
+                send(kernel, data)
+            except Exception as e:
+                self.nb_app.log.warning(
+                    f"Could not send new hooks to kernel {kernel_id}: {e}"
+                )
+                continue
+            pushed.append(kernel_id)
+        return pushed
+
+    def check(self) -> t.Optional[dict]:
+        """The payload to push if anything changed since the last check, or
+        None. This scans the file system, so ``tick`` runs it off the IO loop.
+        """
+        fingerprint = self._fingerprint()
+        if fingerprint == self.fingerprint:
+            return None
+        self.fingerprint = fingerprint
+        data = self.payload()
+        if _globals.ENABLED_EXTENSIONS_ENV_VAR in os.environ:
+            # Kernels launched from now on inherit the new set.
+            os.environ[_globals.ENABLED_EXTENSIONS_ENV_VAR] = \
+                json.dumps(data["enabled"])
+            self.fingerprint = self._fingerprint()
+        return data
+
+    def _push_changes(self, data: t.Optional[dict]) -> t.Optional[t.List[str]]:
+        if data is None:
+            return None
+        pushed = self.push(data)
+        if pushed:
+            self.nb_app.log.info(
+                f"Sent new hooks to {len(pushed)} running kernel(s)."
+            )
+        return pushed
+
+    def poll(self) -> t.Optional[t.List[str]]:
+        """Push the hooks if anything changed since the last poll. Returns
+        the ids of the kernels they were pushed to.
+        """
+        return self._push_changes(self.check())
+
+    def tick(self) -> None:
+        """``poll`` from the IO loop: check on a worker thread, so a slow
+        file system doesn't stall the server, and push from the loop.
+        """
+        if self._checking is not None:
+            return
+        from tornado.ioloop import IOLoop
+        loop = IOLoop.current()
+        self._checking = loop.run_in_executor(None, self.check)
+
+        def done(future) -> None:
+            self._checking = None
+            try:
+                self._push_changes(future.result())
+            except Exception as e:
+                self.nb_app.log.warning(f"Could not check for new hooks: {e}")
+
+        loop.add_future(self._checking, done)
+
+
+def send(kernel_manager: "KernelManager", data: dict) -> None:
+    """Open a comm to the kernel's ``COMM_TARGET`` with ``data``."""
+    import uuid
+    stream = kernel_manager.connect_shell()
+    socket = getattr(stream, "socket", stream)
+    try:
+        kernel_manager.session.send(socket, "comm_open", {
+            "comm_id": uuid.uuid4().hex,
+            "target_name": COMM_TARGET,
+            "data": data
+        })
+    finally:
+        # The socket lingers until the message is sent.
+        stream.close()
+
+
+def watch_interval() -> float:
+    try:
+        return float(os.environ["JUPYTER_KERNEL_HOOK_WATCH_INTERVAL"])
+    except (KeyError, ValueError):
+        return DEFAULT_WATCH_INTERVAL
+
+
+def watch(
+        nb_app: "NotebookApp",
+        interval: t.Optional[float] = None
+) -> t.Optional[Watcher]:
+    """Start polling on the server's IO loop, every ``interval`` seconds
+    (``JUPYTER_KERNEL_HOOK_WATCH_INTERVAL``, 2 by default; 0 turns it off).
+
+    Also installs the listener script, and tells the kernels the server
+    launches where to leave their markers.
+    """
+    if interval is None:
+        interval = watch_interval()
+    if interval <= 0:
+        return None
+    from tornado.ioloop import PeriodicCallback
+    listeners_dir = tempfile.mkdtemp(prefix="jupyter_kernel_hook-listeners-")
+    atexit.register(shutil.rmtree, listeners_dir, True)
+    os.environ[LISTENERS_DIR_ENV_VAR] = listeners_dir
+    try:
+        install_listener()
+    except OSError as e:
+        nb_app.log.warning(
+            f"Could not install the listener script, so running kernels"
+            f" won't receive new hooks: {e}"
+        )
+    watcher = Watcher(nb_app, listeners_dir=listeners_dir)
+    watcher.callback = PeriodicCallback(watcher.tick, interval * 1000)
+    watcher.callback.start()
+    return watcher
+
+
+__all__ = [
+    "COMM_TARGET",
+    "listen",
+    "applied_hooks",
+    "apply",
+    "on_comm_open",
+    "install_listener",
+    "Watcher",
+    "send",
+    "watch"
+]
@@ -0,0 +1,350 @@
+"""Measure what a hook adds to the startup of every kernel.
+
+At registration, with ``profile=True``, the server runs the hook's startup
+script in a fresh subprocess under ``-X importtime`` and ``tracemalloc``,
+against an ``InteractiveShell`` like a kernel's. It records how long the
+script took, including the call (e.g. ``load_ipython_extension(ip)``), how
+much memory it added, and which of the modules it pulled in cost the most.
+It warns in the server log when a hook costs more than
+``JUPYTER_KERNEL_HOOK_IMPORT_TIME_WARNING`` seconds (1 by default) or
+``JUPYTER_KERNEL_HOOK_IMPORT_MEMORY_WARNING`` (``100M`` by default).
+
+Results are kept in the cache directory, one per version of each package, so
+the server only profiles a hook again once its version or its script
+changes, and new versions can be compared with old ones (see ``history``,
+and ``python -m jupyter_kernel_hook profile``). Packages without a version
+are profiled again when one of the source files they loaded changes.
+
+Times are measured with ``tracemalloc`` on, which slows imports down, so they
+are an upper bound on what kernels pay.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+import typing as t
+from dataclasses import field
+from dataclasses import dataclass
+
+from . import _globals
+from .watchdog import parse_size
+
+
+HISTORY_FILENAME = "import_costs.json"
+HISTORY_LENGTH = 10
+DEFAULT_TIME_WARNING = 1.0
+DEFAULT_MEMORY_WARNING = 100 * 2 ** 20
+TOP_MODULES = 10
+
+_MARKER = "jupyter_kernel_hook: import starts"
+
+# Run in a subprocess:
+# ``python -X importtime -c _PROFILE_SCRIPT <module> <startup script>``.
+# The shell and everything the startup script needs are set up before the
+# marker, so only the hook's imports are reported after it.
+_PROFILE_SCRIPT = f"""
+import sys
+import json
+import time
+import tracemalloc
+
+from IPython.core.interactiveshell import InteractiveShell
+import jupyter_kernel_hook
+from jupyter_kernel_hook import conditions, hotapply, runtime, stats  # noqa
+
+path, script = sys.argv[1:3]
+ip = InteractiveShell.instance()
+code = compile(script, "<startup script>", "exec")
+before = set(sys.modules)
+
+sys.stderr.write({_MARKER!r} + "\\n")
+sys.stderr.flush()
+tracemalloc.start()
+start = time.perf_counter()
+exec(code, ip.user_ns)
+seconds = time.perf_counter() - start
+memory, peak_memory = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+errors = [r.error for r in stats.records if r.error]
+if errors:
+    sys.exit("\\n".join(errors))
+sources = (
+    getattr(sys.modules[name], "__file__", None)
+    for name in set(sys.modules) - before
+)
+print(json.dumps({{
+    "seconds": seconds,
+    "memory": memory,
+    "peak_memory": peak_memory,
+    "sources": sorted(i for i in sources if i)
+}}))
+"""
+
+# Left out of the subprocess's environment, so the script runs the hook the
+# way an unconstrained kernel would, without touching the kernels' overrun list.
+_UNSET_ENV_VARS = (
+    "JUPYTER_KERNEL_HOOK_TIME_BUDGET",
+    "JUPYTER_KERNEL_HOOK_MEMORY_BUDGET",
+    "JUPYTER_KERNEL_HOOK_TOTAL_TIME_BUDGET",
+    "JUPYTER_KERNEL_HOOK_TOTAL_MEMORY_BUDGET",
+    "JUPYTER_KERNEL_HOOK_LOG",
+)
+
+
+@dataclass
+class ImportCost(object):
+    """What running the startup script of ``path`` cost, in a fresh
+    interpreter.
+
+    ``top`` holds the most expensive modules that the script loaded, as
+    ``[name, seconds, cumulative seconds]``. A module's own seconds exclude
+    the modules it imported. ``sources`` maps the files of the modules it
+    loaded to their stat, for packages without a version.
+    """
+    path: str
+    version: t.Optional[str] = None
+    seconds: float = 0.0
+    memory: int = 0
+    peak_memory: int = 0
+    modules: int = 0
+    top: t.List[list] = field(default_factory=list)
+    measured: float = 0.0
+    script_hash: t.Optional[str] = None
+    sources: t.Dict[str, t.Optional[list]] = field(default_factory=dict)
+    cached: bool = False
+
+    def is_fresh(self, version: t.Optional[str], script_hash: str) -> bool:
+        """Whether this is still the cost of the installed package."""
+        if self.version != version or self.script_hash != script_hash:
+            return False
+        if version is not None:
+            return True
+        return bool(self.sources) and all(
+            _globals._stat_key(source) == key
+            for source, key in self.sources.items()
+        )
+
+    def summary(self) -> str:
+        version = f" {self.version}" if self.version else ""
+        return (
+            f"{self.path}{version}: {self.seconds:.3f}s and"
+            f" {self.memory / 2 ** 20:.1f}MiB in {self.modules} modules"
+        )
+
+
+def parse_importtime(stderr: str) -> t.List[t.Tuple[str, float, float]]:
+    """``(module, seconds, cumulative seconds)`` for each line of
+    ``-X importtime`` output after the marker.
+    """
+    lines = stderr.splitlines()
+    if _MARKER in lines:
+        lines = lines[lines.index(_MARKER) + 1:]
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        try:
+            own, cumulative, name = line[len("import time:"):].split("|")
+            modules.append(
+                (name.strip(), int(own) / 1e6, int(cumulative) / 1e6)
+            )
+        except ValueError:
+            # The header, or another program's output.
+            continue
+    return modules
+
+
+def _script_hash(script: str) -> str:
+    return hashlib.sha1(script.encode("utf8")).hexdigest()
+
+
+def profile(
+        path: str,
+        script: t.Optional[str] = None,
+        timeout: float = 300,
+        top: int = TOP_MODULES
+) -> ImportCost:
+    """Run the startup ``script`` of ``path`` in a subprocess, with the
+    extension enabled, and measure it. By default, the script only imports
+    ``path``.
+
+    Raises ``RuntimeError`` if the script fails.
+    """
+    if script is None:
+        script = f"import {path}\n"
+    env = dict(os.environ)
+    for var in _UNSET_ENV_VARS:
+        env.pop(var, None)
+    env["PYTHONPATH"] = os.pathsep.join(i for i in sys.path if i)
+    env[_globals.ENABLED_EXTENSIONS_ENV_VAR] = json.dumps([path])
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _PROFILE_SCRIPT, path,
+         script],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout
+    )
+    stderr = proc.stderr.decode(errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"Trial import of {path!r} failed:\n" + stderr)
+    out = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+
+    modules = parse_importtime(stderr)
+    ranked = sorted(modules, key=lambda m: m[1], reverse=True)
+    version = _globals.package_version(path)
+    sources = {}
+    if version is None:
+        sources = {i: _globals._stat_key(i) for i in out["sources"]}
+    return ImportCost(
+        path=path,
+        version=version,
+        seconds=out["seconds"],
+        memory=out["memory"],
+        peak_memory=out["peak_memory"],
+        modules=len(modules),
+        top=[list(m) for m in ranked[:top]],
+        measured=time.time(),
+        script_hash=_script_hash(script),
+        sources=sources
+    )
+
+
+# History
+
+def _history_file() -> str:
+    return os.path.join(_globals._cache_dir(), HISTORY_FILENAME)
+
+
+def read_history() -> t.Dict[str, t.List[dict]]:
+    try:
+        with open(_history_file(), encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def history(path: str) -> t.List[ImportCost]:
+    """Costs of ``path`` that were recorded, oldest first, one per
+    version.
+    """
+    costs = []
+    for d in read_history().get(path, []):
+        try:
+            costs.append(ImportCost(**d))
+        except TypeError:
+            continue
+    return costs
+
+
+def record(cost: ImportCost) -> None:
+    """Add ``cost`` to the history, replacing the entry of the same
+    version.
+    """
+    file = _history_file()
+    d = {k: v for k, v in cost.__dict__.items() if k != "cached"}
+    try:
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with _globals.file_lock(f"{file}.lock"):
+            data = read_history()
+            entries = [
+                i for i in data.get(cost.path, [])
+                if i.get("version") != cost.version
+            ]
+            entries.append(d)
+            data[cost.path] = entries[-HISTORY_LENGTH:]
+            _globals._atomic_write(file, json.dumps(data, indent=2))
+    except OSError:
+        pass
+
+
+def measure(
+        path: str,
+        script: t.Optional[str] = None,
+        force: bool = False,
+        **kwargs
+) -> ImportCost:
+    """The cost of ``path``'s installed version and startup ``script``:
+    recorded, or profiled and recorded if there is none yet (or ``force`` is
+    True).
+    """
+    if script is None:
+        script = f"import {path}\n"
+    if not force:
+        version = _globals.package_version(path)
+        script_hash = _script_hash(script)
+        for cost in reversed(history(path)):
+            if cost.is_fresh(version, script_hash):
+                cost.cached = True
+                return cost
+    cost = profile(path, script=script, **kwargs)
+    record(cost)
+    return cost
+
+
+# Thresholds
+
+def time_warning() -> float:
+    try:
+        return float(os.environ["JUPYTER_KERNEL_HOOK_IMPORT_TIME_WARNING"])
+    except (KeyError, ValueError):
+        return DEFAULT_TIME_WARNING
+
+
+def memory_warning() -> int:
+    try:
+        return parse_size(
+            os.environ["JUPYTER_KERNEL_HOOK_IMPORT_MEMORY_WARNING"]
+        )
+    except (KeyError, ValueError):
+        return DEFAULT_MEMORY_WARNING
+
+
+def check(cost: ImportCost) -> t.List[str]:
+    """Warnings for whatever ``cost`` exceeds, compared with the previous
+    version that was recorded.
+    """
+    previous = None
+    for old in history(cost.path):
+        if old.version != cost.version:
+            previous = old
+
+    messages = []
+    if cost.seconds > time_warning():
+        was = ""
+        if previous is not None:
+            was = f" (version {previous.version}: {previous.seconds:.2f}s)"
+        slowest = ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds, _ in cost.top[:3]
+        )
+        messages.append(
+            f"Importing {cost.path!r} takes {cost.seconds:.2f}s{was}, which"
+            f" every kernel pays at startup. Slowest modules: {slowest}."
+        )
+    if cost.memory > memory_warning():
+        was = ""
+        if previous is not None:
+            was = (
+                f" (version {previous.version}:"
+                f" {previous.memory / 2 ** 20:.1f}MiB)"
+            )
+        messages.append(
+            f"Importing {cost.path!r} adds {cost.memory / 2 ** 20:.1f}MiB"
+            f"{was} to every kernel."
+        )
+    return messages
+
+
+__all__ = [
+    "ImportCost",
+    "parse_importtime",
+    "profile",
+    "read_history",
+    "history",
+    "record",
+    "measure",
+    "check"
+]
@@ -0,0 +1,70 @@
+"""Makes a kernel accept the hooks that the server pushes (see ``hotapply``).
+
+The server writes a single startup script that calls ``listen`` once per
+kernel, while it watches for new hooks. This only registers the comm target
+and leaves a marker file for the server to find; ``hotapply`` is imported
+once the server actually sends something. Like ``runtime``, this is imported
+inside kernels, so it must only use the standard library, and it imports as
+little as it can.
+"""
+import os
+import sys
+
+
+COMM_TARGET = "jupyter_kernel_hook"
+LISTENERS_DIR_ENV_VAR = "JUPYTER_KERNEL_HOOK_LISTENERS_DIR"
+
+_listening = []
+
+
+def _on_comm_open(comm, msg):
+    from .hotapply import on_comm_open
+    on_comm_open(comm, msg)
+
+
+def _connection_file():
+    kernelapp = sys.modules.get("ipykernel.kernelapp")
+    if kernelapp is None or not kernelapp.IPKernelApp.initialized():
+        return None
+    return kernelapp.IPKernelApp.instance().connection_file or None
+
+
+def marker_path(directory, connection_file):
+    """Marker of the kernel with ``connection_file``, in ``directory``."""
+    return os.path.join(directory, os.path.basename(connection_file))
+
+
+def listen(ip=None):
+    """Accept hooks from the server in the running kernel, once.
+
+    Returns False if there is no kernel to listen in, e.g. in a terminal.
+    """
+    if ip is None:
+        IPython = sys.modules.get("IPython")
+        ip = IPython.get_ipython() if IPython is not None else None
+    manager = getattr(getattr(ip, "kernel", None), "comm_manager", None)
+    if manager is None:
+        return False
+    if any(m is manager for m in _listening):
+        return True
+    manager.register_target(COMM_TARGET, _on_comm_open)
+    _listening.append(manager)
+
+    # Tells the server that this kernel can receive hooks.
+    directory = os.environ.get(LISTENERS_DIR_ENV_VAR)
+    connection_file = _connection_file()
+    if directory and connection_file:
+        try:
+            with open(marker_path(directory, connection_file), "w"):
+                pass
+        except OSError:
+            pass
+    return True
+
+
+__all__ = [
+    "COMM_TARGET",
+    "LISTENERS_DIR_ENV_VAR",
+    "marker_path",
+    "listen"
+]
@@ -0,0 +1,428 @@
+"""Pre-warmed kernels, forked from a template process.
+
+The template imports IPython, ipykernel and every enabled hooked package
+once, then forks idle children that wait for a kernel to start. Starting a
+kernel hands one of them its command line and environment, and the kernel
+shares the template's imported modules copy-on-write, so its startup scripts
+find everything they import already loaded. The template forks a
+replacement right after, so the pool stays full.
+
+The template runs in the environment of the kernel that started it, and
+only if ``jupyter_kernel_hook`` can be imported there; otherwise kernels start
+the normal way. It is recycled when the hooks change: the server takes a
+``fingerprint`` of the startup directories and of the enabled extensions in
+the config when it starts the template, and compares it to the current one
+before every kernel it asks for.
+
+This only works on POSIX, since it relies on ``fork``. See ``provisioner``
+for how kernels are started from the pool.
+"""
+import os
+import ast
+import sys
+import json
+import time
+import atexit
+import signal
+import socket
+import tempfile
+import argparse
+import threading
+import traceback
+import subprocess
+import typing as t
+
+from . import _globals
+from . import conditions
+
+
+DEFAULT_SIZE = 1
+KERNEL_MODULES = ("ipykernel_launcher", "ipykernel")
+
+
+def supported() -> bool:
+    return hasattr(os, "fork") and hasattr(socket, "AF_UNIX")
+
+
+def kernel_argv(cmd: t.List[str]) -> t.Optional[t.List[str]]:
+    """Arguments for ``IPKernelApp``, if ``cmd`` starts a plain ipykernel."""
+    if len(cmd) >= 3 and cmd[1] == "-m" and cmd[2] in KERNEL_MODULES:
+        return cmd[3:]
+    return None
+
+
+def fingerprint() -> t.Tuple[str, t.List[t.Any]]:
+    """Changes whenever the template would warm other hooks."""
+    return _globals.hook_fingerprint(), _globals.config_fingerprint()
+
+
+# Template process
+
+def _script_conditions(script_path: str) -> t.Optional[dict]:
+    """The conditions a generated startup script checks, if any."""
+    try:
+        with open(script_path, encoding="utf8") as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, UnicodeDecodeError):
+        return None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and node.args \
+                and getattr(node.func, "id", None) == "matches":
+            try:
+                return ast.literal_eval(node.args[0])
+            except ValueError:
+                return None
+    return None
+
+
+def _warm_hooks() -> t.List[str]:
+    """Import the packages of the enabled, non-lazy hooks."""
+    from . import runtime
+
+    enabled = _globals.__getattr__("enabled_server_extensions")
+    hooks = {}
+    for directory in _globals.hook_dirs():
+        manifest_path = os.path.join(directory, _globals.MANIFEST_FILENAME)
+        try:
+            for hook in runtime.load_manifest(manifest_path):
+                hooks.setdefault(hook.path, hook)
+        except (OSError, ValueError):
+            pass
+        try:
+            filenames = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        for filename in filenames:
+            if filename.endswith(".py"):
+                script = os.path.join(directory, filename)
+                path = _globals.generated_for(script)
+                if path is not None:
+                    hooks.setdefault(path, runtime.Hook(
+                        path=path, conditions=_script_conditions(script)
+                    ))
+
+    warmed = []
+    for hook in hooks.values():
+        if hook.path not in enabled or hook.lazy:
+            continue
+        # Only the kernel knows whether it meets per-kernel conditions.
+        if conditions.per_kernel(hook.conditions) \
+                or not conditions.matches(hook.conditions):
+            continue
+        try:
+            runtime.add_origins(hook.origins)
+            hook.import_module()
+        except Exception:
+            traceback.print_exc()
+            continue
+        warmed.append(hook.path)
+    return warmed
+
+
+def _run_child(read_fd: int) -> None:
+    """Wait for a kernel to start, then become it. Never returns."""
+    code = 1
+    try:
+        os.setsid()
+        with os.fdopen(read_fd, "rb") as f:
+            data = f.read()
+        if not data:
+            # The pool was stopped.
+            code = 0
+            return
+        request = json.loads(data)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.environ.clear()
+        os.environ.update(request["env"])
+        template_dir = os.getcwd()
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+        # Resolved again in the kernel's own environment.
+        for name in ("startup_dir", "enabled_server_extensions"):
+            vars(_globals).pop(name, None)
+        _globals._enabled_lookup.clear()
+        conditions._kernel_name = conditions._unknown
+
+        sys.argv = list(request["argv"])
+        # ``-m`` put the template's working directory first.
+        if sys.path and sys.path[0] in ("", template_dir):
+            del sys.path[0]
+        from ipykernel.kernelapp import IPKernelApp
+        IPKernelApp.launch_instance(argv=kernel_argv(request["argv"]))
+        code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+class Template(object):
+    """The template process: a fork server with a pool of idle children."""
+
+    def __init__(self, socket_path: str, size: int = DEFAULT_SIZE):
+        self.socket_path = socket_path
+        self.size = size
+        self.idle: t.List[t.Tuple[int, int]] = []
+        self.warmed: t.List[str] = []
+
+    def warm(self) -> None:
+        import IPython  # noqa: F401
+        import ipykernel.kernelapp  # noqa: F401
+        self.warmed = _warm_hooks()
+
+    def fork_idle(self) -> None:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(write_fd)
+            for _, fd in self.idle:
+                os.close(fd)
+            self.sock.close()
+            _run_child(read_fd)
+        os.close(read_fd)
+        self.idle.append((pid, write_fd))
+
+    def fill(self) -> None:
+        while len(self.idle) < self.size:
+            self.fork_idle()
+
+    def spawn(self, request: dict) -> int:
+        if not self.idle:
+            self.fork_idle()
+        pid, write_fd = self.idle.pop(0)
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(json.dumps(request).encode())
+        return pid
+
+    def stop(self) -> None:
+        # Idle children exit when they read EOF.
+        for _, fd in self.idle:
+            os.close(fd)
+        self.idle = []
+
+    def handle(self, request: dict) -> t.Optional[dict]:
+        op = request.get("op")
+        if op == "hello":
+            return {"pid": os.getpid(), "warmed": self.warmed}
+        elif op == "spawn":
+            return {"pid": self.spawn(request)}
+        elif op == "stop":
+            return None
+        return {"error": f"Unknown operation {op!r}."}
+
+    def serve(self) -> None:
+        # Kernels are reaped automatically; the server only polls their pids.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        self.warm()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        tmp_path = f"{self.socket_path}.{os.getpid()}.tmp"
+        self.sock.bind(tmp_path)
+        self.sock.listen()
+        self.fill()
+        # Only show up once everything is warm.
+        os.replace(tmp_path, self.socket_path)
+        try:
+            while True:
+                conn, _ = self.sock.accept()
+                with conn, conn.makefile("rwb") as f:
+                    try:
+                        request = json.loads(f.readline())
+                    except ValueError:
+                        continue
+                    response = self.handle(request)
+                    if response is None:
+                        f.write(b'{"stopped": true}\n')
+                        f.flush()
+                        break
+                    f.write(json.dumps(response).encode() + b"\n")
+                    f.flush()
+                # Refill after answering, so the server isn't kept waiting.
+                self.fill()
+        finally:
+            self.stop()
+            self.sock.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+
+# Server side
+
+class Pool(object):
+    """Handle on a template process for one Python executable."""
+
+    def __init__(self, executable: str, size: int = DEFAULT_SIZE):
+        self.executable = executable
+        self.size = size
+        self._dir = tempfile.mkdtemp(prefix="jupyter_kernel_hook-pool-")
+        self.socket_path = os.path.join(self._dir, "template.sock")
+        self.process: t.Optional[subprocess.Popen] = None
+        self.env: t.Optional[t.Dict[str, str]] = None
+        self.fingerprint: t.Optional[t.Tuple[str, t.List[t.Any]]] = None
+        self._hello: t.Optional[dict] = None
+        self._importable: t.Optional[bool] = None
+        self._lock = threading.Lock()
+
+    def importable(self, env: t.Optional[t.Dict[str, str]] = None) -> bool:
+        """Whether the template can run with ``env``, i.e. whether
+        ``jupyter_kernel_hook`` is installed for the kernels. Checked once.
+        """
+        if self._importable is None:
+            try:
+                self._importable = subprocess.run(
+                    [self.executable, "-c", "import jupyter_kernel_hook.pool"],
+                    env=dict(os.environ if env is None else env),
+                    cwd=self._dir,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=60
+                ).returncode == 0
+            except (OSError, subprocess.SubprocessError):
+                self._importable = False
+        return self._importable
+
+    def start(self, env: t.Optional[t.Dict[str, str]] = None) -> None:
+        """Start the template with a kernel's ``env`` (the server's by
+        default).
+        """
+        self.env = dict(os.environ if env is None else env)
+        # Fingerprint first, so a change while warming recycles the template.
+        self.fingerprint = fingerprint()
+        self._hello = None
+        self.process = subprocess.Popen(
+            [self.executable, "-m", "jupyter_kernel_hook.pool",
+             "--socket", self.socket_path, "--size", str(self.size)],
+            env=self.env,
+            cwd=self._dir,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+    def _request(self, request: dict, timeout: float = 10) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            with sock.makefile("rwb") as f:
+                f.write(json.dumps(request).encode() + b"\n")
+                f.flush()
+                return json.loads(f.readline())
+
+    def ready(self) -> bool:
+        """Whether the template is done warming up."""
+        if self.process is None or self.process.poll() is not None:
+            return False
+        if self._hello is None:
+            if not os.path.exists(self.socket_path):
+                return False
+            self._hello = self._request({"op": "hello"})
+        return True
+
+    def wait_ready(self, timeout: float = 60) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.ready():
+            if self.process is None or self.process.poll() is not None \
+                    or time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def spawn(
+            self,
+            argv: t.List[str],
+            env: t.Optional[t.Dict[str, str]] = None,
+            cwd: t.Optional[str] = None
+    ) -> t.Optional[int]:
+        """Start a kernel from the pool. Returns its pid, or None if the pool
+        can't start it (yet), in which case start it the normal way.
+        """
+        if kernel_argv(argv) is None:
+            return None
+        env = dict(os.environ if env is None else env)
+        with self._lock:
+            try:
+                if not self.importable(env):
+                    return None
+                if not self.ready():
+                    if self.process is None or \
+                            self.process.poll() is not None:
+                        self.start(env)
+                    return None
+                if fingerprint() != self.fingerprint:
+                    self.recycle(env)
+                    return None
+                response = self._request({
+                    "op": "spawn",
+                    "argv": list(argv),
+                    "env": env,
+                    "cwd": cwd
+                })
+            except (OSError, ValueError):
+                return None
+        return response.get("pid")
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self._request({"op": "stop"}, timeout=2)
+        except (OSError, ValueError):
+            pass
+        try:
+            self.process.wait(2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.fingerprint = None
+        self._hello = None
+
+    def recycle(self, env: t.Optional[t.Dict[str, str]] = None) -> None:
+        """Replace the template, e.g. because the hooks changed. ``env``
+        defaults to the one it was started with.
+        """
+        env = self.env if env is None else env
+        self.stop()
+        self.start(env)
+
+
+_pools: t.Dict[str, Pool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(executable: str, size: t.Optional[int] = None) -> Pool:
+    """The server's pool for a Python executable. Its template is started
+    by the first kernel asked of it, with that kernel's environment.
+    """
+    if size is None:
+        size = int(os.environ.get("JUPYTER_KERNEL_HOOK_POOL_SIZE",
+                                  DEFAULT_SIZE))
+    with _pools_lock:
+        try:
+            return _pools[executable]
+        except KeyError:
+            pool = _pools[executable] = Pool(executable, size=size)
+            return pool
+
+
+@atexit.register
+def stop_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.stop()
+        _pools.clear()
+
+
+def main(argv: t.Optional[t.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Kernel template process.")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE)
+    args = parser.parse_args(argv)
+    Template(args.socket, size=args.size).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Precompile the import closure of a hook, for kernels without ``__pycache__``.
+
+Kernels that run from read-only images or fresh containers often can't read
+or write the ``__pycache__`` next to a package's sources, so each of them
+compiles every module the hook imports. At registration, the server finds
+those modules with a trial import in a subprocess and compiles them into a
+``sys.pycache_prefix`` tree. The kernel points ``sys.pycache_prefix`` there
+while it imports the hook (see ``runtime.pycache_prefix``).
+
+The ``.pyc`` files are hash-checked, so a changed source file is never run
+from a stale cache. The closure is only recomputed when the package version
+or one of its source files changes. The trial import also records where the
+top-level modules it loaded are, for ``runtime.OriginFinder``.
+"""
+import os
+import sys
+import json
+import subprocess
+import typing as t
+from dataclasses import field
+from dataclasses import dataclass
+
+from . import _globals
+
+
+# Run in a subprocess: ``python -c _CLOSURE_SCRIPT <module> <prefix>``.
+_CLOSURE_SCRIPT = """
+import os
+import sys
+import json
+import importlib
+import importlib.util
+import py_compile
+
+path, prefix = sys.argv[1:3]
+before = set(sys.modules)
+importlib.import_module(path)
+sources = set()
+modules = {}
+for name, m in list(sys.modules.items()):
+    spec = getattr(m, "__spec__", None)
+    if name in before or spec is None or not spec.has_location:
+        continue
+    if not isinstance(spec.origin, str):
+        continue
+    if spec.origin.endswith(".py"):
+        sources.add(spec.origin)
+    if "." not in name:
+        locations = spec.submodule_search_locations
+        if locations is not None:
+            locations = list(locations)
+            entry = os.path.dirname(locations[0])
+        else:
+            entry = os.path.dirname(spec.origin)
+        modules[name] = [spec.origin, locations, entry]
+
+sys.pycache_prefix = prefix
+compiled = 0
+for source in sorted(sources):
+    cfile = importlib.util.cache_from_source(source)
+    try:
+        with open(source, "rb") as f:
+            source_hash = importlib.util.source_hash(f.read())
+        with open(cfile, "rb") as f:
+            header = f.read(16)
+    except OSError:
+        header = b""
+    if header[:4] == importlib.util.MAGIC_NUMBER and header[8:] == source_hash:
+        continue
+    try:
+        py_compile.compile(
+            source,
+            cfile=cfile,
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH
+        )
+    except (OSError, py_compile.PyCompileError):
+        continue
+    compiled += 1
+
+print(json.dumps({
+    "sources": sorted(sources),
+    "modules": modules,
+    "compiled": compiled
+}))
+"""
+
+
+def supported() -> bool:
+    """``sys.pycache_prefix`` is new in Python 3.8."""
+    return hasattr(sys, "pycache_prefix")
+
+
+def pycache_prefix_dir() -> str:
+    """Where the ``.pyc`` files go. Set ``JUPYTER_KERNEL_HOOK_PYCACHE_PREFIX``
+    to move it, e.g. to a volume that's shared with the kernels' containers.
+    """
+    try:
+        return os.environ["JUPYTER_KERNEL_HOOK_PYCACHE_PREFIX"]
+    except KeyError:
+        return os.path.join(_globals._cache_dir(), "pycache")
+
+
+@dataclass
+class PrecompileResult(object):
+    path: str
+    prefix: str
+    version: t.Optional[str] = None
+    sources: t.Dict[str, t.List[int]] = field(default_factory=dict)
+    compiled: int = 0
+    modules: t.Dict[str, list] = field(default_factory=dict)
+    cached: bool = False
+
+
+def _index_file(path: str, prefix: str) -> str:
+    return os.path.join(prefix, f"{path}.json")
+
+
+def _read_index(path: str, prefix: str) -> t.Optional[PrecompileResult]:
+    try:
+        with open(_index_file(path, prefix), encoding="utf8") as f:
+            return PrecompileResult(**json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _is_fresh(result: PrecompileResult, version: t.Optional[str]) -> bool:
+    if result.version != version or not result.sources:
+        return False
+    return all(
+        _globals._stat_key(source) == key
+        for source, key in result.sources.items()
+    )
+
+
+def precompile(
+        path: str,
+        prefix: t.Optional[str] = None,
+        timeout: float = 300
+) -> PrecompileResult:
+    """Compile the modules that ``import {path}`` loads into ``prefix``.
+
+    Raises ``RuntimeError`` if the trial import fails.
+    """
+    if prefix is None:
+        prefix = pycache_prefix_dir()
+    version = _globals.package_version(path)
+    result = _read_index(path, prefix)
+    if result is not None and _is_fresh(result, version):
+        result.cached = True
+        return result
+
+    os.makedirs(prefix, exist_ok=True)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(i for i in sys.path if i)
+    proc = subprocess.run(
+        [sys.executable, "-c", _CLOSURE_SCRIPT, path, prefix],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Trial import of {path!r} failed:\n"
+            + proc.stderr.decode(errors="replace")
+        )
+    out = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+
+    result = PrecompileResult(
+        path=path,
+        prefix=prefix,
+        version=version,
+        sources={i: _globals._stat_key(i) for i in out["sources"]},
+        compiled=out["compiled"],
+        modules=out["modules"]
+    )
+    d = {k: v for k, v in result.__dict__.items() if k != "cached"}
+    _globals._atomic_write(_index_file(path, prefix), json.dumps(d))
+    return result
+
+
+__all__ = [
+    "supported",
+    "pycache_prefix_dir",
+    "PrecompileResult",
+    "precompile"
+]
@@ -0,0 +1,114 @@
+"""Kernel provisioner that starts kernels from a pre-warmed pool.
+
+Select it in a kernel spec's metadata::
+
+    "metadata": {
+        "kernel_provisioner": {
+            "provisioner_name": "jupyter-kernel-hook-pool",
+            "config": {"pool_size": 2}
+        }
+    }
+
+Kernels that can't come from the pool (the template is still warming up, the
+hooks just changed, the kernel isn't a plain ``ipykernel``, or the platform
+can't fork) start the normal way. See ``pool`` for how the pool works.
+"""
+import os
+import time
+import asyncio
+import signal
+import typing as t
+
+from jupyter_client.provisioning import LocalProvisioner
+from traitlets import Integer
+from traitlets import default
+
+from . import pool
+
+
+class ForkedProcess(object):
+    """Enough of ``Popen`` for ``LocalProvisioner``, for a kernel that isn't
+    a child of the server, so it can only be polled through its pid.
+    """
+
+    stdin = None
+    stdout = None
+    stderr = None
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode: t.Optional[int] = None
+
+    def poll(self) -> t.Optional[int]:
+        """The kernel's exit code, or None while it runs.
+
+        The kernel is a child of the template process, which reaps it, so
+        its real exit code is lost: a kernel that exited always reports 0.
+        """
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                # The real exit code went to the template process.
+                self.returncode = 0
+            except PermissionError:
+                pass
+        return self.returncode
+
+    def wait(self, timeout: t.Optional[float] = None) -> int:
+        # Only called once ``poll`` says the kernel is gone.
+        while self.poll() is None:
+            time.sleep(0.1)
+        return self.returncode
+
+    def send_signal(self, signum: int) -> None:
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+
+class PooledProvisioner(LocalProvisioner):
+    """``LocalProvisioner`` that takes kernels from ``pool.get_pool``."""
+
+    pool_size = Integer(
+        config=True,
+        help="Number of idle kernels the template process keeps forked."
+    )
+
+    @default("pool_size")
+    def _default_pool_size(self) -> int:
+        return int(os.environ.get("JUPYTER_KERNEL_HOOK_POOL_SIZE",
+                                  pool.DEFAULT_SIZE))
+
+    def _spawn(self, cmd: t.List[str], env: t.Optional[dict],
+               cwd: t.Optional[str]) -> t.Optional[int]:
+        # Starting the template, talking to it and recycling it all block.
+        if not pool.supported() or pool.kernel_argv(cmd) is None:
+            return None
+        kernel_pool = pool.get_pool(cmd[0], size=self.pool_size)
+        return kernel_pool.spawn(cmd, env=env, cwd=cwd)
+
+    async def launch_kernel(self, cmd: t.List[str], **kwargs: t.Any):
+        # Keep the server's event loop free while the pool is busy.
+        pid = await asyncio.get_running_loop().run_in_executor(
+            None, self._spawn, cmd, kwargs.get("env"), kwargs.get("cwd")
+        )
+        if pid is None:
+            return await super().launch_kernel(cmd, **kwargs)
+        self.process = ForkedProcess(pid)
+        self.pid = self.pgid = pid
+        self.log.debug("Started kernel %s from the pool.", pid)
+        return self.connection_info
+
+
+__all__ = [
+    "ForkedProcess",
+    "PooledProvisioner"
+]
@@ -0,0 +1,694 @@
+"""Kernel-side runtime for bundled startup hooks.
+
+This module is imported inside IPython kernels by the bundle startup script,
+so it must only use the standard library (plus ``IPython``, which is always
+there in a kernel).
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import types
+import warnings
+import importlib
+import importlib.util
+import contextlib
+import threading
+import traceback
+import typing as t
+from dataclasses import field
+from dataclasses import fields
+from dataclasses import dataclass
+
+from . import _globals
+from . import watchdog
+from .conditions import matches
+from .stats import HookRecord
+from .stats import measure
+from .stats import record_hook
+
+if t.TYPE_CHECKING:
+    from concurrent.futures import Future
+
+
+MANIFEST_VERSION = 1
+MODES = ("sync", "background")
+DEFAULT_WORKERS = 4
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports the real module on first attribute access.
+
+    Like ``import a.b.c``, the proxy is bound under the top-level name ``a``,
+    and accessing it imports all of ``a.b.c``. If a namespace is given, the
+    proxy replaces itself there with the real module once it's loaded.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            import_name: t.Optional[str] = None,
+            namespace: t.Optional[dict] = None
+    ):
+        super().__init__(name)
+        self.__dict__["_LazyModule__import_name"] = import_name or name
+        self.__dict__["_LazyModule__namespace"] = namespace
+
+    def _load(self) -> types.ModuleType:
+        importlib.import_module(self.__import_name)
+        module = sys.modules[self.__name__]
+        namespace = self.__namespace
+        if namespace is not None and namespace.get(self.__name__) is self:
+            namespace[self.__name__] = module
+        return module
+
+    def __getattr__(self, attr: str) -> t.Any:
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value: t.Any) -> None:
+        setattr(self._load(), attr, value)
+
+    def __dir__(self) -> t.List[str]:
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        return f"<lazy module {self.__import_name!r}>"
+
+
+class OriginFinder(object):
+    """Meta path finder for top-level modules that the server already found.
+
+    Importing them then takes a stat of the recorded file instead of a search
+    of every ``sys.path`` entry. If the file has moved, or its ``sys.path``
+    entry is gone, the normal import system takes over.
+    """
+
+    def __init__(self):
+        self.modules: t.Dict[str, list] = {}
+
+    def find_spec(self, name: str, path=None, target=None):
+        if path is not None:
+            return None
+        try:
+            origin, locations, entry = self.modules[name]
+        except KeyError:
+            return None
+        if entry not in sys.path or not os.path.isfile(origin):
+            return None
+        return importlib.util.spec_from_file_location(
+            name, origin, submodule_search_locations=locations
+        )
+
+    def invalidate_caches(self) -> None:
+        pass
+
+
+_finder: t.Optional[OriginFinder] = None
+
+
+def add_origins(origins: t.Optional[dict]) -> None:
+    """Serve the modules in a hook's ``origins`` record from where they are.
+
+    Locations recorded by a server that runs in another environment than the
+    kernel are ignored.
+    """
+    global _finder
+    if not origins or origins.get("prefix") != sys.prefix:
+        return
+    if _finder is None or _finder not in sys.meta_path:
+        _finder = OriginFinder()
+        sys.meta_path.insert(0, _finder)
+    for name, location in origins["modules"].items():
+        _finder.modules.setdefault(name, location)
+
+
+_prefix_lock = threading.Lock()
+_prefix_users = 0
+_saved_prefix: t.Optional[str] = None
+
+
+@contextlib.contextmanager
+def pycache_prefix(prefix: t.Optional[str]) -> t.Iterator[None]:
+    """Read and write bytecode under ``prefix`` while importing a hook that
+    was precompiled there (see ``jupyter_kernel_hook.precompile``).
+
+    Hooks imported at the same time on other threads share the prefix until
+    the last of them is done. Does nothing before Python 3.8, or if the
+    prefix doesn't exist.
+    """
+    global _prefix_users, _saved_prefix
+    if prefix is None or not hasattr(sys, "pycache_prefix") \
+            or not os.path.isdir(prefix):
+        yield
+        return
+    with _prefix_lock:
+        if _prefix_users == 0:
+            _saved_prefix = sys.pycache_prefix
+            sys.pycache_prefix = prefix
+        _prefix_users += 1
+    try:
+        yield
+    finally:
+        with _prefix_lock:
+            _prefix_users -= 1
+            if _prefix_users == 0:
+                sys.pycache_prefix = _saved_prefix
+
+
+@dataclass
+class Hook(object):
+    path: str
+    obj: t.Optional[str] = None
+    obj_name: t.Optional[str] = None
+    is_called: bool = False
+    uses_ipy: bool = False
+    priority: int = 50
+    add_to_globals: bool = False
+    lazy: bool = False
+    magics: t.Optional[t.Dict[str, t.List[str]]] = None
+    mode: str = "sync"
+    after: t.List[str] = field(default_factory=list)
+    before: t.List[str] = field(default_factory=list)
+    pycache_prefix: t.Optional[str] = None
+    origins: t.Optional[dict] = None
+    time_budget: t.Optional[float] = None
+    memory_budget: t.Optional[int] = None
+    conditions: t.Optional[dict] = None
+
+    @property
+    def top_level_name(self) -> str:
+        return self.path.partition(".")[0]
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Hook":
+        names = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in d.items() if k in names})
+
+    def import_module(self) -> types.ModuleType:
+        with pycache_prefix(self.pycache_prefix):
+            return importlib.import_module(self.path)
+
+    def import_obj(self, module: types.ModuleType) -> t.Any:
+        """Same as ``from {path} import {obj_name}``."""
+        try:
+            return getattr(module, self.obj_name)
+        except AttributeError:
+            return importlib.import_module(f"{self.path}.{self.obj_name}")
+
+    def call(self, module: types.ModuleType, ip=None) -> t.Any:
+        ns = {self.obj_name: self.import_obj(module)}
+        if self.uses_ipy:
+            ns.update(ip=ip, ipy=ip, ipython=ip)
+        return eval(self.obj, ns)
+
+    def bind_lazy(self, user_ns: t.Optional[dict] = None) -> None:
+        if user_ns is not None:
+            name = self.top_level_name
+            user_ns[name] = LazyModule(name, self.path, user_ns)
+
+    def _magic_stub(self, ip, kind: str, name: str, load: callable) -> callable:
+        def stub(line, cell=None):
+            load()
+            magic = ip.find_magic(name, kind)
+            if magic is None or getattr(magic, "_jupyter_kernel_hook_stub", False):
+                raise RuntimeError(
+                    f"Loading {self.path!r} did not register %{name}."
+                )
+            if kind == "cell":
+                return magic(line, cell)
+            return magic(line)
+
+        stub._jupyter_kernel_hook_stub = True
+        stub.__doc__ = f"Loads {self.path!r} on first use."
+        return stub
+
+    def register_magic_stubs(
+            self,
+            ip,
+            user_ns: t.Optional[dict] = None,
+            record: t.Optional[HookRecord] = None
+    ) -> None:
+        """Register stand-ins for the hook's magics instead of importing it.
+
+        The first time any of the stubs is used, the hook runs for real, which
+        registers the real magics over the stubs.
+        """
+        loaded = []
+        if record is None:
+            record = HookRecord(path=self.path)
+
+        def load():
+            if not loaded:
+                loaded.append(True)
+                with measure(record):
+                    self.load(ip=ip, user_ns=user_ns, record=record)
+
+        for kind, names in self.magics.items():
+            for name in names:
+                ip.register_magic_function(
+                    self._magic_stub(ip, kind, name, load),
+                    magic_kind=kind,
+                    magic_name=name
+                )
+        if self.add_to_globals:
+            self.bind_lazy(user_ns)
+
+    def effective_mode(self, ip=None) -> str:
+        """How ``run`` loads the hook: sync, background, deferred or lazy.
+
+        Background and deferred loading need a shell, so without one they
+        fall back to sync.
+        """
+        if self.lazy:
+            return "lazy"
+        elif ip is not None and self.magics:
+            return "deferred"
+        elif ip is not None and self.mode == "background":
+            return "background"
+        return "sync"
+
+    def imports_inline(self, ip=None) -> bool:
+        """Whether ``run`` imports the module before returning."""
+        return self.effective_mode(ip) == "sync"
+
+    def budget(self) -> watchdog.Budget:
+        return watchdog.hook_budget(self.time_budget, self.memory_budget)
+
+    def get_watchdog(self) -> t.Optional[watchdog.Watchdog]:
+        """Watchdog for loading the hook now, or None if it's unbounded."""
+        dog = watchdog.Watchdog(self.path, self.budget())
+        return dog if dog.limit else None
+
+    def run(
+            self,
+            ip=None,
+            user_ns: t.Optional[dict] = None,
+            record: t.Optional[HookRecord] = None,
+            imported: t.Optional["Future"] = None,
+            load: t.Optional[t.Callable[[], t.Any]] = None
+    ) -> None:
+        """Load the hook the way its mode says. ``imported`` is a future for
+        the import, if it's already running on another thread. ``load``
+        replaces ``Hook.load`` when the hook is loaded synchronously, once the
+        module is imported.
+        """
+        mode = self.effective_mode(ip)
+        if record is not None:
+            record.mode = mode
+        if mode == "lazy":
+            self.bind_lazy(user_ns)
+        elif mode == "deferred":
+            self.register_magic_stubs(ip, user_ns=user_ns, record=record)
+        elif mode == "background":
+            BackgroundLoad(self, ip, user_ns=user_ns, record=record).start()
+        else:
+            if load is None:
+                def load():
+                    self.load(ip=ip, user_ns=user_ns, record=record)
+            dog = self.get_watchdog()
+            if dog is None:
+                if imported is not None:
+                    imported.result()
+                load()
+                return
+            try:
+                dog.run(self.import_module, load, imported=imported)
+            except watchdog.OverBudget as e:
+                if record is not None:
+                    record.error = str(e)
+                warnings.warn(str(e))
+
+    def load(
+            self,
+            ip=None,
+            user_ns: t.Optional[dict] = None,
+            record: t.Optional[HookRecord] = None
+    ) -> None:
+        """Import the module and make the call, if there is one."""
+        start = time.perf_counter()
+        module = self.import_module()
+        after_import = time.perf_counter()
+        if self.is_called:
+            self.call(module, ip=ip)
+        elif self.obj is not None:
+            self.import_obj(module)
+        if record is not None:
+            record.import_seconds = after_import - start
+            if self.is_called:
+                record.call_seconds = time.perf_counter() - after_import
+        if self.add_to_globals and user_ns is not None:
+            name = self.top_level_name
+            user_ns[name] = sys.modules[name]
+
+
+_pending: t.List["BackgroundLoad"] = []
+_pending_lock = threading.Lock()
+
+
+class BackgroundLoad(object):
+    """Import a hook's module on a worker thread.
+
+    Only the import happens off the main thread. The call (which usually
+    registers things on ``ip``) and ``add_to_globals`` are applied on the main
+    thread, before the first cell that runs after the import finished, or
+    before the first cell that mentions the package or one of its magics, in
+    which case that cell waits for this hook, and only this hook.
+    """
+
+    def __init__(
+            self,
+            hook: Hook,
+            ip,
+            user_ns: t.Optional[dict] = None,
+            record: t.Optional[HookRecord] = None
+    ):
+        self.hook = hook
+        self.ip = ip
+        self.user_ns = user_ns
+        self.record = record or HookRecord(path=hook.path, mode="background")
+        self.import_seconds = None
+        self.modules_added = 0
+        self.applied = False
+        self.thread = threading.Thread(
+            target=self._import,
+            name=f"jupyter_kernel_hook:{hook.path}",
+            daemon=True
+        )
+
+    def _import(self) -> None:
+        n_modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            self.hook.import_module()
+        except BaseException:
+            # Re-raised by ``apply`` on the main thread.
+            pass
+        self.import_seconds = time.perf_counter() - start
+        self.modules_added = len(sys.modules) - n_modules
+
+    def start(self) -> None:
+        with _pending_lock:
+            _pending.append(self)
+        _watch_cells(self.ip)
+        if self.hook.add_to_globals:
+            # Touching the proxy imports the module, which blocks on the
+            # worker thread's import lock until the import is done.
+            self.hook.bind_lazy(self.user_ns)
+        self.thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return not self.thread.is_alive()
+
+    def needed_by(self, cell: str) -> bool:
+        names = [self.hook.top_level_name]
+        for magic_names in (self.hook.magics or {}).values():
+            names.extend(magic_names)
+        return any(name in cell for name in names)
+
+    def apply(self) -> None:
+        """Wait for the import, then finish loading on the calling thread."""
+        if self.applied:
+            return
+        self.applied = True
+        self.thread.join()
+        with _pending_lock:
+            if self in _pending:
+                _pending.remove(self)
+        record = self.record
+        try:
+            with measure(record):
+                self.hook.load(ip=self.ip, user_ns=self.user_ns, record=record)
+        except Exception:
+            traceback.print_exc()
+        record.import_seconds = self.import_seconds
+        record.modules_added += self.modules_added
+
+
+def _on_pre_run_cell(info=None) -> None:
+    cell = getattr(info, "raw_cell", None) or ""
+    with _pending_lock:
+        pending = list(_pending)
+    for b in pending:
+        if b.ready or b.needed_by(cell):
+            b.apply()
+
+
+_watched_shells: t.List[t.Any] = []
+
+
+def _watch_cells(ip) -> None:
+    if any(i is ip for i in _watched_shells):
+        return
+    _watched_shells.append(ip)
+    ip.events.register("pre_run_cell", _on_pre_run_cell)
+
+
+def wait(timeout: t.Optional[float] = None) -> bool:
+    """Apply every background hook, waiting for the ones still importing.
+
+    Returns False if ``timeout`` ran out before all imports were done.
+    """
+    with _pending_lock:
+        pending = list(_pending)
+    for b in pending:
+        b.thread.join(timeout)
+        if not b.ready:
+            return False
+        b.apply()
+    return True
+
+
+def load_manifest(manifest_path: str) -> t.List[Hook]:
+    """Load the hooks in a manifest, sorted by priority."""
+    with open(manifest_path, encoding="utf8") as f:
+        data = json.load(f)
+    if data.get("version") != MANIFEST_VERSION:
+        raise ValueError(
+            f"Unsupported manifest version {data.get('version')!r} in"
+            f" {manifest_path!r}."
+        )
+    hooks = [Hook.from_dict(d) for d in data["hooks"].values()]
+    return sorted(hooks, key=lambda h: (h.priority, h.path))
+
+
+def schedule(hooks: t.List[Hook]) -> t.List[Hook]:
+    """Order hooks so each one runs after its ``after`` hooks and before its
+    ``before`` hooks. Ties are broken by priority, then by name.
+
+    Relationships to hooks that aren't in ``hooks`` (e.g. disabled ones) are
+    ignored. If there is a cycle, the hooks in it fall back to priority order
+    with a warning.
+    """
+    by_path = {h.path: h for h in hooks}
+    deps = {h.path: set() for h in hooks}
+    for h in hooks:
+        deps[h.path].update(i for i in h.after if i in by_path)
+        for i in h.before:
+            if i in by_path:
+                deps[i].add(h.path)
+
+    def key(h: Hook) -> tuple:
+        return h.priority, h.path
+
+    dependents = {h.path: [] for h in hooks}
+    for path, d in deps.items():
+        for i in d:
+            dependents[i].append(path)
+    remaining = {path: len(d) for path, d in deps.items()}
+    heap = [key(h) for h in hooks if not remaining[h.path]]
+    heapq.heapify(heap)
+
+    ordered = []
+    while heap:
+        _, path = heapq.heappop(heap)
+        ordered.append(by_path[path])
+        for i in dependents[path]:
+            remaining[i] -= 1
+            if not remaining[i]:
+                heapq.heappush(heap, key(by_path[i]))
+
+    if len(ordered) < len(hooks):
+        cycle = sorted(
+            (h for h in hooks if remaining[h.path]),
+            key=key
+        )
+        warnings.warn(
+            "Hooks have cyclic after/before relationships: "
+            + ", ".join(repr(h.path) for h in cycle)
+        )
+        ordered.extend(cycle)
+    return ordered
+
+
+def _workers() -> int:
+    try:
+        return int(os.environ["JUPYTER_KERNEL_HOOK_WORKERS"])
+    except (KeyError, ValueError):
+        return DEFAULT_WORKERS
+
+
+def _quiet_import(hook: Hook) -> float:
+    start = time.perf_counter()
+    try:
+        hook.import_module()
+    except BaseException:
+        # Re-raised by ``Hook.run`` on the main thread.
+        pass
+    return time.perf_counter() - start
+
+
+def _run_hooks(
+        hooks: t.List[Hook],
+        ip=None,
+        user_ns: t.Optional[dict] = None,
+        workers: int = 1
+) -> None:
+    """Run the hooks in order, importing ahead on a thread pool.
+
+    A hook's module is imported on the pool as soon as every hook it comes
+    after has fully run, so independent imports overlap. The calls still run
+    on the calling thread, in order.
+
+    Hooks that went over their budget in an earlier kernel aren't imported
+    ahead, since they will be skipped.
+    """
+    inline = [
+        h for h in hooks if h.imports_inline(ip)
+        and not (h.budget() and watchdog.overrun(h.path))
+    ]
+    pool = None
+    if workers > 1 and len(inline) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="jupyter_kernel_hook"
+        )
+    deps = {h.path: set(h.after) for h in hooks}
+    for h in hooks:
+        for i in h.before:
+            if i in deps:
+                deps[i].add(h.path)
+    all_paths = set(deps)
+    futures = {}
+    done = set()
+
+    def submit_ready() -> None:
+        for h in inline:
+            if h.path not in futures \
+                    and not (deps[h.path] & all_paths) - done:
+                futures[h.path] = pool.submit(_quiet_import, h)
+
+    try:
+        if pool is not None:
+            submit_ready()
+        for hook in hooks:
+            future = futures.get(hook.path)
+            import_seconds = None
+            if future is not None and hook.get_watchdog() is None:
+                import_seconds = future.result()
+                future = None
+            try:
+                with record_hook(hook.path) as record:
+                    # Hooks with a budget only wait for the import within it.
+                    hook.run(ip=ip, user_ns=user_ns, record=record,
+                             imported=future)
+            except Exception:
+                traceback.print_exc()
+            if future is not None and future.done():
+                import_seconds = future.result()
+            if import_seconds is not None:
+                # The import itself happened on the pool.
+                record.import_seconds = import_seconds
+            done.add(hook.path)
+            if pool is not None:
+                submit_ready()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+
+def _get_ipython():
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return None
+    return get_ipython()
+
+
+def run_hook(
+        hook: Hook,
+        ip=None,
+        user_ns: t.Optional[dict] = None,
+        load: t.Optional[t.Callable[[], t.Any]] = None
+) -> None:
+    """Run a single hook and record it for ``%kernel_hooks``. ``load`` is
+    passed on to ``Hook.run``.
+    """
+    with record_hook(hook.path) as record:
+        hook.run(ip=ip, user_ns=user_ns, record=record, load=load)
+
+
+_ran: t.Set[str] = set()
+
+
+def run(
+        manifest_path: str,
+        ip=None,
+        workers: t.Optional[int] = None
+) -> None:
+    """Run every enabled hook in the manifest whose conditions this kernel
+    meets (see ``conditions``).
+
+    Hooks run in ``schedule`` order. Modules of hooks that don't depend on
+    each other are imported concurrently on up to ``workers`` threads
+    (``JUPYTER_KERNEL_HOOK_WORKERS``, or 4 by default; 1 turns it off).
+
+    The enabled set is looked up once for the whole bundle. An exception in
+    one hook is printed and does not stop the others, same as with separate
+    startup scripts.
+    """
+    if not os.path.isfile(manifest_path):
+        return
+    if ip is None:
+        ip = _get_ipython()
+    hooks = load_manifest(manifest_path)
+    enabled = _globals.__getattr__("enabled_server_extensions")
+
+    # A hook in both the shared bundle and the user's bundle only runs once.
+    hooks = [
+        h for h in hooks if h.path in enabled and h.path not in _ran
+        and matches(h.conditions)
+    ]
+    _ran.update(h.path for h in hooks)
+    for h in hooks:
+        add_origins(h.origins)
+    if not hooks:
+        return
+
+    if ip is not None:
+        user_ns = ip.user_ns
+    else:
+        user_ns = sys.modules["__main__"].__dict__
+
+    if workers is None:
+        workers = _workers()
+    _run_hooks(schedule(hooks), ip=ip, user_ns=user_ns, workers=workers)
+
+
+__all__ = [
+    "MANIFEST_VERSION",
+    "MODES",
+    "LazyModule",
+    "Hook",
+    "pycache_prefix",
+    "OriginFinder",
+    "add_origins",
+    "BackgroundLoad",
+    "wait",
+    "load_manifest",
+    "schedule",
+    "run_hook",
+    "run"
+]
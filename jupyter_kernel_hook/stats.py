@@ -0,0 +1,176 @@
+"""Per-hook kernel startup instrumentation.
+
+Like ``runtime``, this is imported inside kernels, so it must only use the
+standard library.
+"""
+import os
+import sys
+import json
+import time
+import contextlib
+import tracemalloc
+import typing as t
+from dataclasses import asdict
+from dataclasses import dataclass
+
+from . import _globals
+
+
+@dataclass
+class HookRecord(object):
+    """What one hook cost the kernel.
+
+    Hooks that finish loading after startup (background and deferred hooks)
+    keep adding to the same record when they do.
+    """
+    path: str
+    mode: str = "sync"
+    seconds: float = 0.0
+    import_seconds: t.Optional[float] = None
+    call_seconds: t.Optional[float] = None
+    peak_memory: t.Optional[int] = None
+    modules_added: int = 0
+    error: t.Optional[str] = None
+
+
+records: t.List[HookRecord] = []
+
+
+def _log_record(record: HookRecord) -> None:
+    """Append the record to ``JUPYTER_KERNEL_HOOK_LOG`` as a JSON line."""
+    log_path = os.environ.get("JUPYTER_KERNEL_HOOK_LOG")
+    if not log_path:
+        return
+    d = asdict(record)
+    d.update(pid=os.getpid(), time=time.time())
+    try:
+        with open(log_path, "a", encoding="utf8") as f:
+            f.write(json.dumps(d) + "\n")
+    except OSError:
+        pass
+
+
+def _trace_memory() -> bool:
+    return bool(os.environ.get("JUPYTER_KERNEL_HOOK_TRACEMALLOC"))
+
+
+@contextlib.contextmanager
+def measure(record: HookRecord) -> t.Iterator[HookRecord]:
+    """Add the wall time, memory and modules of the block to ``record``.
+
+    Peak memory is only measured while ``tracemalloc`` is tracing. Set
+    ``JUPYTER_KERNEL_HOOK_TRACEMALLOC=1`` to trace just the hooks.
+    """
+    started_tracing = _trace_memory() and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        base_memory = tracemalloc.get_traced_memory()[0]
+    n_modules = len(sys.modules)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record.seconds += time.perf_counter() - start
+        record.modules_added += len(sys.modules) - n_modules
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1] - base_memory
+            record.peak_memory = max(record.peak_memory or 0, peak)
+        if started_tracing:
+            tracemalloc.stop()
+        _log_record(record)
+
+
+@contextlib.contextmanager
+def record_hook(path: str, mode: str = "sync") -> t.Iterator[HookRecord]:
+    """Measure a hook and keep the record for ``%kernel_hooks``."""
+    record = HookRecord(path=path, mode=mode)
+    records.append(record)
+    register_magic()
+    with measure(record):
+        yield record
+
+
+def _fmt_seconds(seconds: t.Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+
+def _fmt_bytes(n: t.Optional[int]) -> str:
+    return "-" if n is None else f"{n / 2 ** 20:.1f}MiB"
+
+
+def format_records() -> str:
+    lookup = _globals._enabled_lookup
+    rows = [("hook", "mode", "total", "import", "call", "memory", "modules",
+             "error")]
+    for r in records:
+        rows.append((
+            r.path,
+            r.mode,
+            _fmt_seconds(r.seconds),
+            _fmt_seconds(r.import_seconds),
+            _fmt_seconds(r.call_seconds),
+            _fmt_bytes(r.peak_memory),
+            str(r.modules_added),
+            r.error or ""
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = [
+        "  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+    if lookup:
+        lines.append(
+            f"\nEnabled extension lookup: {_fmt_seconds(lookup['seconds'])}"
+            f" ({lookup['source']})"
+        )
+    return "\n".join(lines)
+
+
+def kernel_hooks(line: str = "") -> None:
+    """Show what each hooked extension cost this kernel at startup.
+
+    Usage: ``%kernel_hooks`` for a table, ``%kernel_hooks --json`` for JSON.
+    """
+    if line.strip() == "--json":
+        print(json.dumps({
+            "hooks": [asdict(r) for r in records],
+            "enabled_lookup": _globals._enabled_lookup or None
+        }, indent=2))
+    else:
+        print(format_records())
+
+
+_magic_shells: t.List[t.Any] = []
+
+
+def register_magic(ip=None) -> None:
+    """Register ``%kernel_hooks`` in the running IPython shell, once."""
+    if ip is None:
+        IPython = sys.modules.get("IPython")
+        ip = IPython.get_ipython() if IPython is not None else None
+    if ip is None or any(i is ip for i in _magic_shells):
+        return
+    _magic_shells.append(ip)
+    ip.register_magic_function(
+        kernel_hooks,
+        magic_kind="line",
+        magic_name="kernel_hooks"
+    )
+
+
+__all__ = [
+    "HookRecord",
+    "records",
+    "measure",
+    "record_hook",
+    "format_records",
+    "kernel_hooks",
+    "register_magic"
+]
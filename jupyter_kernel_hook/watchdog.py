@@ -0,0 +1,340 @@
+"""Time and memory budgets for hooks, enforced in the kernel.
+
+A hook with a budget has its module imported on a watchdog thread while the
+kernel waits for it. If the import takes longer than the hook's time budget,
+or grows the kernel's resident memory by more than its memory budget, the
+kernel stops waiting, abandons the import and starts without the hook. The
+call (e.g. ``load_ipython_extension(ip)``) still runs on the main thread, so
+it can't be abandoned; if it goes over, the hook is loaded but counts as over
+budget all the same.
+
+Hooks that went over their budget are skipped by later kernels, until the
+version of their package changes. The list is kept in the cache directory
+(see ``clear_overruns``).
+
+Admins can override budgets through the kernels' environment:
+
+* ``JUPYTER_KERNEL_HOOK_TIME_BUDGET`` and ``JUPYTER_KERNEL_HOOK_MEMORY_BUDGET``
+  replace the budget of every hook.
+* ``JUPYTER_KERNEL_HOOK_TOTAL_TIME_BUDGET`` and
+  ``JUPYTER_KERNEL_HOOK_TOTAL_MEMORY_BUDGET`` bound all hooks of a kernel
+  together. Once they run out, the remaining hooks are skipped.
+
+These apply to hooks registered without a budget too: their startup scripts
+check ``BUDGET_ENV_VARS`` and hand the hook to the runtime if any is set.
+
+Times are in seconds, memory in bytes (``K``, ``M`` and ``G`` suffixes are
+allowed). Like ``runtime``, this is imported inside kernels, so it must only
+use the standard library.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import typing as t
+from dataclasses import dataclass
+
+from . import _globals
+
+
+OVERRUNS_FILENAME = "overruns.json"
+BUDGET_ENV_VARS = (
+    "JUPYTER_KERNEL_HOOK_TIME_BUDGET",
+    "JUPYTER_KERNEL_HOOK_MEMORY_BUDGET",
+    "JUPYTER_KERNEL_HOOK_TOTAL_TIME_BUDGET",
+    "JUPYTER_KERNEL_HOOK_TOTAL_MEMORY_BUDGET"
+)
+POLL_INTERVAL = 0.02
+
+_SIZE_SUFFIXES = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+
+
+def parse_size(s: t.Union[str, int]) -> int:
+    """``"512M"`` -> ``536870912``."""
+    if isinstance(s, int):
+        return s
+    s = s.strip().upper().rstrip("B").rstrip("I")
+    if s and s[-1] in _SIZE_SUFFIXES:
+        return int(float(s[:-1]) * _SIZE_SUFFIXES[s[-1]])
+    return int(s)
+
+
+def rss() -> t.Optional[int]:
+    """Resident memory of this process in bytes, or None if it's unknown.
+
+    Where ``/proc`` isn't available, this is the peak resident memory.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+@dataclass
+class Budget(object):
+    seconds: t.Optional[float] = None
+    memory: t.Optional[int] = None
+
+    def __bool__(self) -> bool:
+        return self.seconds is not None or self.memory is not None
+
+    def clip(self, other: "Budget") -> "Budget":
+        """The tighter of the two, for each resource."""
+        def tighter(a, b):
+            return b if a is None else a if b is None else min(a, b)
+
+        return Budget(
+            seconds=tighter(self.seconds, other.seconds),
+            memory=tighter(self.memory, other.memory)
+        )
+
+
+class OverBudget(Exception):
+    """A hook went over its budget, or there was no budget left for it."""
+
+
+def _env_budget(prefix: str) -> Budget:
+    budget = Budget()
+    seconds = os.environ.get(f"JUPYTER_KERNEL_HOOK_{prefix}TIME_BUDGET")
+    memory = os.environ.get(f"JUPYTER_KERNEL_HOOK_{prefix}MEMORY_BUDGET")
+    try:
+        if seconds:
+            budget.seconds = float(seconds)
+        if memory:
+            budget.memory = parse_size(memory)
+    except ValueError:
+        pass
+    return budget
+
+
+# What the kernel's hooks have used up so far, for the total budget.
+_spent = {"seconds": 0.0, "memory": 0}
+
+
+def hook_budget(
+        time_budget: t.Optional[float] = None,
+        memory_budget: t.Optional[int] = None
+) -> Budget:
+    """A hook's own budget: the registered one, unless admins override it."""
+    admin = _env_budget("")
+    return Budget(
+        seconds=time_budget if admin.seconds is None else admin.seconds,
+        memory=memory_budget if admin.memory is None else admin.memory
+    )
+
+
+def remaining_budget() -> Budget:
+    """What's left of the kernel's total budget."""
+    total = _env_budget("TOTAL_")
+    return Budget(
+        seconds=None if total.seconds is None
+        else total.seconds - _spent["seconds"],
+        memory=None if total.memory is None
+        else total.memory - _spent["memory"]
+    )
+
+
+# Hooks that went over budget in earlier kernels
+
+def _overruns_file() -> str:
+    return os.path.join(_globals._cache_dir(), OVERRUNS_FILENAME)
+
+
+def read_overruns() -> t.Dict[str, dict]:
+    try:
+        with open(_overruns_file(), encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_overruns(update: t.Callable[[dict], None]) -> None:
+    path = _overruns_file()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _globals.file_lock(f"{path}.lock"):
+            overruns = read_overruns()
+            update(overruns)
+            _globals._atomic_write(path, json.dumps(overruns, indent=2))
+    except OSError:
+        pass
+
+
+def record_overrun(path: str, reason: str) -> None:
+    def update(overruns: dict) -> None:
+        overruns[path] = {
+            "version": _globals.package_version(path),
+            "reason": reason,
+            "time": time.time()
+        }
+
+    _update_overruns(update)
+
+
+def clear_overruns(paths: t.Optional[t.Iterable[str]] = None) -> None:
+    """Let hooks that went over budget run again, without waiting for a new
+    version. Clears every hook if ``paths`` is None.
+    """
+    def update(overruns: dict) -> None:
+        for path in list(overruns) if paths is None else paths:
+            overruns.pop(path, None)
+
+    _update_overruns(update)
+
+
+def overrun(path: str) -> t.Optional[dict]:
+    """The overrun that still keeps the hook from running, if there is one.
+
+    Only hooks on the list pay for the version lookup.
+    """
+    entry = read_overruns().get(path)
+    if entry is None or entry["version"] != _globals.package_version(path):
+        return None
+    return entry
+
+
+# Enforcement
+
+def _describe(budget: Budget) -> str:
+    parts = []
+    if budget.seconds is not None:
+        parts.append(f"{budget.seconds:g}s")
+    if budget.memory is not None:
+        parts.append(f"{budget.memory / 2 ** 20:.0f}MiB")
+    return " and ".join(parts)
+
+
+def _exceeded(budget: Budget, seconds: float,
+              memory: t.Optional[int]) -> t.Optional[str]:
+    if budget.seconds is not None and seconds > budget.seconds:
+        return f"took more than {budget.seconds:g}s"
+    if budget.memory is not None and memory is not None \
+            and memory > budget.memory:
+        return f"grew memory by more than {budget.memory / 2 ** 20:.0f}MiB"
+    return None
+
+
+class Watchdog(object):
+    """Runs one hook within its budget."""
+
+    def __init__(self, path: str, budget: Budget):
+        self.path = path
+        self.budget = budget
+        self.remaining = remaining_budget()
+        self.start = None
+        self.base_rss = None
+
+    @property
+    def limit(self) -> Budget:
+        return self.budget.clip(self.remaining)
+
+    def _usage(self) -> t.Tuple[float, t.Optional[int]]:
+        seconds = time.perf_counter() - self.start
+        current = rss() if self.limit.memory is not None else None
+        if current is None or self.base_rss is None:
+            return seconds, None
+        return seconds, current - self.base_rss
+
+    def _over(self, seconds: float, memory: t.Optional[int]) -> None:
+        """Raise ``OverBudget`` if the hook used too much."""
+        reason = _exceeded(self.budget, seconds, memory)
+        if reason is not None:
+            record_overrun(self.path, reason)
+            raise OverBudget(
+                f"Hook {self.path!r} {reason}, so later kernels will skip"
+                f" it until its version changes."
+            )
+        reason = _exceeded(self.remaining, seconds, memory)
+        if reason is not None:
+            raise OverBudget(
+                f"Hook {self.path!r} was stopped because the kernel's hooks"
+                f" used up their total budget of {_describe(self.remaining)}."
+            )
+
+    def wait(self, done: t.Callable[[], bool]) -> None:
+        """Wait until ``done()``, or until the budget runs out."""
+        while not done():
+            self._over(*self._usage())
+            time.sleep(POLL_INTERVAL)
+
+    def run(
+            self,
+            import_module: t.Callable[[], t.Any],
+            load: t.Callable[[], None],
+            imported: t.Optional[t.Any] = None
+    ) -> None:
+        """Wait for the import within the budget, then ``load`` the hook.
+
+        ``imported`` is a future for an import that's already running, e.g.
+        on ``runtime``'s import pool. Otherwise the import runs on a daemon
+        thread, which is abandoned if the budget runs out.
+        """
+        entry = overrun(self.path)
+        if entry is not None:
+            raise OverBudget(
+                f"Skipped hook {self.path!r}, which {entry['reason']} in an"
+                f" earlier kernel. It runs again once its version changes."
+            )
+        limit = self.limit
+        if (limit.seconds is not None and limit.seconds <= 0) \
+                or (limit.memory is not None and limit.memory <= 0):
+            raise OverBudget(
+                f"Skipped hook {self.path!r} because the kernel's hooks used"
+                f" up their total budget of {_describe(self.remaining)}."
+            )
+
+        self.start = time.perf_counter()
+        self.base_rss = rss() if limit.memory is not None else None
+        try:
+            if imported is None:
+                thread = threading.Thread(
+                    target=_quiet(import_module),
+                    name=f"jupyter_kernel_hook-watchdog:{self.path}",
+                    daemon=True
+                )
+                thread.start()
+                self.wait(lambda: not thread.is_alive())
+            else:
+                self.wait(imported.done)
+            load()
+            self._over(*self._usage())
+        finally:
+            seconds, memory = self._usage()
+            _spent["seconds"] += seconds
+            _spent["memory"] += max(memory or 0, 0)
+
+
+def _quiet(f: t.Callable[[], t.Any]) -> t.Callable[[], None]:
+    def wrapper() -> None:
+        try:
+            f()
+        except BaseException:
+            # Raised again on the main thread, by ``load``.
+            pass
+
+    return wrapper
+
+
+__all__ = [
+    "OVERRUNS_FILENAME",
+    "Budget",
+    "OverBudget",
+    "Watchdog",
+    "parse_size",
+    "rss",
+    "BUDGET_ENV_VARS",
+    "hook_budget",
+    "remaining_budget",
+    "read_overruns",
+    "record_overrun",
+    "clear_overruns",
+    "overrun"
+]
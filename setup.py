@@ -33,9 +33,9 @@ setup(
     include_package_data=True,
     install_requires=[
         'dataclasses>=0.6;python_version<"3.7"',
+        'importlib_metadata;python_version<"3.8"',
         "IPython",
         "notebook",
-        "jinja2",
     ],
     classifiers=[
         "Development Status :: 1 - Planning",
@@ -51,5 +51,11 @@ setup(
         "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10",
     ],
+    entry_points={
+        "jupyter_client.kernel_provisioners": [
+            "jupyter-kernel-hook-pool ="
+            " jupyter_kernel_hook.provisioner:PooledProvisioner",
+        ],
+    },
     zip_safe=False
 )
@@ -1,11 +1,18 @@
 import sys
 import json
+from textwrap import dedent
 
 import pytest
 import jupyter_core.paths
 from notebook.notebookapp import NotebookApp
 
 from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import data_cache
+from jupyter_kernel_hook import listener
+from jupyter_kernel_hook import runtime
+from jupyter_kernel_hook import stats
+from jupyter_kernel_hook import watchdog
 from jupyter_kernel_hook.core import jupyter_config_json
 
 
@@ -22,9 +29,31 @@ def _delete_global(s: str):
 @pytest.fixture(autouse=True)
 def reset_lazy_loads():
     yield
-    _delete_global("jinja_env")
     _delete_global("startup_dir")
     _delete_global("enabled_server_extensions")
+    _globals._enabled_lookup.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_startup_dir_indexes():
+    yield
+    core._indexes.clear()
+    core._shared_manifests.clear()
+    runtime._ran.clear()
+    if runtime._finder in sys.meta_path:
+        sys.meta_path.remove(runtime._finder)
+    runtime._finder = None
+    watchdog._spent.update(seconds=0.0, memory=0)
+    data_cache._mapped.clear()
+    listener._listening.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_records():
+    stats.records.clear()
+    yield
+    stats.records.clear()
+    stats._magic_shells.clear()
 
 
 @pytest.fixture
@@ -45,6 +74,18 @@ def mock_scripts_dir(monkeypatch, ipython_scripts_dir):
     yield
 
 
+@pytest.fixture(autouse=True)
+def enabled_cache_dir(monkeypatch, tmpdir):
+    directory = tmpdir.mkdir("cache")
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_CACHE_DIR", directory.strpath)
+    monkeypatch.delenv("JUPYTER_KERNEL_HOOK_NO_CACHE", raising=False)
+    monkeypatch.delenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, raising=False)
+    monkeypatch.setenv(
+        _globals.SHARED_DIR_ENV_VAR, tmpdir.join("shared").strpath
+    )
+    yield directory
+
+
 @pytest.fixture
 def jupyter_config_dir(tmpdir):
     directory = tmpdir.mkdir("jupyter_config")
@@ -77,6 +118,55 @@ def nb_app(jupyter_config_dir):
     )
 
 
+FAKE_EXTENSION_SOURCE = """
+    calls = []
+
+
+    def func(*args, **kwargs):
+        calls.append((args, kwargs))
+"""
+
+
+@pytest.fixture
+def fake_extension_module(monkeypatch, tmpdir):
+    """Importable ``fake_extension`` module that records calls to ``func``."""
+    directory = tmpdir.mkdir("site")
+    f = directory.join("fake_extension.py")
+    f.write_text(dedent(FAKE_EXTENSION_SOURCE), encoding="utf8")
+    monkeypatch.syspath_prepend(directory.strpath)
+    monkeypatch.delitem(sys.modules, "fake_extension", raising=False)
+    yield directory
+    sys.modules.pop("fake_extension", None)
+
+
+@pytest.fixture
+def fake_package(fake_extension_module):
+    """Importable ``fake_package`` with a ``sub`` module, which holds on to
+    some memory.
+    """
+    package = fake_extension_module.mkdir("fake_package")
+    package.join("__init__.py").write_text(
+        "from . import sub\nimport json\ndata = [0] * 100000\n",
+        encoding="utf8"
+    )
+    package.join("sub.py").write_text("value = 42\n", encoding="utf8")
+    yield package
+    sys.modules.pop("fake_package", None)
+    sys.modules.pop("fake_package.sub", None)
+
+
+class FakeShell:
+    def __init__(self):
+        self.user_ns = {}
+
+
+@pytest.fixture
+def fake_shell():
+    yield FakeShell()
+
+
 @pytest.fixture
-def jinja_env():
-    yield _globals.__getattr__("jinja_env")
+def ipython_shell():
+    from IPython.core.interactiveshell import InteractiveShell
+    yield InteractiveShell.instance()
+    InteractiveShell.clear_instance()
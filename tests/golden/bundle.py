@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# Generated by jupyter_kernel_hook (bundle)
+def __jupyter_kernel_hook() -> None:
+    """Run every bundled hook from a single manifest.
+
+    We hide everything behind a function to locally scope these objects.
+    Otherwise they will be imported into the Notebook instance!
+    """
+    from jupyter_kernel_hook import runtime
+    runtime.run('/path/to/startup/jupyter_kernel_hook.json')  # noqa: E501
+
+
+__jupyter_kernel_hook()
+del __jupyter_kernel_hook
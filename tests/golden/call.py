@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by jupyter_kernel_hook: fake_extension
+def __jupyter_kernel_hook() -> None:
+    """We want to check if the extension is enabled before importing.
+
+    We hide everything behind a function to locally scope these objects.
+    Otherwise they will be imported into the Notebook instance!
+    """
+    from jupyter_kernel_hook import extension_is_enabled
+    if extension_is_enabled("fake_extension"):
+        def load():
+            from fake_extension import func
+            func()
+
+        import os
+        if any(os.environ.get(i) for i in (
+            "JUPYTER_KERNEL_HOOK_TIME_BUDGET",
+            "JUPYTER_KERNEL_HOOK_MEMORY_BUDGET",
+            "JUPYTER_KERNEL_HOOK_TOTAL_TIME_BUDGET",
+            "JUPYTER_KERNEL_HOOK_TOTAL_MEMORY_BUDGET",
+        )):
+            from jupyter_kernel_hook.runtime import Hook, run_hook
+            run_hook(Hook("fake_extension"), load=load)
+        else:
+            from jupyter_kernel_hook.stats import record_hook
+            with record_hook("fake_extension"):
+                load()
+
+
+__jupyter_kernel_hook()
+del __jupyter_kernel_hook
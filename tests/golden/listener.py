@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# Generated by jupyter_kernel_hook (listener)
+def __jupyter_kernel_hook() -> None:
+    """Accept the hooks that the server pushes.
+
+    We hide everything behind a function to locally scope these objects.
+    Otherwise they will be imported into the Notebook instance!
+    """
+    from jupyter_kernel_hook.listener import listen
+    listen()
+
+
+__jupyter_kernel_hook()
+del __jupyter_kernel_hook
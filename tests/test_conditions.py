@@ -0,0 +1,152 @@
+import sys
+import json
+from unittest.mock import patch
+
+import pytest
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import conditions
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import pool
+from jupyter_kernel_hook import runtime
+from jupyter_kernel_hook.__main__ import main as cli_main
+
+
+@pytest.fixture(autouse=True)
+def reset_kernel_name(monkeypatch):
+    monkeypatch.delenv(conditions.KERNEL_NAME_ENV_VAR, raising=False)
+    monkeypatch.setattr(conditions, "_kernel_name", conditions._unknown)
+    yield
+
+
+@pytest.fixture
+def kernel_named(monkeypatch, tmpdir):
+    """Pretend to be a kernel started with a connection file."""
+    def set_name(name):
+        connection_file = tmpdir.join("kernel-1234.json")
+        connection_file.write_text(
+            json.dumps({"kernel_name": name, "shell_port": 1}),
+            encoding="utf8"
+        )
+        monkeypatch.setattr(sys, "argv", [
+            "ipykernel_launcher.py", "-f", connection_file.strpath
+        ])
+        conditions._kernel_name = conditions._unknown
+    return set_name
+
+
+def test_normalize():
+    assert conditions.normalize({}) is None
+    assert conditions.normalize({
+        "kernel_name": "python3", "env": {"CI": None}
+    }) == {"kernel_name": ["python3"], "env": {"CI": None}}
+    with pytest.raises(ValueError, match="Unknown conditions"):
+        conditions.normalize({"kernel": "python3"})
+    with pytest.raises(ValueError):
+        conditions.normalize({"kernel_name": []})
+    with pytest.raises(ValueError):
+        conditions.normalize({"env": {"CI": True}})
+    with pytest.raises(ValueError):
+        core.HookSpec("fake_extension", conditions={"executable": [1]})
+
+
+def test_match():
+    assert conditions.match("python3", ["python*"])
+    assert not conditions.match("python3", ["!python*"])
+    assert conditions.match("analysis", ["!papermill-*"])
+    assert not conditions.match("papermill-1", ["*", "!papermill-*"])
+    assert not conditions.match(None, ["!papermill-*"])
+
+
+def test_kernel_name(kernel_named, monkeypatch):
+    assert conditions.kernel_name() is None
+    kernel_named("analysis")
+    assert conditions.kernel_name() == "analysis"
+    monkeypatch.setattr(sys, "argv", ["x", "--f=/not/a/file.json"])
+    conditions._kernel_name = conditions._unknown
+    assert conditions.kernel_name() is None
+    monkeypatch.setenv(conditions.KERNEL_NAME_ENV_VAR, "python3")
+    conditions._kernel_name = conditions._unknown
+    assert conditions.kernel_name() == "python3"
+
+
+def test_matches(kernel_named, monkeypatch):
+    kernel_named("python3")
+    monkeypatch.setenv("DISPLAY", ":0")
+    monkeypatch.delenv("CI", raising=False)
+    assert conditions.matches(None)
+    assert conditions.matches({
+        "kernel_name": ["python3"],
+        "env": {"DISPLAY": "*", "CI": None},
+        "executable": [sys.executable]
+    })
+    assert not conditions.matches({"kernel_name": ["!python3"]})
+    assert not conditions.matches({"env": {"CI": "*"}})
+    assert not conditions.matches({"env": {"DISPLAY": None}})
+    assert not conditions.matches({"executable": ["*/not-this-python"]})
+
+
+def test_script_conditions(nb_app, ipython_scripts_dir, kernel_named,
+                           ipython_shell, fake_extension_module):
+    core.main(nb_app, "fake_extension:func()",
+              conditions={"kernel_name": "!batch-*"})
+    script = ipython_scripts_dir.join("50-fake_extension.py")
+    assert pool._script_conditions(script.strpath) == {
+        "kernel_name": ["!batch-*"]
+    }
+
+    kernel_named("batch-small")
+    ipython_shell.safe_execfile(script.strpath, ipython_shell.user_ns)
+    assert "fake_extension" not in sys.modules
+
+    kernel_named("python3")
+    ipython_shell.safe_execfile(script.strpath, ipython_shell.user_ns)
+    import fake_extension
+    assert fake_extension.calls == [((), {})]
+
+
+def test_runtime_run_conditions(monkeypatch, nb_app, ipython_scripts_dir,
+                                fake_shell, fake_extension_module):
+    core.main(nb_app, "fake_extension:func()", bundle=True,
+              conditions={"env": {"INTERACTIVE": "1"}})
+    manifest_path = ipython_scripts_dir.join(_globals.MANIFEST_FILENAME)
+    [hook] = runtime.load_manifest(manifest_path.strpath)
+    assert hook.conditions == {"env": {"INTERACTIVE": "1"}}
+
+    monkeypatch.delenv("INTERACTIVE", raising=False)
+    with patch.object(runtime.Hook, "import_module") as import_module:
+        runtime.run(manifest_path.strpath, ip=fake_shell)
+    import_module.assert_not_called()
+
+    monkeypatch.setenv("INTERACTIVE", "1")
+    runtime.run(manifest_path.strpath, ip=fake_shell)
+    import fake_extension
+    assert fake_extension.calls == [((), {})]
+
+
+def test_warm_hooks_skips_per_kernel(nb_app, ipython_scripts_dir,
+                                     fake_extension_module):
+    core.main(nb_app, "fake_extension",
+              conditions={"kernel_name": "python3"})
+    with patch.object(_globals, "hook_dirs",
+                      return_value=[ipython_scripts_dir.strpath]):
+        assert pool._warm_hooks() == []
+    assert "fake_extension" not in sys.modules
+
+
+def test_cli_install_shared_conditions(tmpdir):
+    shared_dir = tmpdir.join("cli_shared")
+    assert cli_main([
+        "install-shared", "fake_extension",
+        "--shared-dir", shared_dir.strpath,
+        "--ipython-config-dir", tmpdir.strpath,
+        "--kernel-name", "python3", "--kernel-name", "!papermill-*",
+        "--env", "DISPLAY", "--env", "MODE=interactive", "--unset-env", "CI"
+    ]) == 0
+    manifest = core.read_manifest(
+        shared_dir.join(_globals.MANIFEST_FILENAME).strpath
+    )
+    assert manifest["hooks"]["fake_extension"]["conditions"] == {
+        "kernel_name": ["python3", "!papermill-*"],
+        "env": {"DISPLAY": "*", "MODE": "interactive", "CI": None}
+    }
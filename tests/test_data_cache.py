@@ -0,0 +1,152 @@
+import os
+import time
+import array
+import threading
+
+import pytest
+
+from jupyter_kernel_hook import data_cache
+
+
+def _new_kernel():
+    """Forget the entries this process mapped, like a fresh kernel."""
+    data_cache._mapped.clear()
+
+
+def test_get_bytes():
+    builds = []
+
+    def build():
+        builds.append(True)
+        return b"reference table"
+
+    view = data_cache.get("my_package", "table", build, version="1.0")
+    assert bytes(view) == b"reference table"
+    assert view.readonly
+
+    _new_kernel()
+    view = data_cache.get("my_package", "table", build, version="1.0")
+    assert bytes(view) == b"reference table"
+    assert builds == [True]
+
+
+def test_get_array():
+    a = array.array("d", [1.5, 2.5, 3.5])
+    view = data_cache.get("my_package", "floats", lambda: a, version="1.0")
+    assert view.format == "d"
+    assert view.tolist() == [1.5, 2.5, 3.5]
+
+    empty = data_cache.get("my_package", "empty", lambda: b"", version="1.0")
+    assert bytes(empty) == b""
+
+
+def test_get_ndarray():
+    np = pytest.importorskip("numpy")
+    a = np.arange(12, dtype="<i4").reshape(3, 4)
+    data_cache.get("my_package", "ints", lambda: a, version="1.0")
+    _new_kernel()
+    mapped = data_cache.get("my_package", "ints", None, version="1.0")
+    assert (mapped == a).all() and mapped.dtype == a.dtype
+    assert not mapped.flags.writeable
+
+
+def test_concurrent_first_build():
+    builds = []
+
+    def build():
+        builds.append(True)
+        time.sleep(0.1)
+        return b"x" * 1000
+
+    results = []
+
+    def get():
+        results.append(bytes(
+            data_cache.get("my_package", "table", build, version="1.0")
+        ))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert builds == [True]
+    assert results == [b"x" * 1000] * 8
+
+
+def test_new_version(monkeypatch):
+    old = data_cache.entry_path("my_package", "table", version="1.0")
+    data_cache.get("my_package", "table", lambda: b"old", version="1.0")
+    os.utime(old[:-len(data_cache.DATA_SUFFIX)] + data_cache.META_SUFFIX,
+             (0, 0))
+    new = data_cache.get("my_package", "table", lambda: b"new", version="2.0")
+    assert bytes(new) == b"new"
+    # Entries of other versions are left to eviction, and they're the first
+    # to go since they aren't used anymore.
+    assert os.path.exists(old)
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_DATA_CACHE_SIZE", "4")
+    data_cache.get("my_package", "other", lambda: b"x", version="2.0")
+    assert not os.path.exists(old)
+    assert os.path.exists(
+        data_cache.entry_path("my_package", "table", version="2.0")
+    )
+    # Kernels may be waiting on the lock files, so they stay.
+    assert os.path.exists(old + ".lock")
+
+
+def test_get_evicted_meanwhile(monkeypatch):
+    """An entry evicted between reading its metadata and mapping it is
+    built again."""
+    data_cache.get("my_package", "table", lambda: b"old", version="1.0")
+    _new_kernel()
+    path = data_cache.entry_path("my_package", "table", version="1.0")
+    read_meta = data_cache._read_meta
+    evicted = []
+
+    def read_meta_then_evict(p):
+        meta = read_meta(p)
+        if meta is not None and not evicted:
+            data_cache.remove(path)
+            evicted.append(p)
+        return meta
+
+    monkeypatch.setattr(data_cache, "_read_meta", read_meta_then_evict)
+    view = data_cache.get("my_package", "table", lambda: b"new",
+                          version="1.0")
+    assert bytes(view) == b"new"
+    assert evicted == [path]
+
+
+def test_evict(monkeypatch):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_DATA_CACHE_SIZE", "2K")
+    paths = []
+    for i, key in enumerate(["a", "b", "c"]):
+        data_cache.get("my_package", key, lambda: b"x" * 1000, version="1.0")
+        path = data_cache.entry_path("my_package", key, version="1.0")
+        meta = path[:-len(data_cache.DATA_SUFFIX)] + data_cache.META_SUFFIX
+        os.utime(meta, (i, i))
+        paths.append(path)
+
+    # The least recently used entry went first.
+    assert [os.path.exists(i) for i in paths] == [False, True, True]
+
+    # The entry that was just built is kept, even if it's too big.
+    data_cache.get("my_package", "d", lambda: b"x" * 4000, version="1.0")
+    assert os.path.exists(data_cache.entry_path("my_package", "d", "1.0"))
+    assert data_cache.evict(limit=0) == [
+        data_cache.entry_path("my_package", "d", "1.0")
+    ]
+
+
+def test_clear():
+    data_cache.get("my_package", "table", lambda: b"x", version="1.0")
+    data_cache.get("other_package", "table", lambda: b"x", version="1.0")
+    data_cache.clear("my_package")
+    path = data_cache.entry_path("my_package", "table", version="1.0")
+    assert not os.path.exists(path)
+    assert os.path.exists(path + ".lock")
+    assert os.path.exists(
+        data_cache.entry_path("other_package", "table", version="1.0")
+    )
+    data_cache.clear()
+    assert data_cache._entries() == []
@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import contextlib
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from jupyter_client import KernelManager
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import hotapply
+from jupyter_kernel_hook import listener
+from jupyter_kernel_hook import stats
+
+
+@pytest.fixture
+def other_extension(fake_extension_module):
+    fake_extension_module.join("other_extension.py").write_text(
+        "calls = []\n\n\ndef func():\n    calls.append(True)\n",
+        encoding="utf8"
+    )
+    yield
+    sys.modules.pop("other_extension", None)
+
+
+def test_apply_script(nb_app, ipython_scripts_dir, ipython_shell,
+                      fake_extension_module):
+    core.main(nb_app, "fake_extension:func()")
+    data = {
+        "enabled": ["fake_extension"],
+        "scripts": [ipython_scripts_dir.join("50-fake_extension.py").strpath],
+        "manifests": []
+    }
+    assert hotapply.apply(data, ip=ipython_shell) == ["fake_extension"]
+    # Applying again does nothing.
+    assert hotapply.apply(data, ip=ipython_shell) == []
+
+    import fake_extension
+    assert fake_extension.calls == [((), {})]
+    assert _globals.__getattr__("enabled_server_extensions") == {
+        "fake_extension"
+    }
+
+
+def test_apply_bundle(nb_app, ipython_scripts_dir, fake_shell,
+                      fake_extension_module, other_extension):
+    nb_app.nbserver_extensions["other_extension"] = True
+    core.main(nb_app, "fake_extension:func()", bundle=True)
+    core.main(nb_app, "other_extension:func()", bundle=True)
+    manifest_path = ipython_scripts_dir.join(_globals.MANIFEST_FILENAME)
+    # As if ``fake_extension`` had run at startup.
+    stats.records.append(stats.HookRecord(path="fake_extension"))
+
+    data = {
+        "enabled": ["fake_extension", "other_extension"],
+        "scripts": [],
+        "manifests": [manifest_path.strpath]
+    }
+    assert hotapply.apply(data, ip=fake_shell) == ["other_extension"]
+    assert hotapply.apply(data, ip=fake_shell) == []
+    assert "fake_extension" not in sys.modules
+
+
+def test_apply_disabled(nb_app, ipython_scripts_dir, ipython_shell,
+                        fake_extension_module):
+    core.main(nb_app, "fake_extension:func()")
+    data = {
+        "enabled": [],
+        "scripts": [ipython_scripts_dir.join("50-fake_extension.py").strpath],
+    }
+    assert hotapply.apply(data, ip=ipython_shell) == []
+    assert "fake_extension" not in sys.modules
+
+
+def test_apply_not_matching(nb_app, ipython_scripts_dir, ipython_shell,
+                            fake_extension_module, monkeypatch):
+    """A script whose conditions don't match doesn't count as applied, so it
+    can still run if they match later."""
+    monkeypatch.delenv("JUPYTER_KERNEL_HOOK_TEST", raising=False)
+    core.main(nb_app, "fake_extension:func()",
+              conditions={"env": {"JUPYTER_KERNEL_HOOK_TEST": "*"}})
+    data = {
+        "enabled": ["fake_extension"],
+        "scripts": [ipython_scripts_dir.join("50-fake_extension.py").strpath],
+    }
+    assert hotapply.apply(data, ip=ipython_shell) == []
+    assert "fake_extension" not in hotapply.applied_hooks()
+
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_TEST", "1")
+    assert hotapply.apply(data, ip=ipython_shell) == ["fake_extension"]
+
+
+def test_listen(tmpdir, monkeypatch):
+    manager = SimpleNamespace(register_target=lambda *args: None)
+    ip = SimpleNamespace(kernel=SimpleNamespace(comm_manager=manager))
+    assert listener.listen(ip)
+    assert listener.listen(ip)
+    assert listener._listening == [manager]
+    # Not in a kernel.
+    assert not listener.listen(SimpleNamespace())
+
+
+def test_install_listener(nb_app, ipython_scripts_dir):
+    assert hotapply.install_listener()
+    assert not hotapply.install_listener()
+    script = ipython_scripts_dir.join(_globals.LISTENER_FILENAME)
+    assert "listen()" in script.read_text(encoding="utf8")
+    # It isn't a hook, so reconciling leaves it alone.
+    assert core.generated_for(script.strpath) is None
+    core.reconcile_app(nb_app)
+    assert script.check()
+
+
+def test_watcher_poll(nb_app, ipython_scripts_dir, jupyter_config_dir,
+                      tmpdir):
+    listeners_dir = tmpdir.mkdir("listeners")
+    nb_app.kernel_manager = SimpleNamespace(
+        list_kernel_ids=lambda: ["k1", "k2"],
+        get_kernel=lambda kernel_id: SimpleNamespace(
+            connection_file=f"/runtime/kernel-{kernel_id}.json"
+        )
+    )
+    # Only ``k1`` listens.
+    listeners_dir.join("kernel-k1.json").ensure()
+    watcher = hotapply.Watcher(nb_app, listeners_dir=listeners_dir.strpath)
+    with patch.object(hotapply, "send") as send:
+        assert watcher.poll() is None
+        send.assert_not_called()
+
+        core.main(nb_app, "fake_extension")
+        assert watcher.poll() == ["k1"]
+        assert send.call_count == 1
+        data = send.call_args[0][1]
+        assert data["scripts"] == [
+            ipython_scripts_dir.join("50-fake_extension.py").strpath
+        ]
+        assert watcher.poll() is None
+
+        # Extensions enabled in the config are picked up too.
+        config = jupyter_config_dir.join("jupyter_notebook_config.json")
+        d = json.loads(config.read_text(encoding="utf8"))
+        d["NotebookApp"]["nbserver_extensions"]["new_extension"] = True
+        config.write_text(json.dumps(d), encoding="utf8")
+        assert watcher.poll() == ["k1"]
+        assert "new_extension" in send.call_args[0][1]["enabled"]
+
+
+def test_watcher_tick(nb_app, ipython_scripts_dir, tmpdir):
+    """Changes are looked for off the IO loop, and pushed from it."""
+    nb_app.kernel_manager = SimpleNamespace(list_kernel_ids=lambda: [])
+    watcher = hotapply.Watcher(nb_app, listeners_dir=tmpdir.strpath)
+    core.main(nb_app, "fake_extension")
+    threads = []
+    check = watcher.check
+
+    def check_in_thread():
+        threads.append(threading.current_thread())
+        return check()
+
+    async def tick():
+        watcher.tick()
+        checking = watcher._checking
+        # No second check while one is running.
+        watcher.tick()
+        assert watcher._checking is checking
+        while watcher._checking is not None:
+            await asyncio.sleep(0.01)
+
+    with patch.object(watcher, "check", check_in_thread), \
+            patch.object(watcher, "push", return_value=[]) as push:
+        asyncio.run(tick())
+    push.assert_called_once()
+    assert len(threads) == 1
+    assert threads[0] is not threading.current_thread()
+
+
+@pytest.fixture
+def kernel_startup_dir(monkeypatch, tmpdir):
+    ipython_dir = tmpdir.join("ipython")
+    startup_dir = ipython_dir.join("profile_default", "startup")
+    startup_dir.ensure(dir=True)
+    monkeypatch.setattr(_globals, "startup_dir", startup_dir.strpath)
+    yield startup_dir
+
+
+@contextlib.contextmanager
+def running_kernel(startup_dir, enabled):
+    """Start a real kernel that runs ``startup_dir``, with only ``enabled``
+    extensions enabled. Yields the kernel manager and a function that
+    evaluates an expression in the kernel.
+    """
+    hotapply.install_listener(startup_dir.strpath)
+    listeners_dir = startup_dir.dirpath().dirpath().dirpath().mkdir(
+        "listeners"
+    )
+    env = dict(os.environ)
+    env.update({
+        "IPYTHONDIR": startup_dir.dirpath().dirpath().strpath,
+        "PYTHONPATH": os.pathsep.join(i for i in sys.path if i),
+        _globals.ENABLED_EXTENSIONS_ENV_VAR: json.dumps(enabled),
+        listener.LISTENERS_DIR_ENV_VAR: listeners_dir.strpath
+    })
+    km = KernelManager()
+    km.start_kernel(env=env)
+    client = km.client()
+    client.start_channels()
+    try:
+        client.wait_for_ready(timeout=30)
+        watcher = hotapply.Watcher(
+            SimpleNamespace(nbserver_extensions={}),
+            listeners_dir=listeners_dir.strpath
+        )
+        assert watcher.listening(km)
+
+        def evaluate(code):
+            reply = client.execute(
+                "", user_expressions={"x": code}, reply=True, timeout=30
+            )
+            return reply["content"]["user_expressions"]["x"]["data"][
+                "text/plain"
+            ]
+
+        yield km, evaluate
+    finally:
+        client.stop_channels()
+        km.shutdown_kernel(now=True)
+
+
+def wait_for(evaluate, code, expected, timeout=30):
+    deadline = time.monotonic() + timeout
+    while evaluate(code) != expected:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+def test_hot_apply_running_kernel(nb_app, kernel_startup_dir,
+                                  fake_extension_module, other_extension):
+    """A kernel started with one bundled hook gets the second one without
+    restarting, and keeps its state."""
+    core.main(nb_app, "fake_extension:func()", bundle=True)
+
+    with running_kernel(kernel_startup_dir, ["fake_extension"]) as (
+            km, evaluate
+    ):
+        loaded = "'other_extension' in __import__('sys').modules"
+        evaluate("globals().__setitem__('state', 42)")
+        assert evaluate(loaded) == "False"
+
+        nb_app.nbserver_extensions["other_extension"] = True
+        core.main(nb_app, "other_extension:func()", bundle=True)
+        hotapply.send(km, {
+            "enabled": ["fake_extension", "other_extension"],
+            "scripts": [],
+            "manifests": [
+                kernel_startup_dir.join(_globals.MANIFEST_FILENAME).strpath
+            ]
+        })
+
+        wait_for(evaluate, loaded, "True")
+        assert evaluate("__import__('other_extension').calls") == "[True]"
+        assert evaluate("__import__('fake_extension').calls") == "[((), {})]"
+        assert evaluate("state") == "42"
+
+
+def test_hot_apply_disabled_at_start(nb_app, kernel_startup_dir,
+                                     fake_extension_module, other_extension):
+    """A kernel whose only hook was disabled when it started still gets the
+    hook once it's enabled."""
+    nb_app.nbserver_extensions["other_extension"] = True
+    core.main(nb_app, "other_extension:func()")
+    script = kernel_startup_dir.join("50-other_extension.py")
+
+    with running_kernel(kernel_startup_dir, []) as (km, evaluate):
+        loaded = "'other_extension' in __import__('sys').modules"
+        assert evaluate(loaded) == "False"
+
+        hotapply.send(km, {
+            "enabled": ["other_extension"],
+            "scripts": [script.strpath],
+            "manifests": []
+        })
+
+        wait_for(evaluate, loaded, "True")
+        assert evaluate("__import__('other_extension').calls") == "[True]"
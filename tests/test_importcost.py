@@ -0,0 +1,138 @@
+import sys
+from unittest.mock import patch
+
+import pytest
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import importcost
+from jupyter_kernel_hook.__main__ import main as cli_main
+
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 | json
+jupyter_kernel_hook: import starts
+import time:       300 |        300 |     heavy.sub
+import time:      1500 |       1800 |   heavy
+import time:        50 |       1850 | fake_package
+"""
+
+
+def test_parse_importtime():
+    assert importcost.parse_importtime(IMPORTTIME_OUTPUT) == [
+        ("heavy.sub", 0.0003, 0.0003),
+        ("heavy", 0.0015, 0.0018),
+        ("fake_package", 0.00005, 0.00185),
+    ]
+
+
+def test_profile(fake_package):
+    cost = importcost.profile("fake_package")
+    names = [name for name, _, _ in cost.top]
+    assert set(names) == {"fake_package", "fake_package.sub"}
+    assert cost.modules == 2
+    assert cost.seconds > 0
+    # The list of 100000 references.
+    assert cost.memory > 800000
+    assert cost.peak_memory >= cost.memory
+    assert "fake_package" not in sys.modules
+
+    with pytest.raises(RuntimeError, match="Trial import"):
+        importcost.profile("not_a_real_package")
+
+
+def test_history(fake_package):
+    with patch.object(_globals, "package_version", return_value="1.0"):
+        cost = importcost.measure("fake_package")
+        assert not cost.cached
+        with patch.object(importcost, "profile") as profile:
+            assert importcost.measure("fake_package").cached
+        profile.assert_not_called()
+
+    with patch.object(_globals, "package_version", return_value="2.0"):
+        new = importcost.measure("fake_package")
+        assert not new.cached
+    assert [i.version for i in importcost.history("fake_package")] == [
+        "1.0", "2.0"
+    ]
+
+    # Packages without a version are measured again once their files change.
+    assert not importcost.measure("fake_package").cached
+    assert importcost.measure("fake_package").cached
+    fake_package.join("sub.py").write_text("value = 420\n", encoding="utf8")
+    assert not importcost.measure("fake_package").cached
+    assert [i.version for i in importcost.history("fake_package")] == [
+        "1.0", "2.0", None
+    ]
+
+    # So is a changed script.
+    assert not importcost.measure(
+        "fake_package", script="import fake_package.sub\n"
+    ).cached
+
+
+def test_profile_script(fake_extension_module):
+    """The startup script runs against a shell, and its call counts."""
+    fake_extension_module.join("slow_call.py").write_text(
+        "import time\n\n\ndef load(ip):\n"
+        "    assert ip is not None\n"
+        "    time.sleep(0.2)\n",
+        encoding="utf8"
+    )
+    script = core.render_startup_script(
+        core.ScriptInfo.from_str("slow_call:load(ip)")
+    )
+    cost = importcost.profile("slow_call", script=script)
+    assert cost.seconds >= 0.2
+    assert [name for name, _, _ in cost.top] == ["slow_call"]
+
+
+def test_check(monkeypatch):
+    old = importcost.ImportCost("heavy", version="1.0", seconds=0.5,
+                                memory=2 ** 20)
+    importcost.record(old)
+    cost = importcost.ImportCost(
+        "heavy", version="2.0", seconds=2.5, memory=2 ** 20,
+        top=[["heavy.sub", 2.0, 2.0], ["heavy", 0.5, 2.5]]
+    )
+    [message] = importcost.check(cost)
+    assert "takes 2.50s (version 1.0: 0.50s)" in message
+    assert "heavy.sub 2.000s, heavy 0.500s" in message
+
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_IMPORT_TIME_WARNING", "10")
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_IMPORT_MEMORY_WARNING", "512K")
+    [message] = importcost.check(cost)
+    assert "adds 1.0MiB (version 1.0: 1.0MiB) to every kernel" in message
+
+
+def test_core_main_profile(monkeypatch, nb_app, ipython_scripts_dir,
+                           fake_extension_module):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_IMPORT_TIME_WARNING", "0")
+    with patch.object(nb_app.log, "warning") as warning:
+        core.main(nb_app, "fake_extension:func()", profile=True)
+    assert "Importing 'fake_extension' takes" in warning.call_args[0][0]
+    assert [i.path for i in importcost.history("fake_extension")] == [
+        "fake_extension"
+    ]
+    assert ipython_scripts_dir.join("50-fake_extension.py").check()
+    assert "fake_extension" not in sys.modules
+
+
+def test_core_main_profile_error(nb_app, ipython_scripts_dir):
+    nb_app.nbserver_extensions["not_a_real_package"] = True
+    with patch.object(nb_app.log, "warning") as warning:
+        core.main(nb_app, "not_a_real_package", profile=True)
+    assert "Could not profile" in warning.call_args[0][0]
+
+
+def test_cli_profile(capsys, fake_package):
+    assert cli_main(["profile", "fake_package"]) == 0
+    out = capsys.readouterr().out
+    assert "fake_package: " in out
+    assert "fake_package.sub" in out
+
+    assert cli_main(["profile", "--history", "fake_package"]) == 0
+    assert capsys.readouterr().out.startswith("fake_package: ")
+
+    assert cli_main(["profile", "not_a_real_package"]) == 1
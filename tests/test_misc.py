@@ -1,3 +1,9 @@
+import os
+import sys
+import json
+from pathlib import PurePath
+from importlib import metadata
+from unittest.mock import Mock
 from unittest.mock import patch
 
 import pytest
@@ -24,3 +30,247 @@ def test_app_extensions(nb_app):
     assert core._app_enabled_extensions(nb_app, "fake_extension")
     assert not core._app_enabled_extensions(nb_app, "fake_fake_extension")
     assert not core._app_enabled_extensions(nb_app, "disabled_extension")
+
+
+def test_enabled_extensions_cache(jupyter_config_dir):
+    assert _globals._get_enabled_server_extensions() == {"fake_extension"}
+    assert _globals._read_enabled_cache() == {"fake_extension"}
+
+    # A warm cache means the config files are never parsed.
+    with patch.object(_globals, "_scan_enabled_server_extensions") as scan:
+        assert _globals._get_enabled_server_extensions() == {"fake_extension"}
+        scan.assert_not_called()
+
+    # Changing a config file invalidates the cache.
+    d = core.jupyter_config_json("other_extension")
+    cfg_file = jupyter_config_dir.join("jupyter_notebook_config.json")
+    cfg_file.write_text(json.dumps(d), encoding="utf8")
+    assert _globals._read_enabled_cache() is None
+    assert _globals._get_enabled_server_extensions() == {"other_extension"}
+
+
+def test_enabled_extensions_cache_drop_in(jupyter_config_dir):
+    _globals._get_enabled_server_extensions()
+
+    # New files in the ``.d`` directory invalidate the cache too.
+    d = core.jupyter_config_json("drop_in_extension")
+    drop_in = jupyter_config_dir.mkdir("jupyter_notebook_config.d")
+    drop_in.join("drop_in.json").write_text(json.dumps(d), encoding="utf8")
+    assert _globals._read_enabled_cache() is None
+    assert _globals._get_enabled_server_extensions() == {
+        "fake_extension",
+        "drop_in_extension"
+    }
+
+
+def test_enabled_extensions_cache_disabled(monkeypatch, enabled_cache_dir):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_NO_CACHE", "1")
+    assert _globals._get_enabled_server_extensions() == {"fake_extension"}
+    assert enabled_cache_dir.listdir() == []
+
+
+def test_export_enabled_extensions(monkeypatch, nb_app):
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, "")
+    core.export_enabled_extensions(nb_app)
+
+    # The kernel trusts the server's answer and never scans the config files.
+    with patch.object(_globals, "_scan_enabled_server_extensions") as scan:
+        assert _globals._get_enabled_server_extensions() == {"fake_extension"}
+        scan.assert_not_called()
+
+
+def test_export_enabled_extensions_invalid(monkeypatch):
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, "not json")
+    assert _globals._get_enabled_server_extensions() == {"fake_extension"}
+
+
+layered_config_files = [
+    {
+        "jupyter_notebook_config.json": {
+            "NotebookApp": {"nbserver_extensions": {"a": True, "b": True}}
+        },
+        "jupyter_notebook_config.d/10-c.json": {
+            "NotebookApp": {"nbserver_extensions": {"c": True, "a": False}}
+        },
+        "jupyter_notebook_config.d/20-d.json": {
+            "NotebookApp": {"nbserver_extensions": {"d": True, "c": None}}
+        },
+    },
+    {
+        "jupyter_notebook_config.json": {
+            "NotebookApp": {"nbserver_extensions": {"b": None}}
+        },
+        "jupyter_notebook_config.d/e.json": {
+            "NotebookApp": {"nbserver_extensions": {"e": True}},
+            "Other": {"nested": {"x": 1}}
+        },
+        "jupyter_notebook_config.d/not_json.txt": {"ignored": True},
+    },
+    {},
+]
+
+
+@pytest.fixture
+def layered_config_dirs(tmpdir):
+    directories = []
+    for n, files in enumerate(layered_config_files):
+        directory = tmpdir.mkdir(f"layer{n}")
+        for name, data in files.items():
+            f = directory.join(name)
+            f.dirpath().ensure(dir=True)
+            f.write_text(json.dumps(data), encoding="utf8")
+        directories.append(directory.strpath)
+    yield directories
+
+
+def test_read_config_section_matches_notebook(layered_config_dirs):
+    from notebook.config_manager import BaseJSONConfigManager
+
+    for config_dir in layered_config_dirs:
+        cm = BaseJSONConfigManager(config_dir=config_dir)
+        section = "jupyter_notebook_config"
+        expected = cm.get(section)
+        assert _globals._read_config_section(config_dir, section) == expected
+
+
+def test_scan_enabled_server_extensions(monkeypatch, layered_config_dirs):
+    import jupyter_core.paths
+
+    server_cfg = os.path.join(layered_config_dirs[-1], "jupyter_server_config.json")
+    with open(server_cfg, "w", encoding="utf8") as f:
+        json.dump({"ServerApp": {"jpserver_extensions": {"f": True}}}, f)
+
+    monkeypatch.setattr(
+        jupyter_core.paths,
+        "jupyter_config_path",
+        lambda: layered_config_dirs
+    )
+    s, config_dirs = _globals._scan_enabled_server_extensions()
+    assert s == {"a", "b", "d", "e", "f"}
+    assert config_dirs == layered_config_dirs
+
+
+def test_find_startup_dir(monkeypatch, tmpdir):
+    from IPython.paths import get_ipython_dir
+    from IPython.core.profiledir import ProfileDir
+
+    ipython_dir = tmpdir.join("ipython")
+    monkeypatch.setenv("IPYTHONDIR", ipython_dir.strpath)
+    assert _globals.get_ipython_dir() == get_ipython_dir()
+
+    # The profile directory is created when it doesn't exist.
+    startup_dir = _globals.find_startup_dir("jkh_test", ipython_dir.strpath)
+    assert os.path.isdir(startup_dir)
+    profile_dir = ProfileDir.find_profile_dir_by_name(
+        ipython_dir.strpath,
+        "jkh_test"
+    )
+    assert startup_dir == profile_dir.startup_dir
+
+    # Memoized, so the filesystem is only touched once.
+    with patch.object(os, "makedirs") as makedirs:
+        assert _globals.find_startup_dir(
+            "jkh_test",
+            ipython_dir.strpath
+        ) == startup_dir
+        makedirs.assert_not_called()
+
+
+def test_get_startup_dir_overrides(monkeypatch, tmpdir):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_STARTUP_DIR", tmpdir.strpath)
+    assert _globals._get_startup_dir() == tmpdir.strpath
+
+    monkeypatch.delenv("JUPYTER_KERNEL_HOOK_STARTUP_DIR")
+    monkeypatch.setenv("IPYTHONDIR", tmpdir.strpath)
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_PROFILE", "other")
+    assert _globals._get_startup_dir() == \
+        tmpdir.join("profile_other", "startup").strpath
+
+
+@pytest.fixture
+def packages_distributions():
+    _globals._packages_distributions.cache_clear()
+    yield
+    _globals._packages_distributions.cache_clear()
+
+
+def test_package_version(packages_distributions):
+    """The version comes from the distribution that provides the package,
+    which may be named differently."""
+    versions = {"PyYAML": "6.0", "fake_extension": "1.0"}
+
+    def version(name):
+        if name not in versions:
+            raise metadata.PackageNotFoundError(name)
+        return versions[name]
+
+    with patch.object(metadata, "packages_distributions", create=True,
+                      return_value={"yaml": ["PyYAML"]}), \
+            patch.object(metadata, "version", version):
+        assert _globals.package_version("yaml.constructor") == "6.0"
+        assert _globals.package_version("fake_extension") == "1.0"
+        assert _globals.package_version("not_installed") is None
+
+
+def test_package_version_fallback(monkeypatch, packages_distributions):
+    """Before Python 3.10, the distributions are scanned directly."""
+    monkeypatch.delattr(metadata, "packages_distributions", raising=False)
+    dists = [
+        Mock(metadata={"Name": "PyYAML"},
+             read_text=lambda name: "_yaml\nyaml\n"),
+        Mock(metadata={"Name": "attrs"}, read_text=lambda name: None,
+             files=[PurePath("attr/__init__.py"), PurePath("six.py"),
+                    PurePath("attrs-1.0.dist-info/RECORD")]),
+    ]
+    with patch.object(metadata, "distributions", return_value=dists):
+        assert _globals._packages_distributions() == {
+            "_yaml": ["PyYAML"], "yaml": ["PyYAML"],
+            "attr": ["attrs"], "six": ["attrs"]
+        }
+
+
+def test_metadata_backport(monkeypatch):
+    """Before Python 3.8, the ``importlib_metadata`` backport is used."""
+    import importlib
+    from types import ModuleType
+    backport = ModuleType("importlib_metadata")
+    monkeypatch.delattr(importlib, "metadata")
+    monkeypatch.setitem(sys.modules, "importlib.metadata", None)
+    monkeypatch.setitem(sys.modules, "importlib_metadata", backport)
+    assert _globals._metadata() is backport
+
+
+def test_file_lock_windows_errors(monkeypatch, tmpdir):
+    """On Windows, contention is retried, and other errors are raised."""
+    import errno
+    import sys
+    from types import SimpleNamespace
+
+    errors = [OSError(errno.EDEADLK, "busy"), OSError(errno.EBADF, "bad")]
+    calls = []
+
+    def locking(fd, mode, nbytes):
+        calls.append(mode)
+        if mode == "lock" and errors:
+            raise errors.pop(0)
+
+    msvcrt = SimpleNamespace(LK_LOCK="lock", LK_UNLCK="unlock",
+                             locking=locking)
+    monkeypatch.setitem(sys.modules, "msvcrt", msvcrt)
+    monkeypatch.setattr(os, "name", "nt")
+    path = tmpdir.join("lock").strpath
+    with pytest.raises(OSError, match="bad"):
+        with _globals.file_lock(path):
+            pass
+    assert calls == ["lock", "lock"]
+
+    with _globals.file_lock(path):
+        pass
+    assert calls[2:] == ["lock", "unlock"]
+
+
+def test_cli_requires_command(capsys):
+    from jupyter_kernel_hook.__main__ import main as cli_main
+    with pytest.raises(SystemExit):
+        cli_main([])
+    assert "required" in capsys.readouterr().err
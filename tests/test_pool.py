@@ -0,0 +1,152 @@
+import os
+import sys
+import asyncio
+import threading
+from unittest.mock import patch
+
+import pytest
+from jupyter_client import BlockingKernelClient
+from jupyter_client.connect import write_connection_file
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import pool
+from jupyter_kernel_hook import provisioner
+
+pytestmark = pytest.mark.skipif(not pool.supported(), reason="requires fork")
+
+
+@pytest.fixture
+def kernel_pool(monkeypatch, ipython_scripts_dir, fake_extension_module):
+    # The template process finds the hooks through the environment.
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_STARTUP_DIR",
+                       ipython_scripts_dir.strpath)
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR,
+                       '["fake_extension"]')
+    # Like a kernel that has the hooked packages installed.
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(i for i in sys.path if i))
+    kernel_pool = pool.Pool(sys.executable)
+    yield kernel_pool
+    kernel_pool.stop()
+
+
+def test_kernel_argv():
+    cmd = [sys.executable, "-m", "ipykernel_launcher", "-f", "c.json"]
+    assert pool.kernel_argv(cmd) == ["-f", "c.json"]
+    assert pool.kernel_argv(["R", "--slave", "-e", "IRkernel::main()"]) is None
+
+
+def test_hook_fingerprint(nb_app, ipython_scripts_dir):
+    before = _globals.hook_fingerprint()
+    core.main(nb_app, "fake_extension")
+    assert _globals.hook_fingerprint() != before
+
+
+def test_pool_spawn(nb_app, tmpdir, kernel_pool):
+    core.main(nb_app, "fake_extension:func()")
+    kernel_pool.start()
+    assert kernel_pool.wait_ready()
+    hello = kernel_pool._request({"op": "hello"})
+    assert hello["warmed"] == ["fake_extension"]
+
+    connection_file, _ = write_connection_file(
+        tmpdir.join("kernel.json").strpath
+    )
+    cwd = tmpdir.mkdir("notebooks").strpath
+    pid = kernel_pool.spawn(
+        [sys.executable, "-m", "ipykernel_launcher", "-f", connection_file],
+        cwd=cwd
+    )
+    assert pid is not None
+
+    client = BlockingKernelClient(connection_file=connection_file)
+    client.load_connection_file()
+    client.start_channels()
+    try:
+        client.wait_for_ready(timeout=30)
+        outputs = []
+        client.execute_interactive(
+            "import os, sys; print(os.getpid(), os.getcwd(),"
+            " 'fake_extension' in sys.modules)",
+            output_hook=lambda msg: outputs.append(
+                msg["content"].get("text", "")
+            ),
+            timeout=30
+        )
+        # The hooked module came from the template, without an import.
+        assert "".join(outputs).split() == [str(pid), cwd, "True"]
+    finally:
+        client.shutdown()
+        client.stop_channels()
+
+
+def test_pool_recycles_on_hook_change(nb_app, kernel_pool):
+    kernel_pool.start()
+    assert kernel_pool.wait_ready()
+    template_pid = kernel_pool.process.pid
+
+    core.main(nb_app, "fake_extension")
+    cmd = [sys.executable, "-m", "ipykernel_launcher", "-f", "kernel.json"]
+    assert kernel_pool.spawn(cmd) is None
+    assert kernel_pool.process.pid != template_pid
+
+    assert kernel_pool.wait_ready()
+    hello = kernel_pool._request({"op": "hello"})
+    assert hello["warmed"] == ["fake_extension"]
+
+
+def test_pool_recycles_on_config_change(nb_app, kernel_pool,
+                                        jupyter_config_dir):
+    """Enabling an extension in the config changes what the template warms,
+    even if no startup script changed."""
+    kernel_pool.start()
+    assert kernel_pool.wait_ready()
+    template_pid = kernel_pool.process.pid
+
+    config = jupyter_config_dir.join("jupyter_notebook_config.json")
+    config.write_text(config.read_text(encoding="utf8") + "\n",
+                      encoding="utf8")
+    cmd = [sys.executable, "-m", "ipykernel_launcher", "-f", "kernel.json"]
+    assert kernel_pool.spawn(cmd) is None
+    assert kernel_pool.process.pid != template_pid
+
+
+def test_pool_not_importable(monkeypatch, kernel_pool):
+    """Kernels whose environment doesn't have ``jupyter_kernel_hook`` start
+    the normal way, without a template."""
+    monkeypatch.delenv("PYTHONPATH")
+    cmd = [sys.executable, "-m", "ipykernel_launcher", "-f", "kernel.json"]
+    assert kernel_pool.spawn(cmd) is None
+    assert kernel_pool.process is None
+    assert kernel_pool.spawn(cmd) is None
+    assert kernel_pool.process is None
+
+
+def test_provisioner_falls_back(kernel_pool):
+    """Until the template is ready, kernels start the normal way."""
+    prov = provisioner.PooledProvisioner(kernel_id="k", kernel_spec=None)
+    cmd = [sys.executable, "-m", "ipykernel_launcher", "-f", "kernel.json"]
+    with patch.object(pool, "get_pool", return_value=kernel_pool), \
+            patch.object(provisioner.LocalProvisioner, "launch_kernel") \
+            as launch_kernel:
+        asyncio.run(prov.launch_kernel(cmd, env=dict(os.environ)))
+    launch_kernel.assert_called_once()
+    assert prov.process is None
+
+
+def test_provisioner_spawns_off_loop():
+    """The pool is only used from a worker thread, never the event loop."""
+    threads = []
+
+    def spawn(cmd, env=None, cwd=None):
+        threads.append(threading.current_thread())
+        return os.getpid()
+
+    prov = provisioner.PooledProvisioner(kernel_id="k", kernel_spec=None)
+    cmd = [sys.executable, "-m", "ipykernel_launcher", "-f", "kernel.json"]
+    with patch.object(pool, "supported", return_value=True), \
+            patch.object(pool, "get_pool") as get_pool:
+        get_pool.return_value.spawn = spawn
+        asyncio.run(prov.launch_kernel(cmd, env=dict(os.environ)))
+    assert threads and threads[0] is not threading.main_thread()
+    assert prov.pid == os.getpid()
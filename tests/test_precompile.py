@@ -0,0 +1,93 @@
+import os
+import sys
+import importlib.util
+from unittest.mock import patch
+
+import pytest
+
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import runtime
+from jupyter_kernel_hook import precompile
+
+pytestmark = pytest.mark.skipif(
+    not precompile.supported(), reason="requires sys.pycache_prefix"
+)
+
+
+def _pyc(source, prefix):
+    with patch.object(sys, "pycache_prefix", prefix):
+        return importlib.util.cache_from_source(source)
+
+
+def test_precompile(fake_package):
+    result = precompile.precompile("fake_package")
+    sources = [fake_package.join(i).strpath for i in ("__init__.py", "sub.py")]
+    assert sorted(result.sources) == sources
+    assert result.compiled == 2
+    for source in sources:
+        with open(_pyc(source, result.prefix), "rb") as f:
+            header = f.read(16)
+        # Checked hash-based pycs: a changed source is never run from cache.
+        assert int.from_bytes(header[4:8], "little") == 0b11
+
+    # Nothing changed, so there's no trial import the second time.
+    with patch.object(precompile.subprocess, "run") as run:
+        assert precompile.precompile("fake_package").cached
+        run.assert_not_called()
+
+    # A changed source invalidates the closure, and is recompiled alone.
+    fake_package.join("sub.py").write_text("value = 420\n", encoding="utf8")
+    result = precompile.precompile("fake_package")
+    assert not result.cached
+    assert result.compiled == 1
+
+
+def test_precompile_import_error(fake_extension_module):
+    with pytest.raises(RuntimeError):
+        precompile.precompile("not_a_real_package")
+
+
+def test_hook_imports_from_prefix(fake_package):
+    result = precompile.precompile("fake_package")
+    prefix_before = sys.pycache_prefix
+    hook = runtime.Hook(path="fake_package", pycache_prefix=result.prefix)
+    module = hook.import_module()
+    assert module.__cached__.startswith(result.prefix)
+    assert sys.pycache_prefix == prefix_before
+
+
+def test_core_main_precompile(nb_app, ipython_scripts_dir,
+                              fake_extension_module):
+    core.main(nb_app, "fake_extension:func()", precompile=True)
+    script = ipython_scripts_dir.join("50-fake_extension.py")
+    assert "'pycache_prefix': " in script.read_text(encoding="utf8")
+
+    with pytest.raises(ValueError):
+        core.main(nb_app, "fake_extension", lazy=True, precompile=True)
+
+
+def test_core_main_precompile_error(nb_app, ipython_scripts_dir):
+    # The hook is still registered, just without precompiling.
+    with patch.object(nb_app.log, "warning") as warning:
+        core.main(nb_app, "fake_extension", precompile=True)
+    assert "Could not precompile" in warning.call_args[0][0]
+    script = ipython_scripts_dir.join("50-fake_extension.py")
+    assert "pycache_prefix" not in script.read_text(encoding="utf8")
+    assert os.path.exists(script.strpath)
+
+
+def test_precompile_records_origins(nb_app, ipython_scripts_dir, fake_package):
+    result = precompile.precompile("fake_package")
+    assert result.modules["fake_package"] == [
+        fake_package.join("__init__.py").strpath,
+        [fake_package.strpath],
+        fake_package.dirname
+    ]
+
+    nb_app.nbserver_extensions["fake_package"] = True
+    core.main(nb_app, "fake_package", bundle=True, precompile=True)
+    manifest = core.read_manifest(
+        ipython_scripts_dir.join("jupyter_kernel_hook.json").strpath
+    )
+    hook = manifest["hooks"]["fake_package"]
+    assert hook["origins"]["modules"] == result.modules
@@ -16,13 +16,30 @@ def test_create_startup_script(core_main, nb_app):
     """Check that `create_startup_script` properly calls ``core.main``."""
 
     args = (nb_app, "foo")
-    kwargs = dict(priority=42, overwrite=True, add_to_globals=True)
+    kwargs = dict(priority=42, overwrite=True, add_to_globals=True,
+                  export_enabled=True, bundle=True,
+                  lazy=True, defer_magics=True, mode="background",
+                  after=["bar"], before=["baz"], wait=False,
+                  precompile=True, time_budget=1.5, memory_budget="1G",
+                  profile=True, conditions={"kernel_name": "python3"})
     jupyter_kernel_hook.create_startup_script(*args, **kwargs)
 
     # We should have passed everything directly to `core.main()`
     core_main.assert_called_once_with(*args, **kwargs)
 
 
+def test_create_startup_scripts(nb_app):
+    """Check that `create_startup_scripts` properly calls ``core.main_many``."""
+    specs = ["foo", {"script_info": "bar", "priority": 10}]
+    with patch.object(core, "main_many") as f:
+        jupyter_kernel_hook.create_startup_scripts(
+            nb_app, specs, export_enabled=True, bundle=True
+        )
+    f.assert_called_once_with(
+        nb_app, specs, export_enabled=True, wait=True, bundle=True
+    )
+
+
 def test_extension_is_enabled():
     # This extension exists (it's created in the jupyter_config_dir fixture)
     assert jupyter_kernel_hook.extension_is_enabled("fake_extension")
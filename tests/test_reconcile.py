@@ -0,0 +1,171 @@
+import os
+import json
+from unittest.mock import patch
+
+import jupyter_kernel_hook
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import hotapply
+from jupyter_kernel_hook.__main__ import main as cli_main
+
+
+def _listdir(directory):
+    return sorted(i.basename for i in directory.listdir())
+
+
+def test_generated_for(nb_app, ipython_scripts_dir):
+    core.main(nb_app, "fake_extension:func(ip)")
+    f = ipython_scripts_dir.join("50-fake_extension.py")
+    assert core.generated_for(f.strpath) == "fake_extension"
+
+    # Scripts from before the marker are recognized too.
+    lines = f.read_text(encoding="utf8").splitlines()
+    assert lines[1] == "# Generated by jupyter_kernel_hook: fake_extension"
+    f.write_text("\n".join(lines[:1] + lines[2:]), encoding="utf8")
+    assert core.generated_for(f.strpath) == "fake_extension"
+
+    other = ipython_scripts_dir.join("10-other.py")
+    other.write_text("import fake_extension\n", encoding="utf8")
+    assert core.generated_for(other.strpath) is None
+
+
+def test_reconcile(nb_app, ipython_scripts_dir, fake_extension_module):
+    core.main(nb_app, "fake_extension")
+    nb_app.nbserver_extensions["missing_extension"] = True
+    core.main(nb_app, "missing_extension")
+    ipython_scripts_dir.join("10-users_own.py").write_text(
+        "print('hello')\n", encoding="utf8"
+    )
+
+    report = core.reconcile_app(nb_app, dry_run=True)
+    assert report.removed == ["missing_extension"]
+    assert len(ipython_scripts_dir.listdir()) == 3
+
+    # The script of an uninstalled extension is removed...
+    report = core.reconcile_app(nb_app)
+    assert report.removed == ["missing_extension"]
+    assert report.kept == ["fake_extension"]
+    assert _listdir(ipython_scripts_dir) == [
+        "10-users_own.py", "50-fake_extension.py"
+    ]
+
+    # ... and so is the script of a disabled extension.
+    nb_app.nbserver_extensions["fake_extension"] = False
+    report = core.reconcile_app(nb_app)
+    assert report.removed == ["fake_extension"]
+    assert _listdir(ipython_scripts_dir) == ["10-users_own.py"]
+
+
+def test_reconcile_jupyter_server(nb_app, ipython_scripts_dir,
+                                  jupyter_config_dir, fake_extension_module):
+    """Extensions enabled for ``jupyter_server`` keep their scripts."""
+    nb_app.nbserver_extensions["other_extension"] = True
+    core.main(nb_app, "fake_extension")
+    core.main(nb_app, "other_extension")
+    del nb_app.nbserver_extensions["other_extension"]
+    fake_extension_module.join("other_extension.py").ensure()
+    jupyter_config_dir.join("jupyter_server_config.json").write_text(
+        json.dumps({
+            "ServerApp": {"jpserver_extensions": {"other_extension": True}}
+        }),
+        encoding="utf8"
+    )
+
+    report = core.reconcile_app(nb_app)
+    assert report.removed == []
+    assert sorted(report.kept) == ["fake_extension", "other_extension"]
+
+
+def test_reconcile_all_stale_scripts(nb_app, ipython_scripts_dir):
+    """Every stale script is removed, not every other one."""
+    nb_app.nbserver_extensions["gone_ext"] = True
+    core.main(nb_app, "gone_ext", priority=10)
+    # E.g. left behind by an older version that didn't rename scripts.
+    ipython_scripts_dir.join("10-gone_ext.py").copy(
+        ipython_scripts_dir.join("50-gone_ext.py")
+    )
+    assert _listdir(ipython_scripts_dir) == ["10-gone_ext.py",
+                                             "50-gone_ext.py"]
+    core._indexes.clear()
+
+    report = core.reconcile_app(nb_app)
+    assert report.removed == ["gone_ext", "gone_ext"]
+    assert _listdir(ipython_scripts_dir) == []
+
+
+def test_reconcile_on_start(monkeypatch, nb_app, ipython_scripts_dir):
+    """The server extension only logs stale scripts unless told otherwise,
+    since another environment may own them.
+    """
+    nb_app.nbserver_extensions["other_env_extension"] = True
+    core.main(nb_app, "other_env_extension")
+
+    monkeypatch.delenv(core.RECONCILE_ENV_VAR, raising=False)
+    # Watching would keep polling after the test.
+    with patch.object(hotapply, "watch") as watch:
+        jupyter_kernel_hook.load_jupyter_server_extension(nb_app)
+    watch.assert_called_once_with(nb_app)
+    assert _listdir(ipython_scripts_dir) == ["50-other_env_extension.py"]
+
+    monkeypatch.setenv(core.RECONCILE_ENV_VAR, "off")
+    assert core.reconcile_on_start(nb_app) is None
+
+    monkeypatch.setenv(core.RECONCILE_ENV_VAR, "quarantine")
+    report = core.reconcile_on_start(nb_app)
+    assert report.quarantined == ["other_env_extension"]
+    assert _listdir(ipython_scripts_dir) == [
+        "50-other_env_extension.py.disabled"
+    ]
+
+    core.main(nb_app, "other_env_extension")
+    monkeypatch.setenv(core.RECONCILE_ENV_VAR, "remove")
+    report = core.reconcile_on_start(nb_app)
+    assert report.removed == ["other_env_extension"]
+    assert _listdir(ipython_scripts_dir) == [
+        "50-other_env_extension.py.disabled"
+    ]
+
+
+def test_reconcile_quarantine(nb_app, ipython_scripts_dir,
+                              fake_extension_module):
+    core.main(nb_app, "fake_extension")
+    core.main(nb_app, "fake_extension:func()", bundle=True)
+    nb_app.nbserver_extensions["fake_extension"] = False
+
+    report = core.reconcile_app(nb_app, quarantine=True)
+    assert report.quarantined == ["fake_extension", "fake_extension"]
+    assert _listdir(ipython_scripts_dir) == [
+        "50-fake_extension.py.disabled", _globals.MANIFEST_FILENAME
+    ]
+    manifest_path = ipython_scripts_dir.join(_globals.MANIFEST_FILENAME)
+    manifest = core.read_manifest(manifest_path.strpath)
+    assert manifest["hooks"] == {}
+    assert list(manifest["quarantine"]) == ["fake_extension"]
+
+    # Registering the hook again takes it out of quarantine.
+    nb_app.nbserver_extensions["fake_extension"] = True
+    core.main(nb_app, "fake_extension:func()", bundle=True)
+    manifest = core.read_manifest(manifest_path.strpath)
+    assert list(manifest["hooks"]) == ["fake_extension"]
+    assert manifest["quarantine"] == {}
+
+
+def test_reconcile_bundle(nb_app, ipython_scripts_dir, fake_extension_module):
+    core.main(nb_app, "fake_extension", bundle=True)
+    nb_app.nbserver_extensions["fake_extension"] = False
+    report = core.reconcile_app(nb_app)
+    assert report.removed == ["fake_extension"]
+    assert ipython_scripts_dir.listdir() == []
+
+
+def test_cli_reconcile(nb_app, ipython_scripts_dir, capsys):
+    nb_app.nbserver_extensions["missing_extension"] = True
+    core.main(nb_app, "missing_extension")
+    args = ["reconcile", "--startup-dir", ipython_scripts_dir.strpath]
+
+    assert cli_main(args + ["--dry-run"]) == 0
+    assert "Would remove 'missing_extension'." in capsys.readouterr().out
+    assert os.listdir(ipython_scripts_dir.strpath)
+
+    assert cli_main(args) == 0
+    assert os.listdir(ipython_scripts_dir.strpath) == []
@@ -0,0 +1,474 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import runtime
+
+
+@pytest.fixture
+def manifest_path(ipython_scripts_dir):
+    yield os.path.join(ipython_scripts_dir.strpath, _globals.MANIFEST_FILENAME)
+
+
+def test_core_main_bundle(nb_app, ipython_scripts_dir, manifest_path):
+    core.main(nb_app, "fake_extension:func(ip)", bundle=True)
+    core.main(nb_app, "disabled_extension", bundle=True)
+
+    with open(manifest_path, encoding="utf8") as f:
+        manifest = json.load(f)
+    assert manifest["version"] == runtime.MANIFEST_VERSION
+    assert manifest["hooks"] == {
+        "fake_extension": {
+            "path": "fake_extension",
+            "obj": "func(ip)",
+            "obj_name": "func",
+            "is_called": True,
+            "uses_ipy": True,
+            "priority": 50,
+            "add_to_globals": False,
+            "lazy": False,
+            "magics": None,
+            "mode": "sync",
+            "after": [],
+            "before": []
+        }
+    }
+
+    # Only the bundle script is created, not one script per extension.
+    assert sorted(os.listdir(ipython_scripts_dir.strpath)) == [
+        _globals.BUNDLE_FILENAME,
+        _globals.MANIFEST_FILENAME
+    ]
+
+    exit_code = subprocess.call(
+        ["flake8", "--isolated", ipython_scripts_dir.strpath]
+    )
+    assert exit_code == 0
+
+
+def test_core_main_bundle_overwrite(nb_app, manifest_path):
+    core.main(nb_app, "fake_extension", bundle=True)
+    core.main(nb_app, "fake_extension", priority=10, bundle=True)
+    assert runtime.load_manifest(manifest_path)[0].priority == 50
+
+    core.main(nb_app, "fake_extension", priority=10, bundle=True, overwrite=True)
+    assert runtime.load_manifest(manifest_path)[0].priority == 10
+
+
+def test_runtime_run(nb_app, manifest_path, fake_extension_module, fake_shell):
+    core.main(nb_app, "fake_extension:func(ip, a='apples')", bundle=True,
+              add_to_globals=True)
+    runtime.run(manifest_path, ip=fake_shell)
+
+    import fake_extension
+    assert fake_extension.calls == [((fake_shell,), {"a": "apples"})]
+    assert fake_shell.user_ns["fake_extension"] is fake_extension
+
+
+def test_runtime_run_priority(monkeypatch, manifest_path, fake_extension_module,
+                              fake_shell):
+    fake_extension_module.join("first_extension.py").write_text(
+        "import fake_extension\nfake_extension.func('first')\n",
+        encoding="utf8"
+    )
+    hooks = {
+        "fake_extension": core.ScriptInfo.from_str(
+            "fake_extension:func('second')"
+        ).to_hook(priority=60),
+        "first_extension": core.ScriptInfo("first_extension").to_hook(
+            priority=40
+        ),
+        "disabled_extension": core.ScriptInfo("disabled_extension").to_hook(
+            priority=10
+        )
+    }
+    with open(manifest_path, "w", encoding="utf8") as f:
+        json.dump({"version": runtime.MANIFEST_VERSION, "hooks": hooks}, f)
+    monkeypatch.setenv(
+        _globals.ENABLED_EXTENSIONS_ENV_VAR,
+        json.dumps(["fake_extension", "first_extension"])
+    )
+    monkeypatch.delitem(sys.modules, "first_extension", raising=False)
+
+    runtime.run(manifest_path, ip=fake_shell)
+
+    import fake_extension
+    assert fake_extension.calls == [(("first",), {}), (("second",), {})]
+
+
+def test_runtime_run_error(nb_app, manifest_path, fake_extension_module,
+                           fake_shell, capsys):
+    core.main(nb_app, "fake_extension:does_not_exist()", bundle=True)
+    runtime.run(manifest_path, ip=fake_shell)
+    assert "does_not_exist" in capsys.readouterr().err
+
+
+def test_runtime_run_no_manifest(manifest_path):
+    runtime.run(manifest_path)
+
+
+@pytest.fixture
+def fake_package(fake_extension_module):
+    package = fake_extension_module.mkdir("fake_package")
+    package.join("__init__.py").write_text("", encoding="utf8")
+    package.join("sub.py").write_text("value = 42\n", encoding="utf8")
+    yield package
+    sys.modules.pop("fake_package", None)
+    sys.modules.pop("fake_package.sub", None)
+
+
+def test_lazy_module(fake_package):
+    ns = {}
+    ns["fake_package"] = runtime.LazyModule(
+        "fake_package",
+        "fake_package.sub",
+        ns
+    )
+    assert "fake_package" not in sys.modules
+
+    # Nested paths work like ``import fake_package.sub``.
+    assert ns["fake_package"].sub.value == 42
+    assert "fake_package.sub" in sys.modules
+
+    # The proxy replaced itself with the real module.
+    assert ns["fake_package"] is sys.modules["fake_package"]
+
+
+def test_runtime_run_lazy(nb_app, manifest_path, fake_extension_module,
+                          fake_shell):
+    core.main(nb_app, "fake_extension", bundle=True, lazy=True)
+    runtime.run(manifest_path, ip=fake_shell)
+
+    assert "fake_extension" not in sys.modules
+    assert fake_shell.user_ns["fake_extension"].calls == []
+    assert fake_shell.user_ns["fake_extension"] is sys.modules["fake_extension"]
+
+
+def test_core_main_lazy_called(nb_app):
+    with pytest.raises(ValueError):
+        core.main(nb_app, "fake_extension:func()", lazy=True)
+
+
+FAKE_MAGIC_SOURCE = """
+from IPython.core.magic import Magics, magics_class, cell_magic, line_magic
+
+loaded = []
+
+
+@magics_class
+class FakeMagics(Magics):
+
+    @cell_magic
+    def fake_cell(self, line, cell):
+        return line, cell
+
+    @line_magic
+    def fake_line(self, line):
+        return line
+
+
+def load_ipython_extension(ip):
+    loaded.append(ip)
+    ip.register_magics(FakeMagics)
+"""
+
+
+@pytest.fixture
+def fake_magic_module(fake_extension_module):
+    f = fake_extension_module.join("fake_magic.py")
+    f.write_text(FAKE_MAGIC_SOURCE, encoding="utf8")
+    yield f
+    sys.modules.pop("fake_magic", None)
+
+
+def test_discover_magics(fake_magic_module, fake_extension_module):
+    s = core.ScriptInfo.from_str("fake_magic:load_ipython_extension(ip)")
+    assert s.discover_magics() == {"cell": ["fake_cell"], "line": ["fake_line"]}
+
+    # Calls that don't register magics can't be deferred.
+    assert core.ScriptInfo.from_str("fake_extension:func(ip)") \
+        .discover_magics() is None
+    assert core.ScriptInfo.from_str("fake_extension:func()") \
+        .discover_magics() is None
+
+
+def test_runtime_magic_stubs(fake_magic_module, ipython_shell):
+    s = core.ScriptInfo.from_str("fake_magic:load_ipython_extension(ip)")
+    sys.modules.pop("fake_magic", None)
+    hook = runtime.Hook.from_dict(s.to_hook(magics={
+        "cell": ["fake_cell"],
+        "line": ["fake_line"]
+    }))
+    hook.run(ip=ipython_shell, user_ns=ipython_shell.user_ns)
+    assert "fake_magic" not in sys.modules
+
+    assert ipython_shell.run_cell_magic("fake_cell", "a", "b") == ("a", "b")
+    assert ipython_shell.run_line_magic("fake_line", "c") == "c"
+
+    # The real magics replaced the stubs, and the hook ran only once.
+    import fake_magic
+    assert fake_magic.loaded == [ipython_shell]
+    magic = ipython_shell.find_magic("fake_line", "line")
+    assert not hasattr(magic, "_jupyter_kernel_hook_stub")
+
+
+def test_core_main_defer_magics(nb_app, ipython_scripts_dir, fake_magic_module):
+    nb_app.nbserver_extensions["fake_magic"] = True
+    s = "fake_magic:load_ipython_extension(ip)"
+    core.main(nb_app, s, defer_magics=True)
+
+    f = ipython_scripts_dir.join(core.ScriptInfo.from_str(s).gen_filename())
+    assert "Hook.from_dict" in f.read_text(encoding="utf8")
+
+    exit_code = subprocess.call(["flake8", "--isolated", f.strpath])
+    assert exit_code == 0
+
+
+def test_discover_magics_cached(fake_magic_module):
+    s = core.ScriptInfo.from_str("fake_magic:load_ipython_extension(ip)")
+    with patch.object(core.ScriptInfo, "discover_magics",
+                      wraps=s.discover_magics) as discover:
+        for _ in range(2):
+            assert core.discover_magics(s) == {
+                "cell": ["fake_cell"], "line": ["fake_line"]
+            }
+        assert discover.call_count == 1
+
+        # A changed package is discovered again.
+        fake_magic_module.write_text(
+            fake_magic_module.read_text(encoding="utf8") + "\n",
+            encoding="utf8"
+        )
+        core.discover_magics(s)
+        assert discover.call_count == 2
+
+
+SLOW_EXTENSION_SOURCE = """
+import threading
+
+import slow_gate
+
+slow_gate.event.wait(10)
+
+calls = []
+
+
+def load(ip):
+    calls.append(threading.current_thread().name)
+"""
+
+
+@pytest.fixture
+def slow_extension_module(fake_extension_module):
+    fake_extension_module.join("slow_gate.py").write_text(
+        "import threading\nevent = threading.Event()\n",
+        encoding="utf8"
+    )
+    fake_extension_module.join("slow_extension.py").write_text(
+        SLOW_EXTENSION_SOURCE,
+        encoding="utf8"
+    )
+    import slow_gate
+    yield slow_gate.event
+    slow_gate.event.set()
+    runtime.wait(10)
+    runtime._watched_shells.clear()
+    sys.modules.pop("slow_gate", None)
+    sys.modules.pop("slow_extension", None)
+
+
+def test_runtime_background(slow_extension_module, ipython_shell):
+    hook = runtime.Hook.from_dict(
+        core.ScriptInfo.from_str("slow_extension:load(ip)").to_hook(
+            mode="background"
+        )
+    )
+    hook.run(ip=ipython_shell, user_ns=ipython_shell.user_ns)
+    (background,) = runtime._pending
+    assert not background.ready
+
+    # Cells that don't need the hook don't wait for it.
+    runtime._on_pre_run_cell(SimpleNamespace(raw_cell="x = 1"))
+    assert not background.applied
+
+    # Cells that mention the package wait for it, then the call runs on the
+    # main thread.
+    threading.Timer(0.1, slow_extension_module.set).start()
+    runtime._on_pre_run_cell(SimpleNamespace(raw_cell="slow_extension.calls"))
+    assert background.applied
+    assert runtime._pending == []
+
+    import slow_extension
+    assert slow_extension.calls == [threading.current_thread().name]
+
+
+def test_runtime_wait(slow_extension_module, ipython_shell):
+    hook = runtime.Hook.from_dict(
+        core.ScriptInfo.from_str("slow_extension:load(ip)").to_hook(
+            mode="background"
+        )
+    )
+    hook.run(ip=ipython_shell, user_ns=ipython_shell.user_ns)
+    assert not runtime.wait(timeout=0.01)
+
+    slow_extension_module.set()
+    assert runtime.wait()
+
+    import slow_extension
+    assert slow_extension.calls == [threading.current_thread().name]
+
+
+def test_core_main_invalid_mode(nb_app):
+    with pytest.raises(ValueError):
+        core.main(nb_app, "fake_extension", mode="eventually")
+
+
+def _hook(path: str, priority: int = 50, **kwargs) -> runtime.Hook:
+    return runtime.Hook(path=path, priority=priority, **kwargs)
+
+
+def test_schedule():
+    hooks = [
+        _hook("a", priority=10, after=["c"]),
+        _hook("b", priority=20),
+        _hook("c", priority=90, after=["not_enabled"]),
+        _hook("d", priority=5, before=["c"]),
+    ]
+    assert [h.path for h in runtime.schedule(hooks)] == ["d", "b", "c", "a"]
+
+
+def test_schedule_cycle():
+    hooks = [
+        _hook("a", priority=10, after=["b"]),
+        _hook("b", priority=20, after=["a"]),
+        _hook("c", priority=30),
+    ]
+    with pytest.warns(UserWarning, match="cyclic"):
+        ordered = runtime.schedule(hooks)
+    assert [h.path for h in ordered] == ["c", "a", "b"]
+
+
+PARALLEL_EXTENSION_SOURCE = """
+import parallel_gate
+
+# Deadlocks (and times out) unless both modules are imported concurrently.
+parallel_gate.barrier.wait()
+
+
+def load():
+    parallel_gate.log.append(__name__)
+"""
+
+DEPENDENT_EXTENSION_SOURCE = """
+import parallel_gate
+
+# Imported only after both parallel extensions have been called.
+imported_after = list(parallel_gate.log)
+"""
+
+
+@pytest.fixture
+def parallel_extension_modules(fake_extension_module):
+    names = ["parallel_a", "parallel_b", "parallel_gate", "dependent"]
+    fake_extension_module.join("parallel_gate.py").write_text(
+        "import threading\n"
+        "barrier = threading.Barrier(2, timeout=5)\n"
+        "log = []\n",
+        encoding="utf8"
+    )
+    for name in names[:2]:
+        fake_extension_module.join(f"{name}.py").write_text(
+            PARALLEL_EXTENSION_SOURCE,
+            encoding="utf8"
+        )
+    fake_extension_module.join("dependent.py").write_text(
+        DEPENDENT_EXTENSION_SOURCE,
+        encoding="utf8"
+    )
+    yield
+    for name in names:
+        sys.modules.pop(name, None)
+
+
+def test_runtime_run_parallel(monkeypatch, manifest_path, fake_shell,
+                              parallel_extension_modules):
+    hooks = {
+        "parallel_a": core.ScriptInfo.from_str("parallel_a:load()").to_hook(),
+        "parallel_b": core.ScriptInfo.from_str("parallel_b:load()").to_hook(),
+        "dependent": core.ScriptInfo("dependent").to_hook(
+            priority=0,
+            after=["parallel_a", "parallel_b"]
+        ),
+    }
+    with open(manifest_path, "w", encoding="utf8") as f:
+        json.dump({"version": runtime.MANIFEST_VERSION, "hooks": hooks}, f)
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, json.dumps(
+        list(hooks)
+    ))
+
+    runtime.run(manifest_path, ip=fake_shell, workers=2)
+
+    import dependent
+    import parallel_gate
+    assert parallel_gate.log == ["parallel_a", "parallel_b"]
+    assert dependent.imported_after == ["parallel_a", "parallel_b"]
+
+
+def test_core_main_after_requires_bundle(nb_app):
+    with pytest.raises(ValueError):
+        core.main(nb_app, "fake_extension", after=["other_extension"])
+
+
+def test_core_main_bundle_origins(nb_app, manifest_path, fake_extension_module):
+    core.main(nb_app, "fake_extension", bundle=True)
+    hook, = runtime.load_manifest(manifest_path)
+    origin = fake_extension_module.join("fake_extension.py").strpath
+    assert hook.origins == {
+        "prefix": sys.prefix,
+        "modules": {
+            "fake_extension": [origin, None, fake_extension_module.strpath]
+        }
+    }
+
+
+def test_origin_finder(monkeypatch, nb_app, manifest_path,
+                       fake_extension_module, fake_shell):
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, '["fake_extension"]')
+    core.main(nb_app, "fake_extension:func()", bundle=True)
+
+    # The kernel goes straight to the recorded file.
+    searched = []
+    monkeypatch.setattr(sys, "path_hooks", [searched.append] + sys.path_hooks)
+    monkeypatch.setattr(sys, "path_importer_cache", {})
+    runtime.run(manifest_path, ip=fake_shell)
+    assert sys.meta_path[0] is runtime._finder
+    assert "fake_extension" in sys.modules
+    assert searched == []
+
+
+def test_origin_finder_fallback(fake_extension_module, tmpdir):
+    origin = fake_extension_module.join("fake_extension.py").strpath
+    finder = runtime.OriginFinder()
+    finder.modules["fake_extension"] = [
+        origin, None, fake_extension_module.strpath
+    ]
+    assert finder.find_spec("fake_extension").origin == origin
+
+    # Moved files and removed sys.path entries go through the normal import.
+    finder.modules["moved"] = [tmpdir.join("moved.py").strpath, None,
+                               fake_extension_module.strpath]
+    assert finder.find_spec("moved") is None
+    finder.modules["elsewhere"] = [origin, None, tmpdir.strpath]
+    assert finder.find_spec("elsewhere") is None
+
+    # Locations from another environment are never used.
+    runtime.add_origins({"prefix": "/other/env", "modules": {}})
+    assert runtime._finder is None
@@ -1,12 +1,17 @@
 import os
+import threading
 import subprocess
 from textwrap import dedent
+from unittest.mock import Mock
+from unittest.mock import patch
 from dataclasses import dataclass
 
 import pytest
 from jupyter_kernel_hook import _globals
 from jupyter_kernel_hook import core
+from jupyter_kernel_hook import hotapply
 from jupyter_kernel_hook.core import ScriptInfo
+from notebook.notebookapp import NotebookApp
 
 
 def test_script_info_from_str():
@@ -33,6 +38,8 @@ def test_script_info_exists(ipython_scripts_dir):
 class ScriptInfoCase:
     text: str
     script: str
+    # Expected startup script in ``golden/``, without extension.
+    golden: str
 
     def __post_init__(self):
         self.script = dedent(self.script).strip()
@@ -47,21 +54,24 @@ render_cases = [
         text="fake_extension",
         script="""
             import fake_extension  # noqa: F401
-            """
+            """,
+        golden="import"
     ),
     ScriptInfoCase(
         text="fake_extension:func()",
         script="""
             from fake_extension import func
             func()
-            """
+            """,
+        golden="call"
     ),
     ScriptInfoCase(
         text="fake_extension:func(a='apples')",
         script="""
             from fake_extension import func
             func(a='apples')
-            """
+            """,
+        golden="call_kwarg"
     ),
     ScriptInfoCase(
         text="fake_extension:func(ip)",
@@ -70,7 +80,8 @@ render_cases = [
             from IPython import get_ipython
             ip = get_ipython()
             func(ip)
-            """
+            """,
+        golden="call_ip"
     ),
     ScriptInfoCase(
         text="fake_extension:func(ip=ip)",
@@ -79,7 +90,8 @@ render_cases = [
             from IPython import get_ipython
             ip = get_ipython()
             func(ip=ip)
-            """
+            """,
+        golden="call_ip_kwarg"
     ),
     ScriptInfoCase(
         text="fake_extension:func(2, ip=ip, a='apples')",
@@ -88,7 +100,8 @@ render_cases = [
             from IPython import get_ipython
             ip = get_ipython()
             func(2, ip=ip, a='apples')
-            """
+            """,
+        golden="call_mixed"
     )
 ]
 
@@ -98,40 +111,126 @@ def test_script_info_render(script_info_case):
     assert script_info_case.obj.render() == script_info_case.script
 
 
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "golden")
+
+
+def _golden(name):
+    with open(os.path.join(GOLDEN_DIR, name), encoding="utf8") as f:
+        return f.read()
+
+
+def _flake8(script, tmpdir):
+    directory = tmpdir.mkdir("scripts")
+    f = directory.join("main.py")
+    f.write_text(script, encoding="utf8")
+    return subprocess.call(["flake8", "--isolated", directory.strpath])
+
+
 @pytest.mark.parametrize("script_info_case", render_cases)
-def test_jinja_env_render(jinja_env, script_info_case):
-    template = jinja_env.get_template("init.py.jinja")
-    full_script = template.render(script_info=script_info_case.obj)
+def test_render_startup_script(script_info_case):
+    full_script = core.render_startup_script(script_info_case.obj)
 
     for row in script_info_case.script.split("\n"):
         assert row.strip() in full_script
 
 
+@pytest.mark.parametrize("script_info_case", render_cases)
+def test_render_startup_script_golden(script_info_case):
+    """Scripts with the default options, line for line."""
+    script = core.render_startup_script(script_info_case.obj)
+    assert script == _golden(f"{script_info_case.golden}.py")
+
+
 @pytest.mark.parametrize("script_info_case", render_cases)
 @pytest.mark.parametrize("add_to_globals", [False, True])
-def test_jinja_env_valid_py_file(script_info_case, add_to_globals,
-                                 jinja_env, tmpdir):
-    template = jinja_env.get_template("init.py.jinja")
-    full_script = template.render(
-        script_info=script_info_case.obj,
+def test_startup_script_valid_py_file(script_info_case, add_to_globals,
+                                      tmpdir):
+    full_script = core.render_startup_script(
+        script_info_case.obj,
         add_to_globals=add_to_globals
     )
+    assert _flake8(full_script, tmpdir) == 0
+
+
+@pytest.mark.parametrize("add_to_globals", [False, True])
+def test_startup_script_lazy(add_to_globals, tmpdir):
+    full_script = core.render_startup_script(
+        ScriptInfo.from_str("fake_extension.sub"),
+        add_to_globals=add_to_globals,
+        lazy=True
+    )
+    assert "import fake_extension" not in full_script
+    assert "'fake_extension', 'fake_extension.sub', globals()" in full_script
+    assert _flake8(full_script, tmpdir) == 0
+
+
+def test_script_info_render_nested_add_to_globals():
+    s = ScriptInfo.from_str("fake_extension.sub")
+    assert s.render(add_to_globals=True) == dedent("""
+        import fake_extension.sub
+        globals()['fake_extension'] = fake_extension
+        """).strip()
+
+
+render_options = [
+    dict(),
+    dict(add_to_globals=True),
+    dict(lazy=True),
+    dict(add_to_globals=True, lazy=True),
+    dict(magics={"cell": ["fake_cell"], "line": ["fake_line"]}),
+    dict(mode="background"),
+    dict(add_to_globals=True, mode="background"),
+    dict(pycache_prefix="/home/me/.cache/jupyter_kernel_hook/pycache"),
+    dict(time_budget=2.5, memory_budget=2 ** 28),
+    dict(conditions={"kernel_name": ["!batch-*"], "env": {"CI": None}}),
+    dict(mode="background", conditions={"executable": ["*/envs/ds/*"]}),
+]
 
-    directory = tmpdir.mkdir("scripts")
-    f = directory.join("main.py")
-    f.write_text(full_script, encoding="utf8")
 
-    exit_code = subprocess.call(
-        ["flake8", "--isolated", directory.strpath],
-        # stdout=open(os.devnull, 'w')
+# Lazy hooks can't have a call.
+render_combinations = [
+    (case, options)
+    for case in render_cases
+    for options in render_options
+    if not (options.get("lazy") and case.obj.is_called)
+]
+
+
+@pytest.mark.parametrize("script_info_case, options", render_combinations)
+def test_render_startup_script_options(script_info_case, options, tmpdir):
+    """Every combination of options renders a valid, generated script."""
+    script = core.render_startup_script(script_info_case.obj, **options)
+    assert script.splitlines()[1] == (
+        f"{core.SCRIPT_MARKER}: {script_info_case.obj.path}"
     )
+    assert _flake8(script, tmpdir) == 0
+
+
+@pytest.mark.parametrize("manifest_path", [
+    "/path/to/startup/jupyter_kernel_hook.json",
+    "C:\\Users\\me's\\startup\\jupyter_kernel_hook.json",
+])
+def test_render_bundle_script(manifest_path, tmpdir):
+    script = core.render_bundle_script(manifest_path)
+    assert f"runtime.run({manifest_path!r})" in script
+    assert _flake8(script, tmpdir) == 0
+
+
+def test_render_bundle_script_golden():
+    script = core.render_bundle_script(
+        "/path/to/startup/jupyter_kernel_hook.json"
+    )
+    assert script == _golden("bundle.py")
+
 
-    assert exit_code == 0
+def test_render_listener_script_golden(tmpdir):
+    script = core.render_listener_script()
+    assert script == _golden("listener.py")
+    assert _flake8(script, tmpdir) == 0
 
 
 @pytest.mark.parametrize("script_info_case", render_cases)
-def test_core_main(nb_app, script_info_case,
-                   ipython_scripts_dir, jinja_env):
+def test_core_main(nb_app, script_info_case, ipython_scripts_dir):
     core.main(
         nb_app,
         script_info_case.text
@@ -142,10 +241,7 @@ def test_core_main(nb_app, script_info_case,
 
     assert f.exists()
 
-    template = jinja_env.get_template("init.py.jinja")
-    expected_contents = template.render(
-        script_info=script_info_case.obj
-    )
+    expected_contents = core.render_startup_script(script_info_case.obj)
     actual_contents = f.read_text(encoding="utf8")
 
     assert actual_contents == expected_contents
@@ -163,3 +259,161 @@ def test_core_main_disabled_ext(
     f = ipython_scripts_dir.join(filename)
 
     assert not f.exists()
+
+
+def test_core_main_steady_state(nb_app, ipython_scripts_dir):
+    core.main(nb_app, "fake_extension:func()")
+    core._indexes.clear()
+
+    # A restarted server lists the directory once and writes nothing.
+    with patch.object(os, "scandir", wraps=os.scandir) as scandir, \
+            patch.object(_globals, "_atomic_write") as atomic_write:
+        for _ in range(3):
+            core.main(nb_app, "fake_extension:func()", overwrite=True)
+            core.main(nb_app, "fake_extension:func()", bundle=True)
+            core.main(nb_app, "fake_extension:func()", bundle=True)
+        assert scandir.call_count == 1
+        assert atomic_write.call_count == 2  # first manifest + bundle script
+    core._indexes.clear()
+
+    # Changed content is rewritten atomically, without temp files left over.
+    core.main(nb_app, "fake_extension:func(ip)", overwrite=True)
+    assert sorted(i.basename for i in ipython_scripts_dir.listdir()) == [
+        "50-fake_extension.py"
+    ]
+    f = ipython_scripts_dir.join("50-fake_extension.py")
+    assert "func(ip)" in f.read_text(encoding="utf8")
+
+
+def test_core_main_priority_change(nb_app, ipython_scripts_dir):
+    core.main(nb_app, "fake_extension")
+    core.main(nb_app, "fake_extension", priority=10, overwrite=True)
+    assert sorted(i.basename for i in ipython_scripts_dir.listdir()) == [
+        "10-fake_extension.py"
+    ]
+
+    # Leftover duplicates from older versions are cleaned up too.
+    ipython_scripts_dir.join("30-fake_extension.py").write_text(
+        "", encoding="utf8"
+    )
+    core._indexes.clear()
+    core.main(nb_app, "fake_extension", priority=20, overwrite=True)
+    assert sorted(i.basename for i in ipython_scripts_dir.listdir()) == [
+        "20-fake_extension.py"
+    ]
+
+
+@pytest.fixture
+def batch_nb_app(jupyter_config_dir):
+    yield NotebookApp(
+        nbserver_extensions={
+            "fake_extension": True,
+            "other_extension": True,
+            "disabled_extension": False
+        }
+    )
+
+
+def test_core_main_many(batch_nb_app, ipython_scripts_dir):
+    specs = [
+        "fake_extension:func()",
+        {"script_info": "other_extension", "priority": 10},
+        "disabled_extension"
+    ]
+    report = core.main_many(batch_nb_app, specs)
+    assert sorted(os.path.basename(i) for i in report.written) == [
+        "10-other_extension.py", "50-fake_extension.py"
+    ]
+    assert report.skipped == []
+    assert report.disabled == ["disabled_extension"]
+
+    report = core.main_many(batch_nb_app, specs, overwrite=True)
+    assert report.written == []
+    assert sorted(report.skipped) == ["fake_extension", "other_extension"]
+
+
+def test_core_main_many_bundle(batch_nb_app, ipython_scripts_dir):
+    specs = ["fake_extension:func()", "other_extension"]
+    with patch.object(_globals, "_atomic_write",
+                      wraps=_globals._atomic_write) as atomic_write:
+        report = core.main_many(batch_nb_app, specs, bundle=True)
+    assert atomic_write.call_count == 2  # one manifest + bundle script
+    assert sorted(os.path.basename(i) for i in report.written) == [
+        _globals.BUNDLE_FILENAME, _globals.MANIFEST_FILENAME
+    ]
+    manifest = core.read_manifest(report.written[0])
+    assert sorted(manifest["hooks"]) == ["fake_extension", "other_extension"]
+
+
+def test_core_main_many_validates_first(batch_nb_app, ipython_scripts_dir):
+    specs = ["fake_extension", {"script_info": "other_extension", "mode": "x"}]
+    with pytest.raises(ValueError):
+        core.main_many(batch_nb_app, specs)
+    assert ipython_scripts_dir.listdir() == []
+
+
+def test_parse_obj_cached():
+    core._parse_obj.cache_clear()
+    info = ScriptInfo.from_str("fake_extension:func(ip)")
+    assert info.uses_ipy and info.is_called and info.obj_name == "func"
+    assert core._parse_obj.cache_info().misses == 1
+
+
+def test_core_main_no_wait(nb_app, ipython_scripts_dir):
+    started = threading.Event()
+    release = threading.Event()
+    register = core.register
+
+    def slow_register(*args, **kwargs):
+        started.set()
+        release.wait(5)
+        return register(*args, **kwargs)
+
+    with patch.object(core, "register", slow_register):
+        future = core.main(nb_app, "fake_extension", wait=False)
+        assert started.wait(5)
+        assert not future.done()
+        release.set()
+        report = future.result(5)
+
+    assert [os.path.basename(i) for i in report.written] == [
+        "50-fake_extension.py"
+    ]
+
+
+def test_core_main_no_wait_pushes_to_early_kernels(nb_app,
+                                                   ipython_scripts_dir):
+    kernel_ids = [["k0"], ["k0", "k1", "k2"]]
+    nb_app.kernel_manager = Mock(
+        list_kernel_ids=lambda: kernel_ids.pop(0),
+        get_kernel=lambda kernel_id: kernel_id
+    )
+    # The payload is ready before anything runs on the IO loop.
+    callbacks = []
+    nb_app.io_loop = Mock(add_callback=callbacks.append)
+    with patch.object(hotapply, "send") as send, \
+            patch.object(hotapply.Watcher, "listening",
+                         lambda self, kernel: kernel == "k1"), \
+            patch.object(nb_app.log, "warning") as warning:
+        core.main(nb_app, "fake_extension", wait=False).result(5)
+        send.assert_not_called()
+        with patch.object(hotapply.Watcher, "payload") as payload:
+            callbacks.pop()()
+        payload.assert_not_called()
+
+    # Only the kernels that started while the script was written get it, if
+    # they listen.
+    send.assert_called_once()
+    kernel, data = send.call_args[0]
+    assert kernel == "k1"
+    assert data["scripts"] == [
+        ipython_scripts_dir.join("50-fake_extension.py").strpath
+    ]
+    sent, missed = [c[0][0] for c in warning.call_args_list]
+    assert "['k1']" in sent and "sent" in sent
+    assert "['k2']" in missed and "Restart" in missed
+
+
+def test_core_main_many_no_wait_validates_first(batch_nb_app):
+    with pytest.raises(ValueError):
+        core.main_many(batch_nb_app, ["fake_extension"], mode="x", wait=False)
@@ -0,0 +1,104 @@
+import os
+import json
+import threading
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import runtime
+from jupyter_kernel_hook.__main__ import main as cli_main
+
+
+def test_install_shared(tmpdir):
+    config_dir = tmpdir.mkdir("etc_ipython")
+    config_path = config_dir.join(core.SHARED_CONFIG_FILENAME)
+    config_path.write_text(
+        json.dumps({"IPKernelApp": {"pylab": "inline"}}), encoding="utf8"
+    )
+
+    report = core.install_shared(
+        ["fake_extension:func(ip)"], ipython_config_dir=config_dir.strpath
+    )
+    shared_dir = _globals.get_shared_dir()
+    bundle_path = os.path.join(shared_dir, _globals.BUNDLE_FILENAME)
+    assert sorted(report.written) == sorted([
+        os.path.join(shared_dir, _globals.MANIFEST_FILENAME),
+        bundle_path,
+        config_path.strpath
+    ])
+
+    # The existing kernel config is kept.
+    config = json.loads(config_path.read_text(encoding="utf8"))
+    assert config == {
+        "IPKernelApp": {"pylab": "inline"},
+        "InteractiveShellApp": {"exec_files": [bundle_path]}
+    }
+
+    report = core.install_shared(
+        ["fake_extension:func(ip)"], ipython_config_dir=config_dir.strpath
+    )
+    assert report.written == []
+    assert report.skipped == ["fake_extension"]
+
+
+def test_register_skips_shared_hooks(nb_app, ipython_scripts_dir, tmpdir):
+    core.install_shared(
+        ["fake_extension"], ipython_config_dir=tmpdir.strpath
+    )
+    report = core.main_many(nb_app, ["fake_extension"])
+    assert report.written == []
+    assert report.skipped == ["fake_extension"]
+    assert ipython_scripts_dir.listdir() == []
+
+
+def test_concurrent_registration(ipython_scripts_dir):
+    """Separate indexes of one directory, as in separate servers, don't lose
+    each other's hooks."""
+    startup_dir = ipython_scripts_dir.strpath
+    log = core.logging.getLogger("test")
+
+    def register(i):
+        index = core.StartupDirIndex(startup_dir)
+        spec = core.HookSpec(f"ext_{i}", bundle=True)
+        with index.locked():
+            core._write_hooks(index, [spec], {}, core.RegistrationReport(),
+                              log)
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    manifest = core.read_manifest(
+        os.path.join(startup_dir, _globals.MANIFEST_FILENAME)
+    )
+    assert sorted(manifest["hooks"]) == [f"ext_{i}" for i in range(8)]
+
+
+def test_runtime_run_once_per_hook(monkeypatch, nb_app, tmpdir,
+                                   fake_extension_module, fake_shell):
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, '["fake_extension"]')
+    core.install_shared(["fake_extension:func()"], ipython_config_dir=tmpdir)
+    manifest_path = os.path.join(
+        _globals.get_shared_dir(), _globals.MANIFEST_FILENAME
+    )
+    runtime.run(manifest_path, ip=fake_shell)
+    runtime.run(manifest_path, ip=fake_shell)
+
+    import fake_extension
+    assert fake_extension.calls == [((), {})]
+
+
+def test_cli_install_shared(tmpdir, capsys):
+    shared_dir = tmpdir.join("cli_shared")
+    args = ["install-shared", "fake_extension", "--priority", "10",
+            "--shared-dir", shared_dir.strpath,
+            "--ipython-config-dir", tmpdir.strpath]
+    assert cli_main(args) == 0
+    manifest = core.read_manifest(
+        shared_dir.join(_globals.MANIFEST_FILENAME).strpath
+    )
+    assert manifest["hooks"]["fake_extension"]["priority"] == 10
+
+    assert cli_main(args) == 0
+    assert "'fake_extension' is already installed." in capsys.readouterr().out
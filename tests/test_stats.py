@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import stats
+from jupyter_kernel_hook import runtime
+
+
+@pytest.fixture
+def log_file(monkeypatch, tmpdir):
+    f = tmpdir.join("kernel_hooks.jsonl")
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_LOG", f.strpath)
+    yield f
+
+
+def test_record_hook(monkeypatch, log_file):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_TRACEMALLOC", "1")
+    with stats.record_hook("foo"):
+        x = bytearray(2 ** 20)  # noqa: F841
+
+    with pytest.raises(KeyError):
+        with stats.record_hook("bar", mode="lazy"):
+            raise KeyError("oops")
+
+    foo, bar = stats.records
+    assert foo.seconds > 0
+    assert foo.peak_memory >= 2 ** 20
+    assert foo.error is None
+    assert bar.mode == "lazy"
+    assert bar.error == "KeyError: 'oops'"
+
+    lines = [json.loads(i) for i in log_file.readlines()]
+    assert [i["path"] for i in lines] == ["foo", "bar"]
+    assert lines[1]["error"] == "KeyError: 'oops'"
+
+
+def test_runtime_records(nb_app, ipython_scripts_dir, fake_extension_module,
+                         fake_shell):
+    core.main(nb_app, "fake_extension:func()", bundle=True)
+    manifest_path = ipython_scripts_dir.join(_globals.MANIFEST_FILENAME)
+    runtime.run(manifest_path.strpath, ip=fake_shell)
+
+    (record,) = stats.records
+    assert record.path == "fake_extension"
+    assert record.mode == "sync"
+    assert record.import_seconds is not None
+    assert record.call_seconds is not None
+    assert record.modules_added == 1
+    assert _globals._enabled_lookup["source"] == "config"
+
+
+def test_kernel_hooks_magic(ipython_shell, capsys):
+    with stats.record_hook("foo"):
+        pass
+    _globals.__getattr__("enabled_server_extensions")
+
+    ipython_shell.run_line_magic("kernel_hooks", "")
+    out = capsys.readouterr().out
+    assert "foo" in out
+    assert "Enabled extension lookup" in out
+
+    ipython_shell.run_line_magic("kernel_hooks", "--json")
+    data = json.loads(capsys.readouterr().out)
+    assert data["hooks"][0]["path"] == "foo"
+    assert data["enabled_lookup"]["source"] == "config"
@@ -0,0 +1,188 @@
+import sys
+import json
+from unittest.mock import patch
+
+import pytest
+
+from jupyter_kernel_hook import _globals
+from jupyter_kernel_hook import core
+from jupyter_kernel_hook import runtime
+from jupyter_kernel_hook import stats
+from jupyter_kernel_hook import watchdog
+
+
+HANGING_EXTENSION_SOURCE = """
+import hang_gate
+
+hang_gate.event.wait(10)
+
+
+def load():
+    hang_gate.log.append("load")
+"""
+
+
+@pytest.fixture
+def hanging_extension(fake_extension_module):
+    fake_extension_module.join("hang_gate.py").write_text(
+        "import threading\nevent = threading.Event()\nlog = []\n",
+        encoding="utf8"
+    )
+    fake_extension_module.join("hanging_extension.py").write_text(
+        HANGING_EXTENSION_SOURCE,
+        encoding="utf8"
+    )
+    import hang_gate
+    yield hang_gate
+    hang_gate.event.set()
+    sys.modules.pop("hang_gate", None)
+    sys.modules.pop("hanging_extension", None)
+
+
+def _hook(script_info, **kwargs):
+    return runtime.Hook.from_dict(
+        core.ScriptInfo.from_str(script_info).to_hook(**kwargs)
+    )
+
+
+def test_parse_size():
+    assert watchdog.parse_size("512M") == 512 * 2 ** 20
+    assert watchdog.parse_size("1.5GiB") == 3 * 2 ** 29
+    assert watchdog.parse_size("1000") == 1000
+    assert watchdog.parse_size(42) == 42
+    with pytest.raises(ValueError):
+        watchdog.parse_size("lots")
+
+
+def test_budget_clip():
+    budget = watchdog.Budget(seconds=2).clip(watchdog.Budget(1, 100))
+    assert budget == watchdog.Budget(seconds=1, memory=100)
+    assert not watchdog.Budget()
+
+
+def test_hook_spec_budgets():
+    spec = core.HookSpec("fake_extension", time_budget="1.5",
+                         memory_budget="1M")
+    assert spec.time_budget == 1.5
+    assert spec.memory_budget == 2 ** 20
+    assert spec.to_hook()["memory_budget"] == 2 ** 20
+    with pytest.raises(ValueError):
+        core.HookSpec("fake_extension", time_budget=0)
+    with pytest.raises(ValueError):
+        core.HookSpec("fake_extension", memory_budget="-1K")
+
+
+def test_core_main_budget(nb_app, ipython_scripts_dir):
+    core.main(nb_app, "fake_extension:func()", time_budget=2)
+    script = ipython_scripts_dir.join("50-fake_extension.py")
+    content = script.read_text(encoding="utf8")
+    assert "run_hook(hook" in content
+    assert "'time_budget': 2.0," in content
+
+
+def test_time_budget(hanging_extension):
+    hook = _hook("hanging_extension:load()", time_budget=0.1)
+    with stats.record_hook(hook.path) as record, \
+            pytest.warns(UserWarning, match="took more than 0.1s"):
+        hook.run(record=record)
+    assert record.seconds < 5
+    assert "later kernels will skip it" in record.error
+    assert hanging_extension.log == []
+    assert list(watchdog.read_overruns()) == ["hanging_extension"]
+
+    # Later kernels skip the hook without importing it...
+    hanging_extension.event.set()
+    hook = _hook("hanging_extension:load()", time_budget=0.1)
+    with patch.object(hook, "import_module") as import_module, \
+            pytest.warns(UserWarning, match="Skipped hook"):
+        hook.run()
+    import_module.assert_not_called()
+
+    # ... until its version changes.
+    with patch.object(_globals, "package_version", return_value="2.0"):
+        hook.run()
+    assert hanging_extension.log == ["load"]
+
+
+def test_admin_budget(monkeypatch, hanging_extension):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_TIME_BUDGET", "0.1")
+    hook = _hook("hanging_extension:load()", time_budget=60)
+    with pytest.warns(UserWarning, match="took more than 0.1s"):
+        hook.run()
+    assert hanging_extension.log == []
+
+
+def test_admin_budget_per_file(monkeypatch, nb_app, ipython_scripts_dir,
+                               ipython_shell, hanging_extension):
+    """Scripts for hooks registered without a budget still honor the
+    budgets that admins set."""
+    nb_app.nbserver_extensions["hanging_extension"] = True
+    core.main(nb_app, "hanging_extension:load()")
+    script = ipython_scripts_dir.join("50-hanging_extension.py")
+    assert "time_budget" not in script.read_text(encoding="utf8")
+
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR,
+                       '["hanging_extension"]')
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_TIME_BUDGET", "0.1")
+    with pytest.warns(UserWarning, match="took more than 0.1s"):
+        ipython_shell.safe_execfile(script.strpath, ipython_shell.user_ns,
+                                    raise_exceptions=True)
+    assert hanging_extension.log == []
+    assert stats.records[-1].error
+
+
+def test_total_budget(monkeypatch, fake_extension_module):
+    monkeypatch.setenv("JUPYTER_KERNEL_HOOK_TOTAL_TIME_BUDGET", "1")
+    watchdog._spent["seconds"] = 1.5
+    hook = _hook("fake_extension:func()")
+    with pytest.warns(UserWarning, match="total budget of -0.5s"):
+        hook.run()
+    assert "fake_extension" not in sys.modules
+    # Running out of the total budget isn't the hook's fault.
+    assert watchdog.read_overruns() == {}
+
+
+def test_memory_budget(fake_extension_module):
+    if watchdog.rss() is None:
+        pytest.skip("can't measure memory")
+    fake_extension_module.join("hungry_extension.py").write_text(
+        "data = b'x' * 2 ** 26\n", encoding="utf8"
+    )
+    hook = _hook("hungry_extension", memory_budget=2 ** 20)
+    try:
+        with pytest.warns(UserWarning, match="grew memory by more than 1MiB"):
+            hook.run()
+    finally:
+        sys.modules.pop("hungry_extension", None)
+    assert list(watchdog.read_overruns()) == ["hungry_extension"]
+
+    watchdog.clear_overruns()
+    assert watchdog.read_overruns() == {}
+
+
+def test_runtime_run_budget(monkeypatch, ipython_scripts_dir, fake_shell,
+                            hanging_extension, fake_extension_module):
+    """Imports running ahead on the import pool are bounded too."""
+    hooks = {
+        "hanging_extension": core.ScriptInfo.from_str(
+            "hanging_extension:load()"
+        ).to_hook(time_budget=0.1),
+        "fake_extension": core.ScriptInfo.from_str(
+            "fake_extension:func()"
+        ).to_hook(),
+    }
+    manifest_path = ipython_scripts_dir.join(_globals.MANIFEST_FILENAME)
+    manifest_path.write_text(
+        json.dumps({"version": runtime.MANIFEST_VERSION, "hooks": hooks}),
+        encoding="utf8"
+    )
+    monkeypatch.setenv(_globals.ENABLED_EXTENSIONS_ENV_VAR, json.dumps(
+        list(hooks)
+    ))
+
+    with pytest.warns(UserWarning, match="'hanging_extension' took more"):
+        runtime.run(manifest_path.strpath, ip=fake_shell, workers=2)
+
+    import fake_extension
+    assert fake_extension.calls == [((), {})]
+    assert hanging_extension.log == []